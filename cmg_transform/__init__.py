@@ -4,7 +4,8 @@ This module contains the classes related to CMG data transformation.
 import csv
 from ncpi_fhir_plugin.common import CONCEPT, constants
 from csv import DictReader
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import lru_cache, partial
 from cmg_transform.change_logger import ChangeLog
 import sys
 import pdb 
@@ -34,6 +35,172 @@ def strip(val):
     if val is not None:
         return val.strip()
     return val
+class UnmatchedConstant(AttributeError):
+    def __init__(self, constobj, value, propname):
+        super().__init__(f"Unmatched entry, {propname}, for {constobj.__name__}")
+        self.constobj = constobj
+        self.value = value
+        self.propname = propname
+
+class ConstantNormalizer:
+    """Maps raw values onto a constant class's values (including the alt 
+    transforms) with a single dictionary lookup. 
+
+    Every distinct raw value is only resolved once. Those that can't be
+    matched are counted in misses rather than being re-resolved for every 
+    cell they appear in."""
+    def __init__(self, constobj, alt_transforms):
+        self.constobj = constobj
+        self.alt_transforms = alt_transforms
+
+        # Everything that getattr(constobj, PROPNAME) would have found
+        self.properties = {}
+        for propname in dir(constobj):
+            if propname[0] != '_':
+                self.properties[propname] = getattr(constobj, propname)
+        self.choices = ', '.join(self.properties.keys())
+
+        # raw value => canonical value
+        self.lookup = {}
+
+        # raw value => number of times we were unable to match it
+        self.misses = defaultdict(int)
+
+    def normalize(self, rawval, default_to_empty=False):
+        try:
+            return self.lookup[rawval]
+        except KeyError:
+            pass
+
+        if self.resolve(rawval):
+            return self.lookup[rawval]
+        return self.miss(rawval, default_to_empty)
+
+    def resolve(self, rawval):
+        """Adds rawval to the lookup if it can be matched. Unlike normalize, a
+        value that can't be matched isn't counted (or complained about)"""
+        if rawval in self.lookup:
+            return True
+
+        if rawval in self.misses:
+            return False
+
+        if rawval is None or rawval.strip() == "":
+            self.lookup[rawval] = None
+            return True
+
+        val = rawval
+        # For the CMG datasets I've seen, chromosomes are bare numbers/letters
+        # this doesn't make for very useful constant variable names and we 
+        # do want to enforce constants and provide something clear for the
+        # display parameter
+        if self.constobj == constants.DISCOVERY.VARIANT.CHROMOSOME:
+            if val in Transform._raw_chroms:
+                val = f"Chr{val}"
+
+        # Definitely want to get rid of whitespace. We'll take the extracted 
+        # value so that case coming in doesn't have to match
+        propname = val.strip().upper().replace(" ", "_")
+        if propname in self.properties:
+            self.lookup[rawval] = self.properties[propname]
+            return True
+
+        if val in self.alt_transforms:
+            self.lookup[rawval] = self.alt_transforms[val]
+            return True
+
+        return False
+
+    def miss(self, rawval, default_to_empty):
+        self.misses[rawval] += 1
+
+        if default_to_empty:
+            return ""
+
+        # Eventually, this will become it's own exception which can be handled
+        # nicely at the application layer
+        propname = rawval.strip().upper().replace(" ", "_")
+        sys.stderr.write(f"Unmatched entry, {Fore.RED}{propname}{Fore.RESET}. Viable choices include: {Fore.GREEN}{self.choices}{Fore.RESET}\n")
+        raise UnmatchedConstant(self.constobj, rawval, propname)
+
+    def report(self, writer):
+        for rawval in sorted(self.misses):
+            writer.writerow([self.constobj.__name__, rawval, self.misses[rawval]])
+
+class SubstrRules:
+    """A field's SUBSTR data map rules compiled into a single Aho-Corasick
+    automaton, so a value is scanned once rather than once per rule.
+
+    The rules are applied the same way as always: the first rule (in the
+    order they were loaded) found anywhere in the value wins, and every
+    occurrence of it is replaced. Since every match is visited, including
+    overlapping ones, the automaton just has to keep track of the lowest
+    rule index it has seen."""
+    def __init__(self, rules):
+        self.rules = list(rules.items())
+
+        # state => {character => next state}
+        self.goto = [{}]
+        # state => where to go when the next character doesn't match
+        self.fail = [0]
+        # state => lowest rule index matching at this state (including
+        # those which are suffixes of it), or None
+        self.out = [None]
+
+        for index, (err, replacement) in enumerate(self.rules):
+            state = 0
+            for ch in err:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            if self.out[state] is None:
+                self.out[state] = index
+
+        # Breadth first, so each state's fail state is done before it is
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+                inherited = self.out[self.fail[child]]
+                if inherited is not None and (self.out[child] is None or inherited < self.out[child]):
+                    self.out[child] = inherited
+
+    def first_match(self, val):
+        """Index of the first rule found in val, or None"""
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        # An empty rule (state 0) matches anything
+        best = out[0]
+        state = 0
+        for ch in val:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            found = out[state]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        return best
+
+    def apply(self, val):
+        """Returns the rewritten value, or None if none of the rules apply"""
+        index = self.first_match(val)
+        if index is None:
+            return None
+        err, replacement = self.rules[index]
+        return val.replace(err, replacement).strip()
+
 # 
 # TODO
 # To attempt to reach the deadline, I'm just jamming in anything that doesn't fit
@@ -101,6 +268,21 @@ class Transform:
     _cur_filename = None
     _linenumber = 0
 
+    # constobj => ConstantNormalizer
+    _normalizers = {}
+
+    # fieldname => SubstrRules compiled from _data_transform
+    _substr_rules = {}
+
+    # fieldname => memoized MapValue for that field. CMG columns tend to
+    # have very few distinct values, so most cells are a single lookup. The
+    # memos depend on the maps, so they are dropped whenever those change
+    _memos = {}
+    _memo_size = 1024
+
+    # fieldname => [hits, misses] for memos that have since been dropped
+    _memo_stats = defaultdict(lambda: [0, 0])
+
     def ExtractVar(row, fieldname, constobj=None, default_to_empty=False):
         curval = strip(row.get(fieldname))
 
@@ -129,19 +311,67 @@ class Transform:
         return Transform.CleanVar(constobj, val, default_to_empty)
 
     def GetValue(row, fieldname):
-        val = strip(row.get(fieldname))
-
+        return Transform.MapValue(fieldname, strip(row.get(fieldname)))
+
+    def MapValue(fieldname, val):
+        """Apply the data map/transforms to a value that has already been stripped"""
+        try:
+            memo = Transform._memos[fieldname]
+        except KeyError:
+            memo = lru_cache(maxsize=Transform._memo_size)(partial(Transform.ApplyMaps, fieldname))
+            Transform._memos[fieldname] = memo
+        return memo(val)
+
+    def ApplyMaps(fieldname, val):
+        """MapValue without the memo"""
         if fieldname in Transform._data_map:
             if val in Transform._data_map[fieldname]:
                 return Transform._data_map[fieldname][val]
 
         if fieldname in Transform._data_transform:
-            for err in Transform._data_transform[fieldname].keys():
-                if err in val:
-                    return val.replace(err, Transform._data_transform[fieldname][err]).strip()
+            replaced = Transform.SubstrMatcher(fieldname).apply(val)
+            if replaced is not None:
+                return replaced
 
         return Transform.Value(val)
 
+    def SubstrMatcher(fieldname):
+        """Returns the field's compiled SUBSTR rules, compiling them on first use"""
+        if fieldname not in Transform._substr_rules:
+            Transform._substr_rules[fieldname] = SubstrRules(Transform._data_transform[fieldname])
+        return Transform._substr_rules[fieldname]
+
+    def ClearMemos():
+        """Should be called whenever the maps change"""
+        for fieldname, memo in Transform._memos.items():
+            info = memo.cache_info()
+            Transform._memo_stats[fieldname][0] += info.hits
+            Transform._memo_stats[fieldname][1] += info.misses
+        Transform._memos = {}
+
+    def ResetMemoStats():
+        Transform.ClearMemos()
+        Transform._memo_stats.clear()
+
+    def MemoStats():
+        """fieldname => [hits, misses] so far"""
+        stats = defaultdict(lambda: [0, 0])
+        for fieldname, (hits, misses) in Transform._memo_stats.items():
+            stats[fieldname][0] += hits
+            stats[fieldname][1] += misses
+        for fieldname, memo in Transform._memos.items():
+            info = memo.cache_info()
+            stats[fieldname][0] += info.hits
+            stats[fieldname][1] += info.misses
+        return stats
+
+    def MemoReport(writer):
+        """Write out how often each field's values came from the memo"""
+        stats = Transform.MemoStats()
+        for fieldname in sorted(stats):
+            hits, misses = stats[fieldname]
+            writer.writerow([fieldname, hits, misses, "%.1f%%" % (hits * 100 / (hits + misses)) if hits + misses else "-"])
+
     def Value(val):
         """Since we get some weird stuff that probably means "missing", we'll just strip that out"""
         if val not in Transform._missing:
@@ -149,41 +379,19 @@ class Transform:
         return ""
 
     def CleanVar(constobj, rawval, default_to_empty=False):
-        val = rawval
+        return Transform.Normalizer(constobj).normalize(rawval, default_to_empty)
 
-        if val is None or val.strip() == "":
-            return None
+    def Normalizer(constobj):
+        """Returns the compiled normalizer for the constant class, building it on first use"""
+        if constobj not in Transform._normalizers:
+            Transform._normalizers[constobj] = ConstantNormalizer(constobj, 
+                                                    Transform._alt_transforms.get(constobj, {}))
+        return Transform._normalizers[constobj]
 
-        # For the CMG datasets I've seen, chromosomes are bare numbers/letters
-        # this doesn't make for very useful constant variable names and we 
-        # do want to enforce constants and provide something clear for the
-        # display parameter
-        if constobj == constants.DISCOVERY.VARIANT.CHROMOSOME:
-            if val in Transform._raw_chroms:
-                val = f"Chr{val}"
-
-        # Definitely want to get rid of whitespace
-        if val is not None:
-            propname = val.strip().upper().replace(" ", "_")
-            try:
-                # This is just a way to verify that our data conforms to constants
-                # If it works, then we have our value. We'll take the extracted value
-                # so that case coming in doesn't have to match
-                propname = getattr(constobj, propname)
-                return propname
-            except AttributeError as e:
-                if constobj in Transform._alt_transforms:
-                    if val in Transform._alt_transforms[constobj]:
-                        return Transform._alt_transforms[constobj][val]
-
-                if default_to_empty:
-                    return ""
-                # if this excepts, then we need to figure out what is going wrong
-                # Eventually, this will become it's own exception which can be handled
-                # nicely at the application layer
-                sys.stderr.write(f"Unmatched entry, {Fore.RED}{propname}{Fore.RESET}. Viable choices include: {Fore.GREEN}{', '.join([x for x in dir(constobj) if x[0] != '_']) }{Fore.RESET}\n")
-                raise e         
-        return None
+    def UnmatchedReport(writer):
+        """Write out each value that couldn't be matched to a constant along with how often it was seen"""
+        for constobj in Transform._normalizers:
+            Transform._normalizers[constobj].report(writer)
 
     def CleanSubjectId(var):
         # For now, just strip the character data from the strings
@@ -204,6 +412,7 @@ class Transform:
 
                 for line in reader:
                     Transform._field_map[line['CURRENT']] = line['EXPECTED']
+            Transform.ClearMemos()
 
     def LoadDataMap(filename):
         if filename is not None:
@@ -216,6 +425,12 @@ class Transform:
                     else:
                         Transform._data_map[line['FIELD_NAME']][line['ALTERNATIVE']] = line['EXPECTED']
 
+            # Compile the substitutions now rather than in the middle of a file
+            Transform._substr_rules = {}
+            for fieldname in Transform._data_transform:
+                Transform.SubstrMatcher(fieldname)
+            Transform.ClearMemos()
+
     def CheckForBadIDs(line):
         if Transform._cur_filename in Transform._invalid_ids:
             for col in Transform._invalid_ids[Transform._cur_filename]:
@@ -224,20 +439,23 @@ class Transform:
                                     col, 
                                     line[col])
 
-    def GetReader(csv_file, file_type='', delimiter=','):
+    def GetReader(csv_file, file_type='', delimiter=',', verbose=True):
         if file_type.strip() != "":
             Transform._cur_filename = file_type
 
         reader = csv.DictReader(csv_file, delimiter=delimiter, quotechar='"')
+        reader.fieldnames = Transform.MapFieldnames(reader.fieldnames, csv_file.name, verbose)
+        return reader
 
-        fieldnames = []
-        for colname in reader.fieldnames:
+    def MapFieldnames(fieldnames, filename, verbose=True):
+        mapped = []
+        for colname in fieldnames:
             colname = colname.lower()
             if colname in Transform._field_map:
-                fieldnames.append(Transform._field_map[colname])
-                print(f"Transforming {csv_file.name}:{colname} into {Transform._field_map[colname]}")
+                mapped.append(Transform._field_map[colname])
+                if verbose:
+                    print(f"Transforming {filename}:{colname} into {Transform._field_map[colname]}")
             else:
-                fieldnames.append(colname)
+                mapped.append(colname)
 
-        reader.fieldnames = fieldnames
-        return reader
\ No newline at end of file
+        return mapped
\ No newline at end of file
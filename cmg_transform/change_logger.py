@@ -2,11 +2,64 @@
     Singleton object to permit logging of each value before and after transformation 
 
 """
+import sqlite3
 from pathlib import Path
 from sqlite3 import connect
 from colorama import init,Fore,Back,Style
 init()
 
+def create_summary_tables(cur):
+	"""The summary tables hold what Report.summarize needs for each dataset
+	so that reports don't have to scan the transformations"""
+	cur.execute("""CREATE TABLE IF NOT EXISTS variable_totals(
+						dataset_name VARCHAR,
+						variable_id INTEGER,
+						total INTEGER,
+						transformed INTEGER,
+						PRIMARY KEY (dataset_name, variable_id)
+					) WITHOUT ROWID""")
+	cur.execute("""CREATE TABLE IF NOT EXISTS untransformed_values(
+						dataset_name VARCHAR,
+						variable_id INTEGER,
+						orig_val VARCHAR,
+						lines INTEGER,
+						PRIMARY KEY (dataset_name, variable_id, orig_val)
+					) WITHOUT ROWID""")
+
+def materialize_summary(cur, dataset_name):
+	"""(Re)build the summary rows for dataset_name. The counts are of 
+	distinct lines, so this has to be done once the dataset has been fully 
+	logged, rather than a batch at a time"""
+	cur.execute("DELETE FROM variable_totals WHERE dataset_name=?", (dataset_name,))
+	cur.execute("DELETE FROM untransformed_values WHERE dataset_name=?", (dataset_name,))
+	cur.execute("""INSERT INTO variable_totals
+					SELECT 
+						dataset_name,
+						variable_id, 
+						count(DISTINCT line_number),
+						count(DISTINCT CASE WHEN new_val != '' THEN line_number END)
+					FROM 
+						transformations
+					WHERE 
+						dataset_name=?
+					GROUP BY 
+						variable_id""", (dataset_name,))
+	cur.execute("""INSERT INTO untransformed_values
+					SELECT
+						dataset_name,
+						variable_id, 
+						orig_val,
+						count(DISTINCT line_number)
+					FROM 
+						transformations
+					WHERE 
+						dataset_name=? AND
+						new_val == '' AND
+						orig_val != ''
+					GROUP BY 
+						variable_id,
+						orig_val""", (dataset_name,))
+
 class ChangeLog:
 	_instance = None
 	_dataset_name = None
@@ -14,19 +67,42 @@ class ChangeLog:
 	# By Default, let's not log this stuff
 	_active_log = False
 
-	def __init__(self, file_path):
+	# sqlite or parquet (see parquet_change_log)
+	_backend = "sqlite"
+
+	# Transformations are queued up and written in chunks of this size. Each
+	# flush is committed, so the pending queue never grows beyond this
+	_batch_size = 10000
+
+	def __init__(self, file_path, batch_size=None):
 		self.cur = None
+		self.pending = []
+		self.batch_size = batch_size or ChangeLog._batch_size
+		self.log_dir = file_path
 		if ChangeLog._active_log:
 			self.filename = Path(file_path) / "change-log.db"
 
 			must_init_db = not self.filename.is_file()
-			self.db = connect(self.filename)
+			# Parallel transforms may have more than one process writing at a time
+			self.db = connect(self.filename, timeout=60)
 			self.cur = self.db.cursor()
 
+			# Losing the last few batches to a power cut isn't worth a full
+			# fsync on every commit
+			self.cur.execute("PRAGMA journal_mode=WAL")
+			self.cur.execute("PRAGMA synchronous=NORMAL")
+
 			self.varids = {}
 
 			if must_init_db:
 				self.initdb()
+			else:
+				# Logs from before the names were UNIQUE
+				try:
+					self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS variable_names_by_name ON variable_names(name)")
+				except sqlite3.IntegrityError:
+					print(f"The variable names table in {self.filename} has duplicate names")
+			create_summary_tables(self.cur)
 
 			for (varid, name) in self.cur.execute("SELECT variable_id, name FROM variable_names"):
 				self.varids[name] = varid
@@ -37,7 +113,10 @@ class ChangeLog:
 		if ChangeLog._active_log:
 			# Drop the data from the current dataset
 			print(f"Dropping data from {Fore.GREEN}{ChangeLog._dataset_name}{Fore.RESET}")
-			self.cur.execute(f"DELETE FROM transformations WHERE dataset_name='{ChangeLog._dataset_name}'")
+			self.flush()
+			self.cur.execute("DELETE FROM transformations WHERE dataset_name=?", (ChangeLog._dataset_name,))
+			self.cur.execute("DELETE FROM variable_totals WHERE dataset_name=?", (ChangeLog._dataset_name,))
+			self.cur.execute("DELETE FROM untransformed_values WHERE dataset_name=?", (ChangeLog._dataset_name,))
 			print(f"{Fore.GREEN}Dropped{Fore.RESET}.")
 
 	def initdb(self):
@@ -47,7 +126,8 @@ class ChangeLog:
 			self.cur.execute("""CREATE TABLE variable_names (
 									variable_id INTEGER PRIMARY KEY AUTOINCREMENT,
 									filename VARCHAR,
-									name VARCHAR
+									name VARCHAR,
+									UNIQUE(name)
 								);""")
 
 			self.cur.execute("""CREATE TABLE transformations(
@@ -67,48 +147,85 @@ class ChangeLog:
 		if ChangeLog._active_log:
 
 			if varname not in self.varids:
-				try:
-					self.cur.execute(f"""INSERT INTO 
-											variable_names(filename, name) 
-											VALUES ('{filename}', '{varname}')""")
-					self.varids[varname] = self.cur.lastrowid
-				except:
-					print(f"There was a problem inserting {varname} into the variable names table")
-
-			varid = self.varids[varname]
-
+				# Another process may have added it since we loaded the names. 
+				# This is committed right away rather than with the next batch, 
+				# otherwise the other workers are locked out until then
+				self.cur.execute("INSERT OR IGNORE INTO variable_names(filename, name) VALUES (?, ?)", 
+										(filename, varname))
+				self.db.commit()
+				(self.varids[varname],) = self.cur.execute("SELECT variable_id FROM variable_names WHERE name=?", (varname,)).fetchone()
+
+			newval = vnewval
+			if newval is None:
+				newval = ''
+
+			prev = vprev
+			if prev is None:
+				prev = ''
+
+			self.pending.append((self.varids[varname], 
+								line_number, 
+								ChangeLog._dataset_name, 
+								prev, 
+								newval))
+
+			if len(self.pending) >= self.batch_size:
+				self.flush()
+
+	def add_transformations(self, filename, varname, line_numbers, vprevs, vnewvals):
+		"""Log an entire column's worth of transformations in one go"""
+		if ChangeLog._active_log:
+			for line_number, vprev, vnewval in zip(line_numbers, vprevs, vnewvals):
+				self.add_transformation(filename, varname, line_number, vprev, vnewval)
+
+	def flush(self):
+		"""Write any queued transformations to the database and commit them. If
+		the batch can't be written as a whole, the rows are written one at a 
+		time so that only the bad ones are lost"""
+		if ChangeLog._active_log and len(self.pending) > 0:
+			insert = "INSERT INTO transformations VALUES (?, ?, ?, ?, ?)"
+			self.cur.execute("SAVEPOINT flush")
 			try:
-				newval = vnewval
-				if newval is None:
-					newval = ''
-
-				prev = vprev
-				if prev is None:
-					prev = ''
-				self.cur.execute(f"""INSERT INTO transformations VALUES (
-									{varid}, 
-									{line_number},
-									'{ChangeLog._dataset_name}', 
-									'{prev.replace("'", "''")}', 
-									'{newval.replace("'", "''")}')""")
-			except:
-				print(f"""There was a problem inserting {varid}, 
-									{line_number},
-									'{ChangeLog._dataset_name}', 
-									'{prev}', 
-									'{newval}' into the transformations table""")
+				self.cur.executemany(insert, self.pending)
+			except sqlite3.Error as e:
+				# Whatever made it in before the error would be written twice
+				self.cur.execute("ROLLBACK TO flush")
+				failed = 0
+				for idx, row in enumerate(self.pending):
+					try:
+						self.cur.execute(insert, row)
+					except sqlite3.OperationalError:
+						# Locked or out of space, the rest won't fare any better
+						failed += len(self.pending) - idx
+						break
+					except sqlite3.Error:
+						failed += 1
+				print(f"There was a problem inserting {failed} of {len(self.pending)} rows into the transformations table: {e}")
+			self.cur.execute("RELEASE flush")
+			self.pending = []
+			self.db.commit()
 
 	def commit(self):
 		if ChangeLog._active_log:
+			self.flush()
 			self.db.commit()
 
 	@classmethod
-	def InitDB(cls, file_path, dataset_name, purge_priors=False):
+	def InitDB(cls, file_path, dataset_name, purge_priors=False, batch_size=None):
+
+		# Anything still queued belongs to the previous dataset
+		if cls._instance is not None:
+			cls._instance.flush()
 
 		cls._dataset_name = dataset_name
 
 		if cls._instance is None:
-			cls._instance = cls(file_path)
+			if cls._backend == "parquet" and cls._active_log:
+				# pyarrow is only needed by those who ask for it
+				from cmg_transform.parquet_change_log import ParquetChangeLog
+				cls._instance = ParquetChangeLog(file_path, batch_size)
+			else:
+				cls._instance = cls(file_path, batch_size)
 
 		if cls._active_log:
 			if purge_priors:
@@ -116,6 +233,14 @@ class ChangeLog:
 				
 		return cls._instance.cur
 
+	def summarize(self):
+		"""Bring the current dataset's summary up to date. This should be done
+		once everything for the dataset has been logged"""
+		if ChangeLog._active_log:
+			self.flush()
+			materialize_summary(self.cur, ChangeLog._dataset_name)
+			self.db.commit()
+
 	@classmethod
 	def Close(cls):
 		if cls._active_log:
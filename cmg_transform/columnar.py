@@ -0,0 +1,306 @@
+"""
+Column oriented alternative to building a Patient and Disease object for every
+row of the subject file.
+
+The subject file is loaded into a DataFrame and each of the fields are cleaned
+as a whole column. CMG columns have very low cardinality, so the field/data maps
+and the constant normalization are only ever applied once per distinct value and
+then broadcast back over the column. The rows written are identical to those
+produced by Patient.write_default and Disease.writerow/hpo_writerow.
+"""
+import csv
+import sys
+
+import pandas as pd
+
+from ncpi_fhir_plugin.common import constants, GENDERFICATION
+from cmg_transform import Transform, strip
+from cmg_transform.change_logger import ChangeLog
+import cmg_transform.tools.term_lookup as term_lookup
+
+def read_table(filename, delimiter):
+    """Load a CSV/TSV into a DataFrame of strings using the field map for column names.
+
+    Missing values come back as None, just like they would from a DictReader"""
+    with open(filename, 'rt', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f, delimiter=delimiter, quotechar='"'))
+    fieldnames = Transform.MapFieldnames(header, filename)
+
+    df = pd.read_csv(filename,
+                        sep=delimiter,
+                        quotechar='"',
+                        header=None,
+                        skiprows=1,
+                        names=list(range(len(fieldnames))),
+                        index_col=False,
+                        dtype=str,
+                        keep_default_na=False,
+                        encoding='utf-8-sig')
+    df = df.astype(object).where(df.notna(), None)
+
+    # DictReader lets the last column win when two of them map onto the
+    # same name
+    columns = {}
+    for idx, colname in enumerate(fieldnames):
+        columns[colname] = idx
+    df = df[list(columns.values())]
+    df.columns = list(columns.keys())
+    return df
+
+class SubjectTable:
+    def __init__(self, filename, delimiter, family_lkup, proband_relationships):
+        Transform._cur_filename = 'subject'
+        self.df = read_table(filename, delimiter)
+
+        # Matching the line numbers the row engine would report to the change log
+        self.line_numbers = range(2, len(self.df) + 2)
+
+        self.ids = [Transform.CleanSubjectId(x) for x in self.df['subject_id'].tolist()]
+        self.fam_ids = self.extract('family_id')
+        self.mat_ids = [Transform.CleanSubjectId(x) for x in self.extract('maternal_id')]
+        self.pat_ids = [Transform.CleanSubjectId(x) for x in self.extract('paternal_id')]
+        self.twin_ids = [Transform.CleanSubjectId(x) for x in self.extract('twin_id')]
+        self.project_ids = self.extract('project_id')
+        self.dbgap_study_ids = self.extract('dbgap_study_id')
+        self.dbgap_ids = self.extract('dbgap_subject_id')
+        self.ages_at_last_observation = self.extract('age_at_last_observation')
+
+        try:
+            relationships = self.extract('proband_relationship', constants.RELATIONSHIP, True)
+            self.relationships_raw = self.column('proband_relationship', Transform.MapValue)
+        except:
+            print("No proband present")
+            print(sorted(self.df.columns))
+            sys.exit(1)
+        self.is_proband = [x == constants.RELATIONSHIP.PROBAND for x in relationships]
+
+        self.sex = self.extract('sex', constants.GENDER)
+        self.affected_status = self.extract('affected_status', constants.AFFECTED_STATUS)
+        self.ancestry_details = self.extract('ancestry_detail')
+
+        self.race = []
+        self.eth = []
+        hispanic = "Hispanic or Latino"
+        ancestry = self.extract('ancestry')
+        races = self.clean(ancestry,
+                            'ancestry',
+                            constants.RACE,
+                            skip=lambda x: x == hispanic)
+        for idx, anc in enumerate(ancestry):
+            if anc != hispanic:
+                self.race.append(races[idx])
+                self.eth.append(None)
+            else:
+                self.race.append(constants.COMMON.UNKNOWN)
+                self.eth.append(constants.ETHNICITY.HISPANIC)
+
+                # In case the detail field is missing, we'll stash what we found in the
+                # ancestry field there (untransformed)
+                if self.ancestry_details[idx].strip() == "":
+                    self.ancestry_details[idx] = anc
+
+        # Let's assign gendered family member relationships where it makes sense
+        self.relationships = []
+        for sex, relationship in zip(self.sex, relationships):
+            if sex in GENDERFICATION and relationship in GENDERFICATION[sex]:
+                relationship = GENDERFICATION[sex][relationship]
+            self.relationships.append(relationship)
+
+        # The order matters here, since later rows will clobber earlier ones
+        for idx, id in enumerate(self.ids):
+            for relative in [self.mat_ids[idx], self.pat_ids[idx], self.twin_ids[idx]]:
+                if relative is not None:
+                    proband_relationships[relative] = id
+
+            family_lkup[id] = self.fam_ids[idx]
+            if self.is_proband[idx]:
+                proband_relationships[self.fam_ids[idx]] = id
+
+        self.extract_diseases()
+
+    def column(self, fieldname, func):
+        """Apply func(fieldname, value) once per distinct (stripped) value in the column"""
+        if fieldname not in self.df:
+            return [func(fieldname, None)] * len(self.df)
+
+        codes, uniques = pd.factorize(self.df[fieldname], use_na_sentinel=True)
+        # Missing values (short rows) get the last slot
+        cleaned = [func(fieldname, strip(x)) for x in uniques]
+        if (codes < 0).any():
+            cleaned.append(func(fieldname, None))
+        return [cleaned[code] for code in codes]
+
+    def clean(self, values, fieldname, constobj, default_to_empty=False, skip=None):
+        """Apply the constant normalization to values which were already extracted"""
+        normalizer = Transform.Normalizer(constobj)
+        cleaned = []
+        for val in values:
+            if skip is not None and skip(val):
+                cleaned.append(None)
+            else:
+                cleaned.append(normalizer.normalize(val, default_to_empty))
+
+        self.log(fieldname, cleaned)
+        return cleaned
+
+    def log(self, fieldname, values):
+        if ChangeLog._active_log:
+            original = self.df[fieldname].tolist() if fieldname in self.df else [None] * len(self.df)
+            ChangeLog._instance.add_transformations(Transform._cur_filename,
+                                                    fieldname,
+                                                    self.line_numbers,
+                                                    [strip(x) for x in original],
+                                                    values)
+
+    def extract(self, fieldname, constobj=None, default_to_empty=False):
+        """Column equivalent of Transform.ExtractVar"""
+        values = self.column(fieldname, Transform.MapValue)
+        if constobj is not None:
+            return self.clean(values, fieldname, constobj, default_to_empty)
+
+        self.log(fieldname, values)
+        return values
+
+    def extract_diseases(self):
+        descriptions = self.extract('disease_description')
+        self.disease_descriptions = [x.replace("\n", ' ') for x in descriptions]
+        self.phenotype_descriptions = self.extract('phenotype_description')
+        self.ages_of_onset = self.extract('age_of_onset')
+
+        split_terms = lambda value: list(set([x.strip() for x in value.split("|")]))
+        self.hpo_present = self.memoize(self.extract('hpo_present'), split_terms)
+        self.hpo_absent = self.memoize(self.extract('hpo_absent'), split_terms)
+
+        # disease_id => (valid_ids, name, system, alternate names)
+        details = {}
+        self.disease_ids = []
+        self.disease_names = []
+        self.disease_systems = []
+        self.alternate_disease_names = []
+        for idx, disease_id in enumerate(self.extract('disease_id')):
+            if disease_id not in details:
+                details[disease_id] = SubjectTable.disease_details(disease_id.split("|"))
+            valid_ids, name, system, alternates, broken_id = details[disease_id]
+
+            if broken_id is not None:
+                term_lookup.broken_terms[broken_id] = descriptions[idx]
+                name = self.disease_descriptions[idx]
+            self.disease_ids.append(valid_ids)
+            self.disease_names.append(name)
+            self.disease_systems.append(system)
+            self.alternate_disease_names.append(alternates)
+
+    def memoize(self, values, func):
+        lkup = {}
+        results = []
+        for val in values:
+            if val not in lkup:
+                lkup[val] = func(val)
+            results.append(lkup[val])
+        return results
+
+    @classmethod
+    def disease_details(cls, disease_ids):
+        """Mirrors Disease.get_disease_details for a single distinct disease_id value"""
+        primary_id = None
+        primary_details = None
+        alternate_details = []
+        valid_ids = []
+        for id in disease_ids:
+            details = term_lookup.pull_details(id)
+
+            if details:
+                if primary_id is None:
+                    primary_id = id
+                    primary_details = details
+                else:
+                    alternate_details.append(f"{id} ( {details.name} )")
+                valid_ids.append(id)
+
+        if primary_id is None:
+            return (disease_ids, None, None, "", id)
+        return (valid_ids, primary_details.name, primary_details.system, " | ".join(alternate_details), None)
+
+    def write_subjects(self, study, writer, proband_relationships):
+        rows = []
+        for idx, id in enumerate(self.ids):
+            fam_id = self.fam_ids[idx]
+            proband_id = proband_relationships.get(id)
+            proband_relationship = self.relationships[idx]
+            relationship_raw = self.relationships_raw[idx]
+            if relationship_raw == '':
+                relationship_raw = proband_relationship
+
+            # Go ahead and provide a proband_id for those that we can manage
+            if proband_id is None and fam_id in proband_relationships:
+                proband_id = proband_relationships[fam_id]
+
+            rows.append([
+                study,
+                fam_id,
+                self.mat_ids[idx],
+                self.pat_ids[idx],
+                id,
+                proband_id,
+                self.is_proband[idx],
+                proband_relationship,
+                relationship_raw,
+                self.sex[idx],
+                self.race[idx],
+                self.eth[idx],
+                self.ancestry_details[idx],
+                self.ages_at_last_observation[idx],
+                self.dbgap_study_ids[idx],
+                self.dbgap_ids[idx]
+            ])
+        writer.writerows(rows)
+
+    def write_diseases(self, study_name, writer):
+        rows = []
+        for idx, id in enumerate(self.ids):
+            if len(self.disease_ids[idx]) > 0:
+                rows.append([
+                    self.fam_ids[idx],
+                    id,
+                    study_name,
+                    self.disease_ids[idx][0],
+                    self.disease_descriptions[idx],
+                    self.disease_systems[idx],
+                    self.disease_names[idx],
+                    self.ages_of_onset[idx],
+                    self.affected_status[idx],
+                    self.alternate_disease_names[idx],
+                    self.phenotype_descriptions[idx]
+                ])
+        writer.writerows(rows)
+
+    def hpo_writerows(self, study_name, writer):
+        details = {}
+        rows = []
+        for observed, terms in [(constants.PHENOTYPE.OBSERVED.PRESENT, self.hpo_present),
+                                (constants.PHENOTYPE.OBSERVED.ABSENT, self.hpo_absent)]:
+            self.hpo_rows(study_name, observed, terms, details, rows)
+
+        # The row engine writes present before absent one subject at a time
+        rows.sort(key=lambda x: x[0])
+        writer.writerows([row for (idx, row) in rows])
+
+    def hpo_rows(self, study_name, observed, terms, details, rows):
+        for idx, hpos in enumerate(terms):
+            for hpo in hpos:
+                if hpo is not None and hpo != "" and hpo != "-":
+                    if hpo not in details:
+                        details[hpo] = term_lookup.pull_details(hpo)
+                    if details[hpo] is not None:
+                        rows.append((idx, [
+                            self.fam_ids[idx],
+                            self.ids[idx],
+                            study_name,
+                            hpo,
+                            details[hpo].name,
+                            observed,
+                            "http://purl.obolibrary.org/obo/hp.owl",
+                            hpo
+                        ]))
+                    else:
+                        print(f"Unrecognized HPO Term: {hpo}")
@@ -0,0 +1,281 @@
+"""
+    Row level fingerprints so that a refresh only redoes the work for rows
+    that actually changed since the last run.
+
+    Each input row (subject, sample, sequencing and discovery) is hashed as
+    it's read and compared against what we saw last time to report what's
+    new, changed or gone. The rows whose transforms involve remote lookups
+    (the diseases and phenotypes from the subject file and the discovery
+    variants) also have their output captured, so that an unchanged row can
+    be replayed rather than transformed again. Patients, specimens and
+    sequencing rows depend on each other (families, sample => subject,
+    genome builds), so those are always transformed.
+
+    Once the full outputs are written, write_deltas compares them against
+    what was last loaded and writes a .delta.tsv (new or changed) and a
+    .deleted.tsv (gone) for each of them. The outputs only become the new
+    baseline once 02_cmg_load.py --delta has loaded them (see loaded), so
+    transforming twice in a row doesn't lose the first run's changes.
+
+    A replayed row only brings back what was written. Anything else the
+    original transform did along the way isn't repeated, so the broken terms
+    and unmatched constants reports only cover the rows that were actually
+    transformed.
+"""
+import csv
+import json
+import hashlib
+from pathlib import Path
+from sqlite3 import connect
+from collections import defaultdict
+
+from cmg_transform import Transform
+
+def fingerprint(*values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class RecordingWriter:
+    """Stands in for a csv.writer, keeping track of the rows written"""
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(["" if x is None else str(x) for x in row])
+
+class ReplayedDisease:
+    """Writes the rows a Disease wrote the last time its subject row was seen"""
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def writerow(self, study_name, writer):
+        for row in self.outputs['disease']:
+            writer.writerow(row)
+
+    def hpo_writerow(self, study_name, writer):
+        for row in self.outputs['hpo']:
+            writer.writerow(row)
+
+class ReplayedVariant:
+    """Writes the row (and report IDs) a DiscoveryVariant produced last time"""
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def writerow(self, writer, study_name):
+        for row in self.outputs['variant']:
+            writer.writerow(row)
+        return len(self.outputs['variant']) > 0
+
+    def add_variant_ids(self, variant_lkup):
+        for subject_id, variant_id in self.outputs['variant_ids']:
+            variant_lkup[subject_id].append(variant_id)
+
+class RowDelta:
+    _instance = None
+
+    def __init__(self, output):
+        self.filename = Path(output) / "delta.db"
+
+        # Parallel workers each write their own consent group's rows
+        self.db = connect(self.filename, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS inputs(
+                            consent VARCHAR,
+                            kind VARCHAR,
+                            key VARCHAR,
+                            fingerprint VARCHAR,
+                            replay_key VARCHAR,
+                            PRIMARY KEY (consent, kind, key)
+                        ) WITHOUT ROWID""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS replays(
+                            replay_key VARCHAR PRIMARY KEY,
+                            outputs VARCHAR
+                        ) WITHOUT ROWID""")
+        # emitted is what was last loaded, staged is what the latest
+        # transform wrote
+        for table in ['emitted', 'staged']:
+            self.db.execute(f"""CREATE TABLE IF NOT EXISTS {table}(
+                                filename VARCHAR,
+                                key VARCHAR,
+                                fingerprint VARCHAR,
+                                rows VARCHAR,
+                                PRIMARY KEY (filename, key)
+                            ) WITHOUT ROWID""")
+        self.db.commit()
+
+        self.consent = None
+        self.context = None
+        self.previous = {}
+        self.current = {}
+        self.replayed = 0
+
+        # replay_key => outputs, waiting to be written at the end of the 
+        # consent group. Writing them as we go would hold the database's 
+        # lock (and keep the other workers out) for the whole group
+        self.stored = {}
+
+    @classmethod
+    def InitDB(cls, output):
+        cls._instance = RowDelta(output)
+        return cls._instance
+
+    @classmethod
+    def Close(cls):
+        if cls._instance:
+            cls._instance.db.commit()
+            cls._instance.db.close()
+            cls._instance = None
+
+    def context_fingerprint(self, study_name):
+        """Anything other than the row itself that changes what a row turns
+        into: the maps and the reference data used for the lookups"""
+        # Lazy imports, so that the delta doesn't force the lookups to load
+        from cmg_transform.tools import term_lookup
+        from cmg_transform.tools.genenames import Gene
+
+        sources = [index.source for index in term_lookup.ontology_indexes()] + [Gene.local.source]
+        mtimes = {str(source): source.stat().st_mtime for source in sources if source.is_file()}
+        return fingerprint(study_name,
+                            Transform._field_map,
+                            Transform._data_map,
+                            Transform._data_transform,
+                            {file_type: {col: sorted(ids) for col, ids in cols.items()} for file_type, cols in Transform._invalid_ids.items()},
+                            mtimes)
+
+    def begin(self, study_name, consent):
+        """Should be called once the consent group's maps have been loaded"""
+        self.consent = consent
+        self.context = self.context_fingerprint(study_name)
+        self.previous = defaultdict(dict)
+        for kind, key, row_fp in self.db.execute("SELECT kind, key, fingerprint FROM inputs WHERE consent=?", (consent,)):
+            self.previous[kind][key] = row_fp
+        self.current = defaultdict(dict)
+
+    def observe(self, kind, key, row, *depends_on):
+        """Record an input row. Returns the key used to replay its output,
+        which covers the row, the context and anything else it depends on"""
+        row_fp = fingerprint(row)
+        if key is None:
+            # Rows without a natural key (discovery) are identified by their content
+            key = row_fp
+        base = key
+        occurrence = 1
+        while key in self.current[kind]:
+            occurrence += 1
+            key = f"{base}#{occurrence}"
+
+        replay_key = fingerprint(self.context, kind, row_fp, depends_on)
+        self.current[kind][key] = (row_fp, replay_key)
+        return replay_key
+
+    def replay(self, replay_key):
+        if replay_key in self.stored:
+            self.replayed += 1
+            return self.stored[replay_key]
+        row = self.db.execute("SELECT outputs FROM replays WHERE replay_key=?", (replay_key,)).fetchone()
+        if row is None:
+            return None
+        self.replayed += 1
+        return json.loads(row[0])
+
+    def store(self, replay_key, outputs):
+        self.stored[replay_key] = outputs
+
+    def end(self):
+        """Report what changed in the consent group and save its fingerprints"""
+        for kind in sorted(set(self.previous.keys()) | set(self.current.keys())):
+            previous = self.previous[kind]
+            current = self.current[kind]
+            new = len([key for key in current if key not in previous])
+            changed = len([key for key in current if key in previous and previous[key] != current[key][0]])
+            deleted = len([key for key in previous if key not in current])
+            print(f"{self.consent} {kind}: {new} new, {changed} changed, {deleted} deleted, {len(current) - new - changed} unchanged")
+
+        self.db.executemany("INSERT OR REPLACE INTO replays VALUES (?, ?)",
+                            [(replay_key, json.dumps(outputs)) for replay_key, outputs in self.stored.items()])
+        self.stored = {}
+        self.db.execute("DELETE FROM inputs WHERE consent=?", (self.consent,))
+        self.db.executemany("INSERT INTO inputs VALUES (?, ?, ?, ?, ?)",
+                            [(self.consent, kind, key, row_fp, replay_key)
+                                for kind in self.current
+                                    for key, (row_fp, replay_key) in self.current[kind].items()])
+        self.db.commit()
+
+    def prune(self, consents):
+        """Drop anything left over from consent groups and rows that are gone"""
+        self.db.execute(f"DELETE FROM inputs WHERE consent NOT IN ({', '.join(['?'] * len(consents))})", list(consents))
+        self.db.execute("DELETE FROM replays WHERE replay_key NOT IN (SELECT replay_key FROM inputs)")
+        self.db.commit()
+
+    def write_deltas(self, output, delta_keys):
+        """delta_keys maps each output file to the columns that identify a
+        group of rows which must be loaded together (since the loader
+        aggregates them). None means each row stands on its own"""
+        output = Path(output)
+        for filename, key_columns in delta_keys.items():
+            with open(output / filename, 'rt', newline='') as f:
+                reader = csv.reader(f, delimiter='\t', quotechar='"')
+                header = next(reader)
+                indexes = [header.index(col) for col in key_columns] if key_columns else None
+
+                groups = defaultdict(list)
+                for row in reader:
+                    key = json.dumps([row[i] for i in indexes] if indexes else row)
+                    groups[key].append(row)
+
+            previous = {}
+            for key, group_fp, rows in self.db.execute("SELECT key, fingerprint, rows FROM emitted WHERE filename=?", (filename,)):
+                previous[key] = (group_fp, rows)
+
+            stem = filename.rsplit(".", 1)[0]
+            changed = 0
+            with open(output / f"{stem}.delta.tsv", 'wt', newline='') as f:
+                writer = csv.writer(f, delimiter='\t', quotechar='"')
+                writer.writerow(header)
+                for key, rows in groups.items():
+                    if key not in previous or previous[key][0] != fingerprint(rows):
+                        changed += 1
+                        writer.writerows(rows)
+
+            deleted = 0
+            with open(output / f"{stem}.deleted.tsv", 'wt', newline='') as f:
+                writer = csv.writer(f, delimiter='\t', quotechar='"')
+                writer.writerow(header)
+                for key, (group_fp, rows) in previous.items():
+                    if key not in groups:
+                        deleted += 1
+                        writer.writerows(json.loads(rows))
+
+            self.db.execute("DELETE FROM staged WHERE filename=?", (filename,))
+            self.db.executemany("INSERT INTO staged VALUES (?, ?, ?, ?)",
+                                [(filename, key, fingerprint(rows), json.dumps(rows)) for key, rows in groups.items()])
+            self.db.commit()
+            print(f"{filename}: {changed} new or changed, {deleted} deleted")
+
+    def loaded(self):
+        """The deltas have made it to the server, so the next ones should be
+        relative to what the last transform wrote"""
+        filenames = [filename for (filename,) in self.db.execute("SELECT DISTINCT filename FROM staged")]
+        for filename in filenames:
+            self.db.execute("DELETE FROM emitted WHERE filename=?", (filename,))
+            self.db.execute("INSERT INTO emitted SELECT * FROM staged WHERE filename=?", (filename,))
+        self.db.execute("DELETE FROM staged")
+        self.db.commit()
+        return filenames
+
+def record_disease(disease, study_name):
+    """Returns what the disease writes to disease.tsv and hpo.tsv"""
+    disease_rows = RecordingWriter()
+    hpo_rows = RecordingWriter()
+    disease.writerow(study_name, disease_rows)
+    disease.hpo_writerow(study_name, hpo_rows)
+    return {'disease': disease_rows.rows, 'hpo': hpo_rows.rows}
+
+def record_variant(variant, study_name):
+    """Returns the discovery_variant.tsv row and report IDs for the variant"""
+    variant_rows = RecordingWriter()
+    variant_ids = defaultdict(list)
+    if variant.writerow(variant_rows, study_name):
+        variant.add_variant_ids(variant_ids)
+    return {'variant': variant_rows.rows, 
+            'variant_ids': [[subject_id, variant_id] for subject_id in variant_ids for variant_id in variant_ids[subject_id]]}
@@ -13,7 +13,9 @@ class DiscoveryVariant:
         'GRCh38DH': 'GRCh38',
         'GRCh37': 'GRCh37'
     }
-    def __init__(self, row):
+    def __init__(self, row, annotate=True):
+        """annotate=False leaves the gene code and self.variant to be filled
+        in later (resolve_gene and annotate_variants) for the whole file at once"""
         self.id = Transform.CleanSubjectId(row['subject_id']) # Transform.CleanSubjectId(row['subject_id'])
         self.sample_id = row['sample_id']
         self.gene = Transform.ExtractVar(row, 'gene')
@@ -53,13 +55,8 @@ class DiscoveryVariant:
             self.variant_id = f"{self.chrom}|{self.pos}|{self.ref}|{self.alt}"
 
 
-        if self.gene:
-            try:
-                gene = Gene.get_gene(self.gene)
-                if gene:
-                    self.gene_code = gene.id
-            except:
-                print(f"There was an issue pulling variant details data down for, {self.gene}")
+        if annotate:
+            self.resolve_gene()
 
         # if we do get a variant, the ID can be used to construct a URL for clinvar entry, which 
         # may be quite informative
@@ -67,11 +64,21 @@ class DiscoveryVariant:
             print(f"Get Variant returned nothing: {self.hgvsc} : {self.hgvsp} : {self.transcript}")
             sys.exit(1)
 
-        if self.hgvsc is not None and self.transcript is not None:
+        self.variant = None
+        if annotate and self.hgvsc is not None and self.transcript is not None:
             self.variant = get_variant(self.hgvsc, self.transcript)
 
         self.inheritance = Transform.ExtractVar(row, 'inheritance_description')
 
+    def resolve_gene(self):
+        if self.gene:
+            try:
+                gene = Gene.get_gene(self.gene)
+                if gene:
+                    self.gene_code = gene.id
+            except:
+                print(f"There was an issue pulling variant details data down for, {self.gene}")
+
     def add_variant_ids(self, variant_lkup):
         if self.variant_id is not None:
             variant_lkup[self.id].append(f"{self.variant_id}+{self.sample_id}")
@@ -0,0 +1,184 @@
+"""
+    Parquet alternative to the sqlite change log.
+
+    The sqlite log stores every cell's before and after values as text, even
+    though the same handful of values ("Unknown" => "", etc) make up nearly
+    all of them. Here, each flush becomes a row group in a Parquet file under
+
+        <log dir>/change-log/dataset_name=<dataset>/filename=<file type>/
+
+    with the variable and values dictionary encoded, so a cell costs a few
+    bits rather than a row of text. Each process writes its own part files,
+    so the parallel transforms don't have to coordinate (which is also why
+    the dictionaries are Parquet's own, per column chunk, rather than one
+    global one).
+
+    A part file can only be read once it's closed, which happens whenever
+    the log is committed (and at Close).
+
+    ParquetReport answers the same questions as transformed.Report, using
+    pyarrow's compute functions over the whole dataset at once.
+"""
+import os
+import shutil
+from collections import defaultdict
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+from colorama import init,Fore,Back,Style
+init()
+
+from cmg_transform.change_logger import ChangeLog
+from cmg_transform.transformed import Report
+
+schema = pa.schema([
+	("name", pa.dictionary(pa.int32(), pa.string())),
+	("line_number", pa.int32()),
+	("orig_val", pa.dictionary(pa.int32(), pa.string())),
+	("new_val", pa.dictionary(pa.int32(), pa.string()))
+])
+
+def log_root(log_dir):
+	return Path(log_dir) / "change-log"
+
+class ParquetChangeLog:
+	def __init__(self, file_path, batch_size=None):
+		# The sqlite log hands this out to the reports, we don't have one
+		self.cur = None
+		self.batch_size = batch_size or ChangeLog._batch_size
+		self.log_dir = file_path
+		self.root = log_root(file_path)
+
+		# filename => column => values waiting to be written
+		self.pending = defaultdict(lambda: defaultdict(list))
+		self.pending_count = 0
+
+		# (dataset_name, filename) => open ParquetWriter
+		self.writers = {}
+		self.parts = 0
+
+	def purge_priors(self):
+		if ChangeLog._active_log:
+			print(f"Dropping data from {Fore.GREEN}{ChangeLog._dataset_name}{Fore.RESET}")
+			self.flush()
+			self.close_writers()
+			shutil.rmtree(self.root / f"dataset_name={ChangeLog._dataset_name}", ignore_errors=True)
+			print(f"{Fore.GREEN}Dropped{Fore.RESET}.")
+
+	def add_transformation(self, filename, varname, line_number, vprev, vnewval):
+		if ChangeLog._active_log:
+			pending = self.pending[filename]
+			pending['name'].append(varname)
+			pending['line_number'].append(line_number)
+			pending['orig_val'].append('' if vprev is None else vprev)
+			pending['new_val'].append('' if vnewval is None else vnewval)
+			self.pending_count += 1
+
+			if self.pending_count >= self.batch_size:
+				self.flush()
+
+	def add_transformations(self, filename, varname, line_numbers, vprevs, vnewvals):
+		"""Log an entire column's worth of transformations in one go"""
+		if ChangeLog._active_log:
+			pending = self.pending[filename]
+			count = len(line_numbers)
+			pending['name'].extend([varname] * count)
+			pending['line_number'].extend(line_numbers)
+			pending['orig_val'].extend(['' if x is None else x for x in vprevs])
+			pending['new_val'].extend(['' if x is None else x for x in vnewvals])
+			self.pending_count += count
+
+			if self.pending_count >= self.batch_size:
+				self.flush()
+
+	def writer(self, filename):
+		key = (ChangeLog._dataset_name, filename)
+		if key not in self.writers:
+			directory = self.root / f"dataset_name={ChangeLog._dataset_name}" / f"filename={filename}"
+			directory.mkdir(parents=True, exist_ok=True)
+			self.parts += 1
+			self.writers[key] = pq.ParquetWriter(directory / f"part-{os.getpid()}-{self.parts:05}.parquet",
+												schema,
+												compression='zstd')
+		return self.writers[key]
+
+	def flush(self):
+		"""Write a row group for each file with anything queued"""
+		if ChangeLog._active_log and self.pending_count > 0:
+			for filename, columns in self.pending.items():
+				table = pa.table({
+					"name": pa.array(columns['name'], pa.string()).dictionary_encode(),
+					"line_number": pa.array(columns['line_number'], pa.int32()),
+					"orig_val": pa.array(columns['orig_val'], pa.string()).dictionary_encode(),
+					"new_val": pa.array(columns['new_val'], pa.string()).dictionary_encode()
+				}, schema=schema)
+				self.writer(filename).write_table(table)
+			self.pending = defaultdict(lambda: defaultdict(list))
+			self.pending_count = 0
+
+	def close_writers(self):
+		for writer in self.writers.values():
+			writer.close()
+		self.writers = {}
+
+	def commit(self):
+		"""Close the part files so that they can be read"""
+		if ChangeLog._active_log:
+			self.flush()
+			self.close_writers()
+
+	def summarize(self):
+		"""Nothing to materialize, the reports are fast enough without"""
+		self.commit()
+
+class ParquetReport(Report):
+	def __init__(self, log_dir, report_vars=None):
+		self.cur = None
+		self.root = log_root(log_dir)
+		self.load_variables(report_vars)
+
+	def dataset(self):
+		return pads.dataset(self.root, format="parquet", partitioning="hive")
+
+	def variable_names(self):
+		"""Variables are numbered in (filename, name) order. Like the sqlite
+		log, a variable found in more than one file is only counted once,
+		under the first of them"""
+		if not self.root.is_dir():
+			return []
+		names = self.dataset().to_table(columns=["filename", "name"]).unify_dictionaries()
+		names = names.group_by(["name", "filename"]).aggregate([]).to_pydict()
+		files = defaultdict(list)
+		for name, filename in zip(names["name"], names["filename"]):
+			files[name].append(str(filename))
+		variables = sorted((min(filenames), name) for name, filenames in files.items())
+		return [(varid + 1, filename, name) for varid, (filename, name) in enumerate(variables)]
+
+	def dataset_table(self, dataset_name):
+		# Each row group has its own dictionaries, which have to agree before
+		# they can be grouped on
+		return self.dataset().to_table(columns=["name", "line_number", "orig_val", "new_val"],
+										filter=pc.field("dataset_name") == dataset_name).unify_dictionaries()
+
+	def totals(self, dataset_name):
+		table = self.dataset_table(dataset_name)
+		totals = table.group_by("name").aggregate([("line_number", "count_distinct")]).to_pydict()
+		transformed = table.filter(pc.not_equal(table["new_val"].cast(pa.string()), ""))
+		transformed = transformed.group_by("name").aggregate([("line_number", "count_distinct")]).to_pydict()
+		transformed = dict(zip(transformed["name"], transformed["line_number_count_distinct"]))
+
+		for name, total in zip(totals["name"], totals["line_number_count_distinct"]):
+			if name in self.vars_by_name:
+				yield (self.vars_by_name[name].id, total, transformed.get(name, 0))
+
+	def untransformed(self, dataset_name):
+		table = self.dataset_table(dataset_name)
+		mask = pc.and_(pc.equal(table["new_val"].cast(pa.string()), ""),
+						pc.not_equal(table["orig_val"].cast(pa.string()), ""))
+		missed = table.filter(mask).group_by(["name", "orig_val"]).aggregate([("line_number", "count_distinct")]).to_pydict()
+		for name, val, lines in zip(missed["name"], missed["orig_val"], missed["line_number_count_distinct"]):
+			if name in self.vars_by_name:
+				yield (self.vars_by_name[name].id, val, lines)
@@ -6,7 +6,31 @@ from cmg_transform.tools.term_lookup import pull_details, write_cache
 import sys
 
 class Patient:
-    def __init__(self, row, family_lkup, proband_relationships):
+    @classmethod
+    def index(cls, row, family_lkup, proband_relationships):
+        """Records the row's family and proband relationships without building
+        the Patient itself. This is the same bookkeeping that __init__ does,
+        but nothing is logged, so the whole subject file can be indexed before
+        any of the patients are written"""
+        id = Transform.CleanSubjectId(row['subject_id'])
+        fam_id = Transform.GetValue(row, 'family_id')
+
+        for fieldname in ['maternal_id', 'paternal_id', 'twin_id']:
+            relative = Transform.CleanSubjectId(Transform.GetValue(row, fieldname))
+            if relative is not None:
+                proband_relationships[relative] = id
+
+        family_lkup[id] = fam_id
+
+        relationships = Transform.Normalizer(constants.RELATIONSHIP)
+        relationship = Transform.GetValue(row, 'proband_relationship')
+        if relationships.resolve(relationship) and relationships.lookup[relationship] == constants.RELATIONSHIP.PROBAND:
+            proband_relationships[fam_id] = id
+
+    def __init__(self, row, family_lkup, proband_relationships=None):
+        """If the subject file has already been indexed, there is no need to
+        pass proband_relationships (and doing so would put the relationships
+        back the way they were at this row rather than at the end of the file)"""
         self.id = Transform.CleanSubjectId(row['subject_id'])  # Transform.CleanSubjectId(row['subject_id'])
         self.project_id = Transform.ExtractVar(row, 'project_id')
         self.fam_id = Transform.ExtractVar(row, 'family_id')
@@ -18,14 +42,15 @@ class Patient:
         self.age_at_last_observation = Transform.ExtractVar(row, 'age_at_last_observation')
         self.is_proband = False
 
-        if self.mat_id is not None:
-            proband_relationships[self.mat_id] = self.id
+        if proband_relationships is not None:
+            if self.mat_id is not None:
+                proband_relationships[self.mat_id] = self.id
 
-        if self.pat_id is not None:
-            proband_relationships[self.pat_id] = self.id
+            if self.pat_id is not None:
+                proband_relationships[self.pat_id] = self.id
 
-        if self.twin_id is not None:
-            proband_relationships[self.twin_id] = self.id
+            if self.twin_id is not None:
+                proband_relationships[self.twin_id] = self.id
 
         try:
             # I'm hopeful that everything should be in constantsANTS.RELATIONSHIP
@@ -61,7 +86,7 @@ class Patient:
 
         # Go ahead and annotate the proband for the family. This will only work if the family_id for the 
         # member matches the proband's ID...but...such is the way of the world
-        if self.is_proband:
+        if self.is_proband and proband_relationships is not None:
             proband_relationships[self.fam_id] = self.id
 
         # Let's assign gendered family member relationships where it makes sense
@@ -16,16 +16,10 @@ class Sequencing:
     genome_builds = {}      # sample_id => reference sequence
 
     def __init__(self, row, seq_centers, subj_id):
-        self.sample_id = row.get('sample_id')
-
-        # a few of Broad's sequence entries don't have sample information associated with the
-        # sequence output...so, we have to extract it from the filename
+        self.sample_id = Sequencing.key_for(row, Transform.ExtractVar)
         if self.sample_id is None:
-            if 'cram_or_bam_path' in row:
-                self.sample_id =  Transform.ExtractVar(row, 'cram_or_bam_path').split("/")[-1].split(".")[0]
-            else:
-                print("No sample IDs nor cram_or_bam_path")
-                sys.exit(1)
+            print("No sample IDs nor cram_or_bam_path")
+            sys.exit(1)
 
         self.subject_id = Transform.CleanSubjectId(Transform.ExtractVar(row, 'subject_id')) 
         if self.subject_id is None:
@@ -87,6 +81,17 @@ class Sequencing:
         if self.reference_genome_build is not None:
             Sequencing.genome_builds[self.sample_id] = self.reference_genome_build
 
+    @classmethod
+    def key_for(cls, row, extract=Transform.GetValue):
+        """The sample ID a sequencing row belongs to, or None if there isn't one"""
+        sample_id = row.get('sample_id')
+
+        # a few of Broad's sequence entries don't have sample information associated with the
+        # sequence output...so, we have to extract it from the filename
+        if sample_id is None and 'cram_or_bam_path' in row:
+            sample_id = extract(row, 'cram_or_bam_path').split("/")[-1].split(".")[0]
+        return sample_id
+
     @classmethod
     def write_header(cls, writer):
         writer.writerow([
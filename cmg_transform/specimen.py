@@ -15,7 +15,7 @@ class Specimen:
     def __init__(self, row, consent_name, family_lkup, subid_lkup):
         self.id = Transform.CleanSubjectId(row['subject_id']) #Transform.CleanSubjectId(row['subject_id'])
         self.fam_id = family_lkup[self.id]
-        self.sample_id = Transform.ExtractVar(row, 'sample_id')
+        self.sample_id = Specimen.key_for(row, Transform.ExtractVar)
         self.dbgap_sample_id = Transform.ExtractVar(row, 'dbgap_sample_id')
         self.sample_source = Transform.ExtractVar(row, 'sample_source').strip()
         self.consent_name = consent_name
@@ -41,6 +41,19 @@ class Specimen:
         subid_lkup[self.sample_id] = self.id
         Specimen.observed.add(self.sample_id)
 
+    @classmethod
+    def key_for(cls, row, extract=Transform.GetValue):
+        """The sample ID a row is recorded under in observed"""
+        return extract(row, 'sample_id')
+
+    @classmethod
+    def is_duplicate(cls, row, observed=None):
+        """Has the row's sample already been seen? This checks the sample ID 
+        as it appears in the file"""
+        if observed is None:
+            observed = cls.observed
+        return row['sample_id'] in observed
+
     @classmethod
     def write_default_header(cls, writer):
         writer.writerow([
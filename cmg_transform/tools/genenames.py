@@ -1,19 +1,97 @@
 #!/usr/bin/env python
 
-"""Pull the details about a gene symbol from genenames.org """
+"""Pull the details about a gene symbol from a local copy of HGNC's complete 
+set, falling back to genenames.org for anything it doesn't know about"""
 
 import requests
 import collections
 import re
+import json
+from csv import DictReader
+from pathlib import Path
 
 import pprint
 import sys
 
 from time import sleep
 
+from cmg_transform.tools.ontology_index import OntologyIndex
+
 url = "http://rest.genenames.org/fetch/symbol"
 alt_url = "http://rest.genenames.org/search"
 
+class HgncIndex(OntologyIndex):
+    """Indexed symbol => gene lookups against hgnc_complete_set.tsv"""
+
+    # When a symbol matches more than one way, the lowest wins
+    precedence = {
+        'symbol': 0,
+        'alias_symbol': 1,
+        'prev_symbol': 2
+    }
+
+    # These are pipe separated in the TSV, but lists coming from the API
+    list_fields = ['alias_symbol', 'alias_name', 'prev_symbol', 'prev_name', 'gene_group', 'gene_group_id', 
+                    'omim_id', 'pubmed_id', 'refseq_accession', 'ccds_id', 'ena', 'mgd_id', 'rgd_id']
+
+    def __init__(self, source):
+        super().__init__(source, format='hgnc')
+
+    def populate(self, db):
+        db.execute("CREATE TABLE genes(hgnc_id VARCHAR PRIMARY KEY, record VARCHAR) WITHOUT ROWID")
+        db.execute("CREATE TABLE symbols(symbol VARCHAR, kind INTEGER, hgnc_id VARCHAR)")
+
+        symbols = []
+        with open(self.source, 'rt') as f:
+            reader = DictReader(f, delimiter='\t', quotechar='"')
+
+            for line in reader:
+                hgncid = line['hgnc_id']
+                record = {}
+                for field, value in line.items():
+                    if field in HgncIndex.list_fields:
+                        record[field] = [x for x in value.split("|") if x != ""] if value else []
+                    else:
+                        record[field] = value
+                db.execute("INSERT OR REPLACE INTO genes VALUES (?, ?)", (hgncid, json.dumps(record)))
+
+                for field, kind in HgncIndex.precedence.items():
+                    values = record[field] if field in HgncIndex.list_fields else [record[field]]
+                    for symbol in values:
+                        if symbol:
+                            symbols.append((symbol, kind, hgncid))
+        db.executemany("INSERT INTO symbols VALUES (?, ?, ?)", symbols)
+        db.execute("CREATE INDEX symbols_by_symbol ON symbols(symbol, kind)")
+
+    def lookup(self, symbol):
+        """Returns the gene records for the best match(es) for symbol"""
+        db = self.connect()
+        if db is None:
+            return []
+
+        rows = db.execute("SELECT kind, hgnc_id FROM symbols WHERE symbol=? ORDER BY kind", (symbol,)).fetchall()
+        if len(rows) == 0:
+            return []
+
+        best = rows[0][0]
+        ids = sorted(set([hgncid for (kind, hgncid) in rows if kind == best]))
+        return [json.loads(db.execute("SELECT record FROM genes WHERE hgnc_id=?", (hgncid,)).fetchone()[0]) for hgncid in ids]
+
+    def __getitem__(self, symbol):
+        genes = self.lookup(symbol)
+        if len(genes) != 1:
+            raise KeyError(symbol)
+        return genes[0]['hgnc_id']
+
+    def __len__(self):
+        db = self.connect()
+        if db is None:
+            return 0
+        return db.execute("SELECT count(*) FROM genes").fetchone()[0]
+
+    def details(self, symbol):
+        return self.lookup(symbol)
+
 class Gene:
     cache = {}
     def __init__(self, data_chunk):
@@ -45,27 +123,64 @@ class Gene:
     @classmethod
     def get_gene(cls, symbol):
         if symbol not in Gene.cache:
-            query = f"{url}/{symbol}"
-            response = requests.get(query, headers={"content-type":"JSON", "accept":"application/json"})
+            gene = Gene.local_gene(symbol)
+            if gene is None:
+                gene = Gene.remote_gene(symbol)
+            # Misses are cached, too, so that we only ask once
+            Gene.cache[symbol] = gene
+        return Gene.cache[symbol]
+
+    @classmethod
+    def resolve(cls, symbols):
+        """Resolve each of the distinct symbols up front, locally where we can, 
+        so that only the true misses end up going to genenames.org"""
+        misses = []
+        for symbol in sorted(set([x for x in symbols if x])):
+            if symbol not in Gene.cache:
+                gene = Gene.local_gene(symbol)
+                if gene is None:
+                    misses.append(symbol)
+                else:
+                    Gene.cache[symbol] = gene
+
+        if len(misses) > 0:
+            print(f"{len(misses)} gene symbols could not be resolved using {Gene.local.source.name}. Querying genenames.org")
+        for symbol in misses:
+            try:
+                Gene.cache[symbol] = Gene.remote_gene(symbol)
+            except:
+                # We'll let the caller deal with it when they ask for it again
+                print(f"There was an issue pulling gene details down for, {symbol}")
+
+    @classmethod
+    def local_gene(cls, symbol):
+        genes = Gene.local.lookup(symbol)
+        if len(genes) == 1:
+            return Gene(genes[0])
+        if len(genes) > 1:
+            print(f"{symbol} matches more than one gene locally: {', '.join([x['symbol'] for x in genes])}")
+        return None
 
-            sleep(0.3)
-            if response:
-                result = response.json()
-                if result:
-                    genes = []
+    @classmethod
+    def remote_gene(cls, symbol):
+        query = f"{url}/{symbol}"
+        response = requests.get(query, headers={"content-type":"JSON", "accept":"application/json"})
 
-                    for doc in result['response']['docs']:
-                        genes.append(Gene(doc))
-                    
-                    if len(genes) > 1:
-                        print(f"Unexpectedly encountered more than one gene and not sure how to proceed: {genes}")
-                        sys.exit(1)
+        sleep(0.3)
+        if response:
+            result = response.json()
+            if result:
+                genes = []
 
-                    if len(genes) > 0:
-                        Gene.cache[symbol] = genes[0]
+                for doc in result['response']['docs']:
+                    genes.append(Gene(doc))
+                
+                if len(genes) > 1:
+                    print(f"Unexpectedly encountered more than one gene and not sure how to proceed: {genes}")
+                    sys.exit(1)
 
-        if symbol in Gene.cache:
-            return Gene.cache[symbol]
+                if len(genes) > 0:
+                    return genes[0]
 
         # Let's consider that it may be an alias
         query = f"{alt_url}/{symbol}"
@@ -77,11 +192,14 @@ class Gene:
             for alt in result['response']['docs']:
                 gene = Gene.get_gene(alt['symbol'])
                 if gene:
-                    Gene.cache[symbol] = gene
                     return gene
-                     
-        sys.exit(1)
+
+        print(f"Unable to find a gene for the symbol, {symbol}")
+        return None
+
+Gene.local = HgncIndex(Path(__file__).resolve().parent / "hgnc_complete_set.tsv")
 
 
 if __name__=="__main__":
     gene = Gene.get_gene(sys.argv[1])
+    print(gene)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""Compiles the ontology files (OBO and OMIM's mimTitles.txt) into small sqlite
+indexes so that we don't have to parse the full files (and build networkx graphs)
+every time we want to look up a name.
+
+The index is written next to the source file and is rebuilt automatically
+whenever the source's mtime changes and its contents no longer match what
+was indexed."""
+
+import os
+import re
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+
+# This is the same pattern obonet uses, so names should match what we got
+# from the graphs
+tag_line_pattern = re.compile(
+    r"""^
+    (?P<tag>.+?):\s*
+    (?P<value>.*?)
+    (?:\s(?P<trailing_modifier>(?<!\\)\{[^{}]*\}))?
+    (?:\s(?P<comment>(?<!\\)![^\n]*))?
+    \s*$
+    """,
+    re.VERBOSE,
+)
+
+# Bump this if the layout of the index changes so that old ones get rebuilt
+INDEX_VERSION = "1"
+
+def file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def parse_obo(filename):
+    """Yields a dict with id, name, obsolete, alt_id and parents for each [Term] stanza"""
+    term = None
+    with open(filename, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line[0] == "!":
+                continue
+
+            if line[0] == "[":
+                if term is not None:
+                    yield term
+                term = None
+                if line == "[Term]":
+                    term = {'alt_id': [], 'parents': [], 'obsolete': False}
+                continue
+
+            if term is None:
+                continue
+
+            match = tag_line_pattern.match(line)
+            if match is None:
+                continue
+            tag = match.group('tag')
+            value = match.group('value')
+
+            if tag in ('id', 'name'):
+                term[tag] = value
+            elif tag == 'alt_id':
+                term['alt_id'].append(value)
+            elif tag == 'is_obsolete':
+                term['obsolete'] = value == 'true'
+            elif tag == 'is_a':
+                term['parents'].append(value)
+            elif tag == 'relationship':
+                # typedef target
+                parts = value.split()
+                if len(parts) > 1:
+                    term['parents'].append(parts[1])
+        if term is not None:
+            yield term
+
+def parse_omim(filename):
+    """mimTitles.txt is a simple tab delimited file where # lines are comments"""
+    with open(filename, 'rt') as f:
+        for line in f:
+            if line[0] != "#":
+                line = line.strip().split("\t")
+                yield {'id': str(int(line[1])), 'name': line[2], 'alt_id': [], 'parents': [], 'obsolete': False}
+
+class OntologyIndex:
+    """Read only, dict-like access to code => name for a single ontology source
+
+    format is either 'obo' or 'omim'. When include_alt_ids is true, alternate
+    IDs will resolve to the name of their primary term (unless the alternate
+    is also a primary term itself)."""
+    def __init__(self, source, format='obo', ignore_obsolete=True, include_alt_ids=False):
+        self.source = Path(source)
+        self.filename = self.source.parent / f"{self.source.name}.index.db"
+        self.format = format
+        self.ignore_obsolete = ignore_obsolete
+        self.include_alt_ids = include_alt_ids
+        self.db = None
+        self.lock = threading.Lock()
+
+        # Whatever we've already pulled from the db
+        self.cache = {}
+
+    def options(self):
+        return f"{INDEX_VERSION}:{self.format}:{self.ignore_obsolete}:{self.include_alt_ids}"
+
+    def is_available(self):
+        return self.source.is_file() or self.filename.is_file()
+
+    def connect(self):
+        """Returns the connection to the index (or None if there is nothing to index)"""
+        if self.db is None:
+            # The index may be warming up in the background
+            with self.lock:
+                if self.db is None:
+                    if self.source.is_file():
+                        self.refresh()
+                    if not self.filename.is_file():
+                        return None
+                    # Shared across threads, but nobody ever writes to it
+                    self.db = sqlite3.connect(f"file:{self.filename}?mode=ro", uri=True, check_same_thread=False)
+        return self.db
+
+    def refresh(self):
+        """Rebuild the index if the source file has changed since it was built"""
+        mtime = str(self.source.stat().st_mtime)
+        meta = {}
+        if self.filename.is_file():
+            db = sqlite3.connect(self.filename)
+            try:
+                meta = dict(db.execute("SELECT key, value FROM meta"))
+            except sqlite3.DatabaseError:
+                meta = {}
+            db.close()
+
+        if meta.get('options') == self.options():
+            if meta.get('mtime') == mtime:
+                return
+
+            # Touched, but maybe not changed
+            source_hash = file_hash(self.source)
+            if meta.get('hash') == source_hash:
+                db = sqlite3.connect(self.filename)
+                db.execute("UPDATE meta SET value=? WHERE key='mtime'", (mtime,))
+                db.commit()
+                db.close()
+                return
+        self.build()
+
+    def build(self):
+        print(f"Indexing {self.source}")
+
+        # The parallel transforms may all find the index out of date at the
+        # same time, so each builds its own copy and whichever finishes last
+        # wins. Either way, the index is only ever replaced by a complete one
+        fd, tmpfile = tempfile.mkstemp(dir=self.filename.parent, prefix=f"{self.filename.name}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            db = sqlite3.connect(tmpfile)
+            db.execute("PRAGMA journal_mode=OFF")
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute("CREATE TABLE meta(key VARCHAR PRIMARY KEY, value VARCHAR)")
+            self.populate(db)
+
+            db.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ('options', self.options()),
+                ('mtime', str(self.source.stat().st_mtime)),
+                ('hash', file_hash(self.source))
+            ])
+            db.commit()
+            db.close()
+
+            os.replace(tmpfile, self.filename)
+        except:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            raise
+
+    def populate(self, db):
+        """Create and fill the tables from the source file"""
+        db.execute("""CREATE TABLE terms(
+                        code VARCHAR PRIMARY KEY,
+                        name VARCHAR,
+                        obsolete INTEGER,
+                        primary_code VARCHAR
+                    ) WITHOUT ROWID""")
+        db.execute("CREATE TABLE parents(code VARCHAR, parent VARCHAR)")
+
+        if self.format == 'omim':
+            terms = parse_omim(self.source)
+        else:
+            terms = parse_obo(self.source)
+
+        alternates = []
+        parents = []
+        for term in terms:
+            if 'id' not in term:
+                continue
+            if self.ignore_obsolete and term['obsolete']:
+                continue
+            db.execute("INSERT OR REPLACE INTO terms VALUES (?, ?, ?, ?)",
+                            (term['id'], term.get('name'), term['obsolete'], term['id']))
+            for alt_id in term['alt_id']:
+                alternates.append((alt_id, term.get('name'), term['obsolete'], term['id']))
+            for parent in term['parents']:
+                parents.append((term['id'], parent))
+
+        # The graphs ended up with nodes (without names) for parents that
+        # were never defined, so we'll carry those along, too
+        db.executemany("INSERT OR IGNORE INTO terms VALUES (?, NULL, 0, ?)", [(parent, parent) for (code, parent) in parents])
+        db.executemany("INSERT INTO parents VALUES (?, ?)", parents)
+        if self.include_alt_ids:
+            db.executemany("INSERT OR IGNORE INTO terms VALUES (?, ?, ?, ?)", alternates)
+        db.execute("CREATE INDEX parents_by_code ON parents(code)")
+
+    def __contains__(self, code):
+        try:
+            self[code]
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, code):
+        if code not in self.cache:
+            db = self.connect()
+            row = None
+            if db is not None:
+                row = db.execute("SELECT name FROM terms WHERE code=?", (code,)).fetchone()
+            if row is None:
+                raise KeyError(code)
+            self.cache[code] = row[0]
+        return self.cache[code]
+
+    def get(self, code, default=None):
+        try:
+            return self[code]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        db = self.connect()
+        if db is None:
+            return 0
+        return db.execute("SELECT count(*) FROM terms").fetchone()[0]
+
+    def details(self, code):
+        """Returns (name, obsolete, primary_code, [parents]) or None"""
+        db = self.connect()
+        if db is None:
+            return None
+        row = db.execute("SELECT name, obsolete, primary_code FROM terms WHERE code=?", (code,)).fetchone()
+        if row is None:
+            return None
+        parents = [x[0] for x in db.execute("SELECT parent FROM parents WHERE code=?", (row[2],))]
+        return (row[0], bool(row[1]), row[2], parents)
+
+if __name__ == "__main__":
+    # Force each of the indexes to be brought up to date
+    from cmg_transform.tools import term_lookup
+
+    for ontology in term_lookup.ontology_indexes():
+        if ontology.source.is_file():
+            ontology.refresh()
+            print(f"{ontology.filename} : {len(ontology)} entries")
+        else:
+            print(f"{ontology.source} not found")
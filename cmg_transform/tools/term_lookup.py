@@ -1,17 +1,17 @@
 #!/usr/bin/env python
 
 """Simple wrapper around the jax HPO Rest which should be able to extract information about OMIM, ORPHA and HPO codes from their website"""
-import networkx
-import obonet
-import requests
 from pathlib import Path
 import collections
 import csv
+import threading
 
 import sys
 
 import pdb
 
+from cmg_transform.tools.ontology_index import OntologyIndex
+
 obo_path = Path(__file__).resolve().parent
 
 jax_api_base_url = "https://hpo.jax.org/api/hpo"
@@ -85,18 +85,14 @@ class Uberon:
     filename = obo_path / "uberon.obo"
 
     def __init__(self):
-        if Uberon.filename.is_file():
-            graph = obonet.read_obo(Uberon.filename)
-            self.data = {id_: data.get('name') for id_, data in graph.nodes(data=True)} 
-        else:
+        self.data = OntologyIndex(Uberon.filename)
+        if not self.data.is_available():
             print(f"{Uberon.filename} not found. Unable to query local uberon codes")
-            self.data = {}
 
     def details(self, code):
         name = self.data[code]
         return Details(name, code, "https://uberon.github.io/")
 
-uberon = Uberon()
 
 class HPO:
     misspelled = {
@@ -106,22 +102,9 @@ class HPO:
     filename = obo_path / "hp-full.obo"
 
     def __init__(self):
-        if HPO.filename.is_file():
-            graph = obonet.read_obo(HPO.filename, ignore_obsolete=False)
-
-            nodes = graph.nodes(data=True)
-
-            self.data = {id_: data.get('name') for id_, data in nodes} 
-            for id, data in nodes:
-                if 'alt_id' in data:
-                    for aid in data['alt_id']:
-                        if aid not in self.data:
-                            self.data[aid] = data.get('name')
-
-            print(f"HPO OBO file has been loaded {len(self.data)} entries collected")
-        else:
+        self.data = OntologyIndex(HPO.filename, ignore_obsolete=False, include_alt_ids=True)
+        if not self.data.is_available():
             print(f"{HPO.filename} not found. Unable to locally identify HP Codes")
-            self.data = {}
 
     def details(self, code = None):
         #pdb.set_trace()
@@ -135,49 +118,27 @@ class HPO:
         name = self.data[thecode]
         return Details(name, thecode, "https://uberon.github.io/")
 
-hpo = HPO()
 
 class Omim:
     filename = obo_path / "mimTitles.txt"
 
     def __init__(self):
-        self.data = {}
-
-        if Omim.filename.is_file():
-            with open(Omim.filename) as f:
-                for line in f:
-                    if line[0] != "#":
-                        line = line.strip().split("\t")
-                        id = line[1]
-                        name = line[2]
-                        self.data[int(id)] = name
-        else:
+        self.data = OntologyIndex(Omim.filename, format='omim')
+        if not self.data.is_available():
             print(f"{Omim.filename} not found. Unable to locally identify OMIM codes.")
 
-
     def details(self, code):
         id = int(code.replace("OMIM:", ""))
-        name = self.data[id]
+        name = self.data[str(id)]
 
         return Details(name, code, "https://omim.org/")
-omim = Omim()
 
 class Orpha:
     filename = obo_path / "ordo_en_3.obo"
 
     def __init__(self):
-        if Orpha.filename.is_file():
-            graph = obonet.read_obo(Orpha.filename, ignore_obsolete=False)
-
-            nodes = graph.nodes(data=True)
-            self.data = {id_: data.get('name') for id_, data in nodes} 
-            for id, data in nodes:
-                if 'alt_id' in data:
-                    for aid in data['alt_id']:
-                        if aid not in self.data:
-                            self.data[aid] = data.get('name')
-        else:
-            self.data = {}
+        self.data = OntologyIndex(Orpha.filename, ignore_obsolete=False, include_alt_ids=True)
+        if not self.data.is_available():
             print(f"{Orpha.filename} not found. Unable to locally resolve Orphanet codes")
 
     def details(self, code):
@@ -185,7 +146,67 @@ class Orpha:
         key = F"http://www.orpha.net/ORDO/Orphanet_{id}"
         name = self.data[key]
         return Details(name, code, "http://www.orpha.net/ORDO")
-orpha = Orpha()
+
+class OntologyRegistry:
+    """Builds each of the local ontologies the first time something asks for
+    one of its codes, rather than when term_lookup is imported"""
+    def __init__(self):
+        self.factories = {}
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def register(self, prefix, factory):
+        self.factories[prefix] = factory
+
+    def __contains__(self, prefix):
+        return prefix in self.factories
+
+    def __getitem__(self, prefix):
+        if prefix not in self.instances:
+            with self.lock:
+                if prefix not in self.instances:
+                    self.instances[prefix] = self.factories[prefix]()
+        return self.instances[prefix]
+
+    def load(self, prefixes=None):
+        """Open each of the ontologies (building their indexes if necessary)"""
+        if prefixes is None:
+            prefixes = list(self.factories.keys())
+        for prefix in prefixes:
+            self[prefix].data.connect()
+
+    def warm_up(self, prefixes=None):
+        """Load the ontologies in a background thread, so that it can happen
+        while we are busy reading the input files. Returns the thread in case
+        the caller wants to wait on it."""
+        thread = threading.Thread(target=self.load, args=(prefixes,), daemon=True)
+        thread.start()
+        return thread
+
+ontologies = OntologyRegistry()
+ontologies.register("UBERON", Uberon)
+ontologies.register("HP", HPO)
+ontologies.register("OMIM", Omim)
+ontologies.register("ORPHA", Orpha)
+
+def warm_up(prefixes=None):
+    return ontologies.warm_up(prefixes)
+
+def ontology_indexes():
+    """The indexes behind each of the local ontologies"""
+    return [ontologies[prefix].data for prefix in ontologies.factories]
+
+def __getattr__(name):
+    # uberon, hpo, omim and orpha used to be built at import
+    prefixes = {
+        'uberon': 'UBERON',
+        'hpo': 'HP',
+        'omim': 'OMIM',
+        'orpha': 'ORPHA'
+    }
+    if name in prefixes:
+        return ontologies[prefixes[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class Details:
     def __init__(self, name, code, system, obsolete=None):
@@ -201,35 +222,22 @@ class Details:
         writer.writerow([term_type, self.name, self.code, self.system, self.obsolete_note])
 
 def pull_uberon(code, source=None):
-    global uberon
-    return uberon.details(code)
+    return ontologies["UBERON"].details(code)
 
 def pull_hpo(code, source=None):
-    global hpo, remote_calls
+    global remote_calls
 
-    return hpo.details(code)
-
-
-    if code in cache['HPO']:
-        return cache['HPO'][code]
-    remote_calls += 1
-    response = requests.get(f"{jax_api_base_url}/term/{code}")
-    if response:
-        payload = response.json()['details']
-        d = Details(payload['name'], payload['id'], "http://purl.obolibrary.org/obo/hp.owl")
-        cache['HPO'][code] = d
-        return d
-    return None
+    return ontologies["HP"].details(code)
 
 def pull_orpha(code, source=None):
-    global orpha, remote_calls
+    global remote_calls
 
 
-    return orpha.details(code)
+    return ontologies["ORPHA"].details(code)
 
 def pull_omim(code, source=None):
-    global omim, remote_calls
-    return omim.details(code)
+    global remote_calls
+    return ontologies["OMIM"].details(code)
         
 # TODO - Work out the certificate issue with the HPO api instead of using the verify workaround
 def pull_disease(code, source=None):
@@ -246,6 +254,8 @@ def pull_disease(code, source=None):
             return cache['ORPHA'][code]
 
         print(f"No match for {code}. Falling back to the API")
+        # requests is slow to import and most runs never get here
+        import requests
         remote_calls += 1
         response = requests.get(f"{jax_api_base_url}/disease/{code}", verify=False)
         if response:
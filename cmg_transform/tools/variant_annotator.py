@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""Resolve a whole discovery file's worth of variants against the NIH clinical
+tables API concurrently rather than one blocking request (and a 1 second
+nap) at a time.
+
+Anything already in the variant cache is skipped and every result ends up in
+Variant.cache exactly as it would have through get_variant."""
+
+import asyncio
+import time
+
+import aiohttp
+
+from cmg_transform.tools import variant_details
+from cmg_transform.tools.variant_details import variant_query, match_variant, cached_variant
+
+class TokenBucket:
+    """Allows up to rate requests per second, with bursts of up to capacity
+    (by default, no bursts at all)"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else 1
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class VariantAnnotator:
+    # Statuses worth trying again
+    retry_statuses = set([429, 500, 502, 503, 504])
+
+    # Defaults used by the transform, which can be changed from the command line
+    settings = {
+        'rate': 4.0,
+        'concurrency': 8
+    }
+
+    def __init__(self, rate=4.0, concurrency=8, retries=3, backoff=1.0, timeout=30, base_url=None):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # Mostly so that we can point this at a stub server
+        self.base_url = base_url
+
+        self.remote_calls = 0
+        self.failures = 0
+
+    def annotate(self, queries):
+        """queries is a list of (hgvsc, transcript). Returns hgvsc => Variant (or None)
+
+        Like get_variant, the cache is keyed only by hgvsc, so the first
+        transcript we see for a given hgvsc is the one that gets queried"""
+        results = {}
+        pending = {}
+        for hgvsc, transcript in queries:
+            if hgvsc in results or hgvsc in pending:
+                continue
+            cached, var = cached_variant(hgvsc)
+            if cached:
+                results[hgvsc] = var
+            else:
+                pending[hgvsc] = transcript
+
+        if len(pending) > 0:
+            print(f"Querying {len(pending)} variants ({len(results)} were already cached)")
+            results.update(asyncio.run(self.fetch_all(pending)))
+        return results
+
+    async def fetch_all(self, pending):
+        bucket = TokenBucket(self.rate)
+        throttle = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            hgvscs = list(pending.keys())
+            responses = await asyncio.gather(*[self.fetch(session, bucket, throttle, hgvsc, pending[hgvsc]) for hgvsc in hgvscs])
+
+        # Everything touching the cache happens back here, one at a time
+        results = {}
+        for hgvsc, (trscpt, payload) in zip(hgvscs, responses):
+            if payload is not None:
+                results[hgvsc] = match_variant(hgvsc, trscpt, payload)
+            else:
+                # Failures are not recorded as missing, so we'll try them again
+                # next time around
+                results[hgvsc] = None
+        return results
+
+    async def fetch(self, session, bucket, throttle, hgvsc, transcript):
+        """Returns (transcript id, parsed json) or (transcript id, None) if we gave up"""
+        query, trscpt = variant_query(hgvsc, transcript)
+        if self.base_url is not None:
+            query = query.replace(variant_details.url, self.base_url, 1)
+
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * (2 ** attempt)
+            async with throttle:
+                await bucket.acquire()
+                self.remote_calls += 1
+                try:
+                    async with session.get(query) as response:
+                        if response.status == 200:
+                            return trscpt, await response.json(content_type=None)
+
+                        if response.status not in VariantAnnotator.retry_statuses:
+                            print(f"There was a problem getting the variant information for {hgvsc} ({response.status})")
+                            self.failures += 1
+                            return trscpt, None
+
+                        retry_after = response.headers.get("Retry-After")
+                        if retry_after is not None and retry_after.isdigit():
+                            delay = max(delay, int(retry_after))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f"Problem querying {hgvsc} ({type(e).__name__}), attempt {attempt + 1}")
+
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+
+        print(f"There was a problem getting the variant information for {hgvsc}")
+        self.failures += 1
+        return trscpt, None
+
+def annotate_variants(discovery_variants, **kwargs):
+    """Resolve the variants for each of the DiscoveryVariant objects in one go
+    and assign them back to the objects' variant property"""
+    queries = [(var.hgvsc, var.transcript) for var in discovery_variants if var.hgvsc is not None and var.transcript is not None]
+    if len(queries) == 0:
+        return
+
+    annotator = VariantAnnotator(**kwargs)
+    results = annotator.annotate(queries)
+    for var in discovery_variants:
+        if var.hgvsc is not None and var.transcript is not None:
+            var.variant = results.get(var.hgvsc)
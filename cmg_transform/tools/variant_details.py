@@ -8,15 +8,20 @@
 import requests
 import collections
 import re
-from csv import DictReader, DictWriter, writer
+from csv import DictReader
 from time import sleep
 from pathlib import Path 
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlite3 import connect
 
 url = "https://clinicaltables.nlm.nih.gov/api/variants/v4/search?terms="
 cache_path = Path(__file__).resolve().parent
 
 class VarCache:
+    filename = cache_path / "variant_cache.db"
+
+    # The caches used to be written out as CSV files at the end of each run. If
+    # they are present, we'll pull them in when the db is first created
     fn = cache_path / "variant_cache.csv"
 
     # This is a big part, capturing those that don't match what we are trying to find
@@ -24,63 +29,100 @@ class VarCache:
 
     # How long do we keep these failed matches around? 
     max_missing_age = 30
-    def __init__(self):
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = VarCache.filename
+        self.filename = filename
+        self.db = None
+
+        # Whatever we've already pulled from (or written to) the db
         self.data = {}
-        self.missing = {}
 
+    def connect(self):
+        if self.db is None:
+            # Parallel workers share the db, so we'll need to be patient
+            # when someone else is writing
+            self.db = connect(self.filename, timeout=60)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+
+            cur = self.db.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("CREATE TABLE IF NOT EXISTS meta(key VARCHAR PRIMARY KEY, value VARCHAR)")
+            cur.execute(f"""CREATE TABLE IF NOT EXISTS variants(
+                            hgvsc VARCHAR PRIMARY KEY,
+                            {', '.join([f"{col} VARCHAR" for col in Variant.header])}
+                        )""")
+            cur.execute("CREATE TABLE IF NOT EXISTS missing(name VARCHAR PRIMARY KEY, date REAL)")
+            cur.execute("CREATE INDEX IF NOT EXISTS missing_by_date ON missing(date)")
+
+            if cur.execute("SELECT value FROM meta WHERE key='imported'").fetchone() is None:
+                self.import_csv(cur)
+                cur.execute("INSERT INTO meta VALUES ('imported', ?)", (str(datetime.now().timestamp()),))
+
+            # If the age of missing is greater than the maximum, we'll 
+            # try again if it's encountered
+            cur.execute("DELETE FROM missing WHERE date < ?", (self.expiry(),))
+            if cur.rowcount > 0:
+                print(f"Ignoring {cur.rowcount} 'missing' variant entries due to age expirey")
+            self.db.commit()
+        return self.db
+
+    def import_csv(self, cur):
         if VarCache.fn.is_file():
             with open(VarCache.fn, 'rt') as f:
                 reader = DictReader(f, delimiter=',', quotechar='"')
-
-                for line in reader:
-                    self.data[line['VariantID']] = Variant(line)
+                cur.executemany(self.insert_variant_sql(), 
+                                [[line['VariantID']] + [line[col] for col in Variant.header] for line in reader])
 
         if VarCache.miss.is_file():
-            now = datetime.now()
             with open(VarCache.miss, 'rt') as f:
                 reader = DictReader(f, delimiter=',', quotechar='"')
+                cur.executemany("INSERT OR REPLACE INTO missing VALUES (?, ?)", 
+                                [(line['name'], float(line['date'])) for line in reader])
 
-                for line in reader:
-                    # If the age of missing is greater than the maximum, we'll 
-                    # try again if it's encountered
-                    origin = datetime.fromtimestamp(float(line['date']))
-                    if (now - origin).days < VarCache.max_missing_age:
-                        self.missing[line['name']] = float(line['date'])
-                    else:
-                        print(str(origin))
-                        print((now - origin).days)
-                        print(VarCache.max_missing_age)
-                        print((now - origin).days > VarCache.max_missing_age)
-                        print(f"Ignoring 'missing' {line['name']} entry due to age expirey")
+    def insert_variant_sql(self):
+        return f"INSERT OR REPLACE INTO variants VALUES ({', '.join(['?'] * (len(Variant.header) + 1))})"
 
+    def expiry(self):
+        return (datetime.now() - timedelta(days=VarCache.max_missing_age)).timestamp()
 
     def add_missing(self, name):
-        self.missing[name] = datetime.now().timestamp()
+        db = self.connect()
+        db.execute("INSERT OR REPLACE INTO missing VALUES (?, ?)", (name, datetime.now().timestamp()))
+        db.commit()
+        self.data.pop(name, None)
 
     def add_variant(self, name, var):
+        db = self.connect()
+        obj = var.as_obj()
+        db.execute(self.insert_variant_sql(), [name] + [obj[col] for col in Variant.header])
+        db.commit()
         self.data[name] = var 
 
     def get_variant(self, name):
         if name in self.data:
             return self.data[name]
 
-        if name in self.missing:
+        db = self.connect()
+        row = db.execute(f"SELECT {', '.join(Variant.header)} FROM variants WHERE hgvsc=?", (name,)).fetchone()
+        if row is not None:
+            self.data[name] = Variant(dict(zip(Variant.header, row)))
+            return self.data[name]
+
+        if db.execute("SELECT 1 FROM missing WHERE name=? AND date >= ?", (name, self.expiry())).fetchone() is not None:
             return -1
         return None
 
     def commit(self):
-        with open(VarCache.fn, 'wt') as f:
-            wrt = DictWriter(f, delimiter=',', quotechar='"', fieldnames=Variant.header)
-            wrt.writeheader()
-            for id in sorted(self.data.keys()):
-                wrt.writerow(self.data[id].as_obj())
-
-        with open(VarCache.miss, 'wt') as f:
-            wrt = writer(f, delimiter=',', quotechar='"')
-            wrt.writerow(['name', 'date'])
+        # Everything is written as soon as we learn about it
+        if self.db is not None:
+            self.db.commit()
 
-            for id in sorted(self.missing.keys()):
-                wrt.writerow([id, self.missing[id]])
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
 class PhenoID:
     system_sources = {
@@ -152,22 +194,57 @@ class Variant:
         }
 Variant.cache = VarCache()
 header = "VariantID,Type,dbSNP,GeneSymbol,Name,Chromosome,GenomicLocation,PhenotypeList,phenotype,phenotypes,PhenotypeIDS,VariationID,AminoAcidChange,RefSeqID".split(",")
-def get_variant(hgvsc, transcript):
+def variant_query(hgvsc, transcript):
+    """Returns the query url along with the transcript ID sans version"""
     # We can't rely on the versions matching. 
     trscpt = transcript.split(".")[0]
-
+    return f"{url}{trscpt} {hgvsc}&maxList=500&df={','.join(header)}", trscpt
+
+def match_variant(hgvsc, trscpt, result):
+    """Find the record matching our transcript in the API's response and add it
+    (or a note about it missing) to the cache"""
+    id = result[0]
+    lst = result[1]
+    # 3rd is always none
+    data = result[3]
+    count = 0
+    for chunk in data:
+        count += 1
+        values = dict(zip(header, chunk))
+
+        if values['RefSeqID'].split(".")[0] == trscpt:
+            var = Variant(values)
+            Variant.cache.add_variant(hgvsc, var)
+
+            return var
+    if count > 0:
+        print(f"We found {count} records, for the hgsvc, but none matched the transcript")
+
+    # Make a note about missing data so we don't requery it for a certain amount of time
+    Variant.cache.add_missing(hgvsc)
+    return None
+
+def cached_variant(hgvsc):
+    """Returns (True, variant) if we already know the answer for hgvsc"""
     var = Variant.cache.get_variant(hgvsc)
 
     # If the name has already been identified as missing, just abort
     if var == -1:
-        return None
+        return True, None
 
     # Return cached entity
     if var is not None:
+        return True, var
+    return False, None
+
+def get_variant(hgvsc, transcript):
+    query, trscpt = variant_query(hgvsc, transcript)
+
+    cached, var = cached_variant(hgvsc)
+    if cached:
         return var
 
     try:
-        query = f"{url}{trscpt} {hgvsc}&maxList=500&df={','.join(header)}"
         response = requests.get(query)
         sleep(1)
     # Some queries regularly fail
@@ -177,26 +254,7 @@ def get_variant(hgvsc, transcript):
 
 
     if response:
-        result = response.json()
-        id = result[0]
-        lst = result[1]
-        # 3rd is always none
-        data = result[3]
-        count = 0
-        for chunk in data:
-            count += 1
-            values = dict(zip(header, chunk))
-
-            if values['RefSeqID'].split(".")[0] == trscpt:
-                var = Variant(values)
-                Variant.cache.add_variant(hgvsc, var)
-
-                return var
-        if count > 0:
-            print(f"We found {count} records, for the hgsvc, but none matched the transcript")
-
-        # Make a note about missing data so we don't requery it for a certain amount of time
-        Variant.cache.add_missing(hgvsc)
+        return match_variant(hgvsc, trscpt, response.json())
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
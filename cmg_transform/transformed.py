@@ -9,6 +9,8 @@ import pdb
 import csv
 import sys
 
+from cmg_transform.change_logger import materialize_summary
+
 class Variable:
     def __init__(self, cursor, variable_id, filename, varname):
         self.cur = cursor
@@ -20,30 +22,67 @@ class Report:
     def __init__(self, cursor, report_vars=None):
         """Optionally, limit variables to list in report_vars"""
         self.cur = cursor
+        self.load_variables(report_vars)
 
+    def load_variables(self, report_vars):
         # Variables, hopefully where id-1 is the index 
         self.variables = []
 
         # Look up a variable by name
         self.vars_by_name = {}
 
+        # ...or by ID
+        self.vars_by_id = {}
+
         # filename => [vars found in file]
         self.filenames = defaultdict(list)
 
-        for (varid, filename, name) in self.cur.execute(""" SELECT 
-                                            variable_id, 
-                                            filename, 
-                                            name 
-                                        FROM 
-                                            variable_names
-                                        ORDER BY
-                                            variable_id"""):
+        for (varid, filename, name) in self.variable_names():
             if report_vars is None or name in report_vars:
                 var = Variable(self.cur, varid, filename, name)
                 self.variables.append(var)
                 self.vars_by_name[name] = var
+                self.vars_by_id[varid] = var
                 self.filenames[filename].append(var)
 
+    def variable_names(self):
+        return self.cur.execute(""" SELECT 
+                                    variable_id, 
+                                    filename, 
+                                    name 
+                                FROM 
+                                    variable_names
+                                ORDER BY
+                                    variable_id""")
+
+    def totals(self, dataset_name):
+        """(variable_id, lines, lines transformed) for each variable"""
+        # Datasets logged before there were summary tables get theirs the
+        # first time they are reported on
+        if self.cur.execute("SELECT 1 FROM variable_totals WHERE dataset_name=? LIMIT 1", (dataset_name,)).fetchone() is None:
+            materialize_summary(self.cur, dataset_name)
+            self.cur.connection.commit()
+
+        return self.cur.execute("""SELECT 
+                                    variable_id, 
+                                    total,
+                                    transformed
+                                FROM 
+                                    variable_totals
+                                WHERE 
+                                    dataset_name=?""", (dataset_name,))
+
+    def untransformed(self, dataset_name):
+        """(variable_id, original value, lines) for each value that ended up empty"""
+        return self.cur.execute("""SELECT
+                                    variable_id, 
+                                    orig_val,
+                                    lines
+                                FROM 
+                                    untransformed_values
+                                WHERE 
+                                    dataset_name=?""", (dataset_name,))
+
     def summarize(self, dataset_name, min_missing=10.0, print_header=True):
         class VarSummary:
             def __init__(self, var, total):
@@ -68,56 +107,16 @@ class Report:
                     writer.writerow([dataset_name,self.var.table, self.var.name, self.total, self.missing, "%.4f" % missing_perc] + values)
 
         summary_data = {}
-        base_qry = """SELECT 
-                        variable_id, 
-                        count(DISTINCT line_number)
-                    FROM 
-                        transformations
-                    WHERE 
-                        dataset_name='{dataset_name}'
-                    GROUP BY 
-                        variable_id"""
-        for (varid, total) in self.cur.execute(f""" SELECT 
-                                            variable_id, 
-                                            count(DISTINCT line_number)
-                                        FROM 
-                                            transformations
-                                        WHERE 
-                                            dataset_name='{dataset_name}'
-                                        GROUP BY 
-                                            variable_id"""):
-            varid = varid -1
-            summary_data[varid] = VarSummary(self.variables[varid], total)
-
-        for (varid, val, total) in self.cur.execute(f"""SELECT
-                                            variable_id, 
-                                            orig_val,
-                                            count(DISTINCT line_number)
-                                        FROM 
-                                            transformations
-                                        WHERE 
-                                            dataset_name='{dataset_name}' AND
-                                            new_val == '' AND
-                                            orig_val != ''
-                                        GROUP BY 
-                                            variable_id,
-                                            orig_val"""):     
-            varid = varid -1
-            summary_data[varid].missing += total
-            summary_data[varid].missed_values[val] = total
-
-        for (varid, total) in self.cur.execute(f"""SELECT
-                                            variable_id, 
-                                            count(DISTINCT line_number)
-                                        FROM 
-                                            transformations
-                                        WHERE 
-                                            dataset_name='{dataset_name}' AND
-                                            new_val != ''
-                                        GROUP BY 
-                                            variable_id"""):     
-            varid = varid -1
-            summary_data[varid].transformed = total
+        for (varid, total, transformed) in self.totals(dataset_name):
+            if varid in self.vars_by_id:
+                summary_data[varid] = VarSummary(self.vars_by_id[varid], total)
+                summary_data[varid].transformed = transformed
+
+        for (varid, val, total) in self.untransformed(dataset_name):
+            if varid in summary_data:
+                summary_data[varid].missing += total
+                summary_data[varid].missed_values[val] = total
+
         writer = csv.writer(sys.stdout, delimiter=',', quotechar='"')
 
         if print_header:
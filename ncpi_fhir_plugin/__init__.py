@@ -8,4 +8,34 @@ def set_fhir_server(host):
     _fhir_server = host
 
 def get_fhir_server():
-    return _fhir_server
\ No newline at end of file
+    return _fhir_server
+
+_content_manifest = None
+
+def set_content_manifest(manifest):
+    global _content_manifest
+
+    _content_manifest = manifest
+
+def get_content_manifest():
+    return _content_manifest
+
+_stable_ids = False
+
+def set_stable_ids(enabled):
+    global _stable_ids
+
+    _stable_ids = enabled
+
+def get_stable_ids():
+    return _stable_ids
+
+_load_profile = None
+
+def set_load_profile(profile):
+    global _load_profile
+
+    _load_profile = profile
+
+def get_load_profile():
+    return _load_profile
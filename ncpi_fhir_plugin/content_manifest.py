@@ -0,0 +1,82 @@
+"""
+Remembers a hash of each resource as it was last sent to the server so that
+reloading a study only submits what actually changed.
+
+Entities are canonicalized (empty fields and the id dropped, keys sorted)
+before hashing, so the body we POSTed the first time around hashes the same
+as the one we PUT (with its new id) the next. Only resources which already
+have an ID can be skipped, and only when the hash recorded for that ID
+matches.
+
+Anything changed on the server behind our back won't be noticed, which is
+what force is for: nothing is skipped, but the hashes are still recorded.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+def canonical(body):
+    body = {k: v for k, v in body.items() if k != "id" and v not in (None, [], {})}
+    return json.dumps(body, sort_keys=True, separators=(',', ':'), default=str)
+
+def digest(body):
+    return hashlib.sha1(canonical(body).encode('utf-8')).hexdigest()
+
+class ContentManifest:
+    def __init__(self, filename, force=False, commit_every=1000):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.force = force
+        self.commit_every = commit_every
+        self.pending = 0
+
+        # How many resources we didn't have to send
+        self.skipped = 0
+
+        # Submissions may be coming back on other threads
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS manifest(
+                            resource_type VARCHAR,
+                            target_id VARCHAR,
+                            hash VARCHAR,
+                            PRIMARY KEY (resource_type, target_id)
+                        ) WITHOUT ROWID""")
+        self.db.commit()
+
+    @classmethod
+    def manifest_filename(cls, cache_dir, study_id):
+        return Path(cache_dir) / "LoadStage" / f"{study_id}_content_manifest.db"
+
+    def unchanged(self, resource_type, body, hash):
+        """True if body has an ID and matches what we last sent for it"""
+        if self.force or "id" not in body:
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT hash FROM manifest WHERE resource_type=? AND target_id=?",
+                                    (resource_type, body['id'])).fetchone()
+            if row is not None and row[0] == hash:
+                self.skipped += 1
+                return True
+        return False
+
+    def record(self, resource_type, target_id, hash):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?)", (resource_type, target_id, hash))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
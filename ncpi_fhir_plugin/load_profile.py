@@ -0,0 +1,190 @@
+"""
+Where does a load spend its time? Once a LoadProfile has been registered
+(see set_load_profile), the streaming loader times each of the TargetBase
+hooks it calls and submit and the BundleSubmitter time the requests
+themselves, all broken down by class_name:
+
+    transform_records_list  aggregating the class's rows
+    get_key_components      working out each record's key
+    build_entity            building each resource (including any ID lookups
+                            for the resources it references)
+    uid_cache               looking IDs up in the local cache
+    query_target_ids        looking IDs up on the server
+    request                 the HTTP requests (a bundle counts as one)
+
+Lookups are charged to the class being looked up, not the one doing the
+looking. Each stage gets a count, total and a latency histogram, and the
+requests also keep track of bytes sent and retries.
+
+Without the streaming loader (LoadStage), only the requests are seen.
+"""
+
+import csv
+import json
+import sys
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+from timeit import default_timer as timer
+
+from ncpi_fhir_plugin import get_load_profile
+
+# Upper bounds (in seconds) for the histogram buckets. Anything slower ends
+# up in the last one
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+def bucket_label(index):
+    if index < len(BUCKETS):
+        return f"<={BUCKETS[index] * 1000:g}ms"
+    return f">{BUCKETS[-1] * 1000:g}ms"
+
+class StageTimes:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.histogram[index] += 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 6),
+            "mean_ms": round(self.total * 1000 / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max * 1000, 3),
+            "histogram": {bucket_label(i): n for i, n in enumerate(self.histogram)}
+        }
+
+class Timed:
+    """Records how long the block took (cheaper than a @contextmanager,
+    which matters when it's wrapped around every key lookup)"""
+    __slots__ = ['profile', 'class_name', 'stage', 'start']
+
+    def __init__(self, profile, class_name, stage):
+        self.profile = profile
+        self.class_name = class_name
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = timer()
+
+    def __exit__(self, *exc_info):
+        self.profile.record(self.class_name, self.stage, timer() - self.start)
+        return False
+
+class LoadProfile:
+    def __init__(self, progress=False, progress_every=1.0):
+        """progress writes a running summary of the current class to stderr,
+        at most once every progress_every seconds"""
+        self.progress = progress
+        self.progress_every = progress_every
+        self.last_progress = 0.0
+        self.started = timer()
+
+        # class_name => stage => StageTimes
+        self.stages = defaultdict(lambda: defaultdict(StageTimes))
+        self.bytes_sent = defaultdict(int)
+        self.retries = defaultdict(int)
+
+        # Requests finish on the pool's threads
+        self.lock = threading.Lock()
+
+    def timed(self, class_name, stage):
+        return Timed(self, class_name, stage)
+
+    def record(self, class_name, stage, seconds):
+        with self.lock:
+            self.stages[class_name][stage].add(seconds)
+        # Lookups are for other classes, so it's the builds that tell us
+        # which class is being loaded
+        if self.progress and stage == 'build_entity' and timer() - self.last_progress >= self.progress_every:
+            self.show_progress(class_name)
+
+    def sent(self, class_name, body):
+        size = len(json.dumps(body, default=str).encode('utf-8'))
+        with self.lock:
+            self.bytes_sent[class_name] += size
+
+    def retried(self, class_name, count=1):
+        with self.lock:
+            self.retries[class_name] += count
+
+    def show_progress(self, class_name):
+        self.last_progress = timer()
+        with self.lock:
+            stages = self.stages[class_name]
+            built = stages['build_entity'].count
+            requests = stages['request']
+            mean = requests.total * 1000 / requests.count if requests.count else 0
+            sent = self.bytes_sent[class_name]
+        sys.stderr.write(f"\r{class_name}: {built} built, {requests.count} requests ({mean:.1f}ms), "
+                         f"{sent / 1048576:.1f} MiB sent, {self.last_progress - self.started:.0f}s elapsed\033[K")
+        sys.stderr.flush()
+
+    def report(self):
+        with self.lock:
+            report = {}
+            for class_name in self.stages:
+                report[class_name] = {
+                    "bytes_sent": self.bytes_sent[class_name],
+                    "retries": self.retries[class_name],
+                    "stages": {stage: times.summary() for stage, times in self.stages[class_name].items()}
+                }
+            return report
+
+    def write_json(self, filename):
+        with open(filename, 'wt') as f:
+            json.dump({
+                "elapsed_seconds": round(timer() - self.started, 3),
+                "classes": self.report()
+            }, f, indent=2)
+
+    def write_csv(self, filename):
+        """One row per class and stage. Bytes sent and retries only apply
+        to the requests"""
+        with open(filename, 'wt', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["class_name", "stage", "count", "total_seconds", "mean_ms", "max_ms", "bytes_sent", "retries"]
+                                + [bucket_label(i) for i in range(len(BUCKETS) + 1)])
+            for class_name, summary in self.report().items():
+                for stage, times in summary['stages'].items():
+                    request_only = stage == "request"
+                    writer.writerow([class_name,
+                                    stage,
+                                    times['count'],
+                                    times['total_seconds'],
+                                    times['mean_ms'],
+                                    times['max_ms'],
+                                    summary['bytes_sent'] if request_only else "",
+                                    summary['retries'] if request_only else ""]
+                                    + list(times['histogram'].values()))
+
+    def print_summary(self, top=5):
+        """The classes which took the longest and where their time went.
+        The stages overlap (build_entity includes lookups), so this is only
+        a rough ordering"""
+        if self.progress:
+            sys.stderr.write("\n")
+        report = self.report()
+        def seconds(class_name):
+            return sum(times['total_seconds'] for times in report[class_name]['stages'].values())
+        for class_name in sorted(report, key=seconds, reverse=True)[:top]:
+            stages = report[class_name]['stages']
+            breakdown = ", ".join(f"{stage} {stages[stage]['total_seconds']:.2f}s"
+                                    for stage in sorted(stages, key=lambda stage: stages[stage]['total_seconds'], reverse=True))
+            print(f"{class_name}: {breakdown}")
+
+def profiled(class_name, stage):
+    """Times the block when a LoadProfile has been registered"""
+    profile = get_load_profile()
+    if profile is None:
+        return nullcontext()
+    return profile.timed(class_name, stage)
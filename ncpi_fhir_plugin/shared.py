@@ -1,4 +1,6 @@
 import re
+import json
+import hashlib
 
 
 def join(*args):
@@ -8,3 +10,9 @@ def join(*args):
 # http://hl7.org/fhir/R4/datatypes.html#id
 def make_identifier(*args):
     return re.sub(r"[^A-Za-z0-9\-\.]", "-", ".".join(str(a) for a in args))[:64]
+
+
+# The same arguments always produce the same (valid) id, no matter where or
+# when the resource is built
+def stable_id(*args):
+    return make_identifier(hashlib.sha1(json.dumps(args, sort_keys=True, default=str).encode('utf-8')).hexdigest())
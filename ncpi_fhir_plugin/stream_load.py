@@ -0,0 +1,319 @@
+"""
+Streaming alternative to kf_lib_data_ingest's LoadStage.
+
+LoadStage expects every transformed file as a DataFrame up front and turns
+each of them into a full list of records before the first resource is sent.
+Here, each file is read a chunk at a time and every record is built (through
+the same TargetBase builders) and submitted before moving on, so memory
+scales with the chunk size rather than with the study.
+
+Classes with a transform_records_list (Group, ResearchStudy, Disease, etc)
+need to see every row before they can aggregate them, so their files are
+still read in full.
+
+With stable_ids, IDs are derived from each resource's identifier rather than
+assigned by the server, and every resource is PUT. Nothing has to be looked
+up and nothing has to wait for its parents' IDs, so classes are no longer
+sent one after the other: with a pool (or bundles), children go out
+alongside their parents. The server must accept client assigned IDs (and,
+in that case, references to resources it hasn't been sent yet).
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from collections import defaultdict, Counter
+from pathlib import Path
+
+import pandas as pd
+
+from ncpi_fhir_plugin import fhir_plugin
+from ncpi_fhir_plugin.load_profile import profiled
+
+logger = logging.getLogger(__name__)
+
+def read_chunks(filename, chunk_size):
+    """Yields lists of records (dicts) from a transformed TSV, chunk_size rows at a time
+
+    Like read_df, everything is a string and empty cells are left empty"""
+    reader = pd.read_csv(filename,
+                        sep='\t',
+                        dtype=str,
+                        na_filter=False,
+                        chunksize=chunk_size)
+    for chunk in reader:
+        yield chunk.to_dict('records')
+
+def class_records(entity_class, filename, chunk_size):
+    """Yields lists of records for the class to build. Classes with a
+    transform_records_list get everything at once"""
+    if hasattr(entity_class, 'transform_records_list'):
+        records = []
+        for chunk in read_chunks(filename, chunk_size):
+            records += chunk
+        if len(records) > 0:
+            with profiled(entity_class.class_name, 'transform_records_list'):
+                records = entity_class.transform_records_list(records)
+            yield records
+    else:
+        yield from read_chunks(filename, chunk_size)
+
+class UidCache:
+    """Maps each entity's key components to the ID the server assigned it"""
+    def __init__(self, filename, commit_every=1000):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_every = commit_every
+        self.pending = 0
+
+        # Submissions may be finishing up on other threads
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS uids(
+                            class_name VARCHAR,
+                            key VARCHAR,
+                            target_id VARCHAR,
+                            PRIMARY KEY (class_name, key)
+                        ) WITHOUT ROWID""")
+        self.db.commit()
+
+    def get(self, class_name, key):
+        with self.lock:
+            row = self.db.execute("SELECT target_id FROM uids WHERE class_name=? AND key=?", (class_name, key)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def all(self, class_name):
+        """Returns key => target_id for everything we know about the class"""
+        with self.lock:
+            return dict(self.db.execute("SELECT key, target_id FROM uids WHERE class_name=?", (class_name,)))
+
+    def set(self, class_name, key, target_id):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO uids VALUES (?, ?, ?)", (class_name, key, target_id))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+class StreamingLoader:
+    def __init__(self, host, study_id, cache_dir, chunk_size=1000, submitter=None, pool=None, prefetch_size=1000, stable_ids=False):
+        """submitter is an optional BundleSubmitter. Without one, each resource
+        is sent on its own through the class's submit. 
+        
+        pool is an optional SubmissionPool. Without one, each request must 
+        finish before we build the next resource.
+
+        prefetch_size is the page size used to pull down the identifiers
+        for each resource type the first time we need an ID for one. Set
+        it to 0 to search for each record's identifier instead.
+
+        stable_ids assigns IDs locally (see TargetBase.stable_target_id)
+        rather than looking them up on the server. Anything in the uid cache
+        keeps the ID it already has."""
+        self.host = host
+        self.study_id = study_id
+        self.chunk_size = chunk_size
+        self.submitter = submitter
+        self.pool = pool
+        self.prefetch_size = prefetch_size
+        self.stable_ids = stable_ids
+        self.uids = UidCache(StreamingLoader.cache_filename(cache_dir, study_id))
+
+        # class_name => Counter of what happened to each record
+        self.stats = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+        # (class_name, key) => future for resources still being sent
+        self.inflight = {}
+
+        # resource_type => identifier => [ids] for what was already on the
+        # server when we started
+        self.known_ids = {}
+
+    @classmethod
+    def cache_filename(cls, cache_dir, study_id):
+        return Path(cache_dir) / "StreamLoad" / f"{study_id}_uid_cache.db"
+
+    def key_for(self, entity_class, record):
+        with profiled(entity_class.class_name, 'get_key_components'):
+            key_components = entity_class.get_key_components(record, self.get_target_id_from_record)
+        return key_components, json.dumps(key_components, sort_keys=True, default=str)
+
+    def get_target_id_from_record(self, entity_class, record):
+        """This is what the builders use to find IDs for themselves as well as
+        for any resources they reference"""
+        target_id_concept = getattr(entity_class, 'target_id_concept', None)
+        if target_id_concept and record.get(target_id_concept):
+            return record[target_id_concept]
+
+        try:
+            key_components, key = self.key_for(entity_class, record)
+        except Exception:
+            return None
+
+        with profiled(entity_class.class_name, 'uid_cache'):
+            target_id = self.uids.get(entity_class.class_name, key)
+        if target_id is None and self.stable_ids:
+            return entity_class.stable_target_id(key_components)
+        if target_id is None:
+            with profiled(entity_class.class_name, 'query_target_ids'):
+                target_ids = self.query_target_ids(entity_class, key_components)
+            if len(target_ids) > 0:
+                if len(target_ids) > 1:
+                    logger.warning(f"Multiple {entity_class.resource_type} resources found for {key}: {target_ids}")
+                target_id = target_ids[0]
+                self.uids.set(entity_class.class_name, key, target_id)
+        return target_id
+
+    def get_target_ids_from_records(self, entity_class, records):
+        """Bulk version of get_target_id_from_record for the builders which
+        reference a lot of resources at once (Group members, for instance).
+        Everything we already know comes from a single read of the uid cache"""
+        with profiled(entity_class.class_name, 'uid_cache'):
+            known = self.uids.all(entity_class.class_name)
+        target_id_concept = getattr(entity_class, 'target_id_concept', None)
+
+        target_ids = []
+        for record in records:
+            if target_id_concept and record.get(target_id_concept):
+                target_ids.append(record[target_id_concept])
+                continue
+            try:
+                key_components, key = self.key_for(entity_class, record)
+            except Exception:
+                target_ids.append(None)
+                continue
+            target_id = known.get(key)
+            if target_id is None:
+                target_id = self.get_target_id_from_record(entity_class, record)
+            target_ids.append(target_id)
+        return target_ids
+
+    def query_target_ids(self, entity_class, key_components):
+        if self.prefetch_size < 1:
+            return entity_class.query_target_ids(self.host, key_components)
+
+        # Anything we've created or updated since is in the uid cache, so
+        # whatever isn't in here doesn't exist on the server
+        if entity_class.resource_type not in self.known_ids:
+            self.known_ids[entity_class.resource_type] = entity_class.prefetch_target_ids(self.host, self.prefetch_size)
+            logger.info(f"Prefetched {len(self.known_ids[entity_class.resource_type])} {entity_class.resource_type} identifiers")
+        return self.known_ids[entity_class.resource_type].get(key_components['identifier'], [])
+
+    def load_record(self, entity_class, record):
+        try:
+            key_components, key = self.key_for(entity_class, record)
+        except Exception as e:
+            # No key, no entity
+            logger.debug(f"Skipping {entity_class.class_name} record without key: {e}")
+            self.count(entity_class, 'skipped')
+            return None
+
+        # If the same entity is already on its way, we need its ID before
+        # building this version of it (otherwise we'd create it twice)
+        if (entity_class.class_name, key) in self.inflight:
+            self.inflight.pop((entity_class.class_name, key)).result()
+        if self.submitter is not None:
+            self.submitter.wait_for(entity_class.class_name, key)
+
+        try:
+            with profiled(entity_class.class_name, 'build_entity'):
+                entity = entity_class.build_entity(record, self.get_target_id_from_record)
+            if self.submitter is not None:
+                # We'll hear back once the bundle has been sent
+                self.submitter.add(entity_class, 
+                                    key, 
+                                    entity, 
+                                    on_success=lambda target_id: self.loaded(entity_class, key, target_id),
+                                    on_failure=lambda message: self.failed(entity_class, key, message))
+                return None
+            if self.pool is not None:
+                self.inflight[(entity_class.class_name, key)] = self.pool.submit(self.host, 
+                                                                        entity_class.class_name, 
+                                                                        self.send, 
+                                                                        entity_class, 
+                                                                        key, 
+                                                                        entity)
+                return None
+            target_id = entity_class.submit(self.host, entity)
+        except Exception as e:
+            logger.exception(f"Unable to load {entity_class.class_name} {key}")
+            self.count(entity_class, 'failed')
+            return None
+        self.loaded(entity_class, key, target_id)
+        return target_id
+
+    def send(self, entity_class, key, entity):
+        """Submit a single entity from one of the pool's threads"""
+        try:
+            target_id = entity_class.submit(self.host, entity)
+        except Exception as e:
+            self.failed(entity_class, key, str(e))
+            return None
+        self.loaded(entity_class, key, target_id)
+        return target_id
+
+    def count(self, entity_class, outcome):
+        with self.lock:
+            self.stats[entity_class.class_name][outcome] += 1
+
+    def loaded(self, entity_class, key, target_id):
+        self.uids.set(entity_class.class_name, key, target_id)
+        self.count(entity_class, 'loaded')
+
+    def failed(self, entity_class, key, message):
+        logger.error(f"Unable to load {entity_class.class_name} {key}: {message}")
+        self.count(entity_class, 'failed')
+
+    def load_class(self, entity_class, filename):
+        logger.info(f"Streaming {entity_class.class_name} from {filename}")
+        for records in class_records(entity_class, filename, self.chunk_size):
+            for record in records:
+                self.load_record(entity_class, record)
+            self.uids.commit()
+            if self.stable_ids:
+                # We only need to hang on to what's still on its way
+                self.inflight = {k: future for k, future in self.inflight.items() if not future.done()}
+
+        # Anything that depends on this class will need its IDs (unless
+        # it can work them out for itself)
+        if not self.stable_ids:
+            self.finish()
+        logger.info(f"{entity_class.class_name}: {dict(self.stats[entity_class.class_name])}")
+
+    def finish(self):
+        """Send whatever is still waiting and wait for it to get there"""
+        if self.submitter is not None:
+            self.submitter.flush()
+        if self.pool is not None:
+            self.pool.wait()
+            self.inflight = {}
+        self.uids.commit()
+
+    def run(self, class_names, files):
+        """class_names are the classes to be loaded, files maps class_name =>
+        transformed file, with 'default' used for any class not listed"""
+        try:
+            # The targets are listed in the order they must be loaded
+            for entity_class in fhir_plugin.all_targets:
+                if entity_class.class_name in class_names:
+                    filename = files.get(entity_class.class_name, files.get('default'))
+                    if filename is not None and Path(filename).is_file():
+                        self.load_class(entity_class, filename)
+            self.finish()
+        finally:
+            self.uids.close()
+        return self.stats
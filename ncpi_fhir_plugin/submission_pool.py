@@ -0,0 +1,88 @@
+"""
+Bounded pool of threads used to keep several requests in flight against the
+FHIR server while the loader carries on building resources.
+
+Each host gets its own pool of workers and each resource class is limited
+to a number of outstanding requests. When a class hits its limit, submit
+blocks until one of its requests finishes, so the loader can never get
+too far ahead of the server. wait() is the barrier used between classes,
+since a class can't be built until the IDs of everything it references
+are known.
+"""
+
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+class SubmissionPool:
+    def __init__(self, max_workers=8, class_limits=None):
+        """class_limits is class_name => maximum requests in flight. Classes
+        not listed get max_workers"""
+        self.max_workers = max_workers
+        self.class_limits = class_limits or {}
+
+        self.executors = {}
+        self.semaphores = {}
+        self.inflight = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def executor(self, host):
+        with self.lock:
+            if host not in self.executors:
+                self.executors[host] = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                          thread_name_prefix=f"submit")
+            return self.executors[host]
+
+    def semaphore(self, class_name):
+        with self.lock:
+            if class_name not in self.semaphores:
+                limit = self.class_limits.get(class_name, self.max_workers)
+                self.semaphores[class_name] = threading.BoundedSemaphore(limit)
+            return self.semaphores[class_name]
+
+    def submit(self, host, class_name, func, *args, **kwargs):
+        """Run func in the background, blocking first if class_name already
+        has as many requests in flight as it's allowed"""
+        semaphore = self.semaphore(class_name)
+        semaphore.acquire()
+        try:
+            future = self.executor(host).submit(func, *args, **kwargs)
+        except:
+            semaphore.release()
+            raise
+
+        with self.lock:
+            self.inflight[class_name].add(future)
+
+        def done(future):
+            semaphore.release()
+            with self.lock:
+                self.inflight[class_name].discard(future)
+            if future.exception() is not None:
+                logger.error(f"{class_name} submission failed: {future.exception()}")
+        future.add_done_callback(done)
+        return future
+
+    def pending(self, class_name=None):
+        with self.lock:
+            if class_name is not None:
+                return len(self.inflight[class_name])
+            return sum([len(x) for x in self.inflight.values()])
+
+    def wait(self, class_name=None):
+        """Block until everything submitted (for class_name, or at all) is done"""
+        with self.lock:
+            if class_name is not None:
+                futures = list(self.inflight[class_name])
+            else:
+                futures = [future for futures in self.inflight.values() for future in futures]
+        wait(futures)
+
+    def shutdown(self):
+        self.wait()
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors = {}
@@ -2,9 +2,15 @@ from fhir_walk.fhir_host import FhirHost
 from fhirwood.identifier import Identifier
 from pprint import pformat
 from requests import RequestException
-from ncpi_fhir_plugin import get_fhir_server
+from ncpi_fhir_plugin import get_fhir_server, get_content_manifest, get_stable_ids, get_load_profile
+from ncpi_fhir_plugin.content_manifest import digest
+from ncpi_fhir_plugin.shared import stable_id
+from ncpi_fhir_plugin.load_profile import profiled
 import sys
 import pdb 
+from collections import defaultdict
+from concurrent.futures import wait
+import threading
 from colorama import init,Fore,Back,Style
 init()
 
@@ -18,6 +24,13 @@ def submit(host, entity_class, body):
     # drop empty fields
     body = {k: v for k, v in body.items() if v not in (None, [], {})}
 
+    # Nothing to do if the server already has this exact resource
+    manifest = get_content_manifest()
+    if manifest is not None:
+        content_hash = digest(body)
+        if manifest.unchanged(entity_class.resource_type, body, content_hash):
+            return body['id']
+
     headers = {}
     verb = "POST"
     api_path = f"{host}/{entity_class.resource_type}"
@@ -31,14 +44,22 @@ def submit(host, entity_class, body):
         headers["Content-Type"] = cheaders["Content-Type"].replace(
             "application/fhir", "application/json-patch"
         )
+    profile = get_load_profile()
+    if profile is not None:
+        profile.sent(entity_class.class_name, body)
+
     #pdb.set_trace()
-    success, result = fhir_server.send_request(
-        verb, api_path, body=body, headers=headers
-    )
+    with profiled(entity_class.class_name, 'request'):
+        success, result = fhir_server.send_request(
+            verb, api_path, body=body, headers=headers
+        )
 
+    # When we assign the IDs ourselves, other resources may already be
+    # pointing at this one, so the server doesn't get to pick a new ID
     if (
         (not success)
         and (verb == "PUT")
+        and (not get_stable_ids())
         and (
             "no resource with this ID exists"
             in result.get("response", {})
@@ -48,11 +69,17 @@ def submit(host, entity_class, body):
     ):
         verb = "POST"
         api_path = f"{host}/{entity_class.resource_type}"
-        success, result = fhir_server.send_request(
-            verb, api_path, body=body, headers=headers
-        )
+        if profile is not None:
+            profile.sent(entity_class.class_name, body)
+            profile.retried(entity_class.class_name)
+        with profiled(entity_class.class_name, 'request'):
+            success, result = fhir_server.send_request(
+                verb, api_path, body=body, headers=headers
+            )
 
     if success:
+        if manifest is not None:
+            manifest.record(entity_class.resource_type, result["response"]["id"], content_hash)
         return result["response"]["id"]
     else:
         print(pformat(body))
@@ -60,6 +87,212 @@ def submit(host, entity_class, body):
             f"Sent {verb} request to {api_path}:\n{pformat(body)}"
             f"\nGot:\n{pformat(result)}"
         )
+def get_target_ids_from_records(entity_class, records, get_target_id_from_record):
+    """Returns the target ID (or None) for each of the records. If whoever
+    handed us get_target_id_from_record can look them all up at once (the
+    StreamingLoader does), we'll let them, otherwise it's one at a time"""
+    owner = getattr(get_target_id_from_record, '__self__', None)
+    bulk = getattr(owner, 'get_target_ids_from_records', None)
+    if bulk is not None:
+        return bulk(entity_class, records)
+    return [get_target_id_from_record(entity_class, record) for record in records]
+
+class BundleSubmitter:
+    """Collects entities and sends them to the server as batch (or transaction)
+    Bundles rather than one request per resource.
+
+    Each entity is added with a callback which receives the ID assigned to it
+    once its bundle has been sent. Only the entries which fail are retried:
+    PUTs for IDs the server doesn't know about are resent as POSTs (just like
+    submit does, and unless the IDs are stable ones) and server side errors
+    are retried up to max_retries times.
+
+    A transaction is all or nothing, so when one fails, its entries are
+    resent as a batch to find out which of them were the problem."""
+
+    retry_statuses = ["429", "500", "502", "503", "504"]
+
+    def __init__(self, host, bundle_size=500, bundle_type="batch", max_retries=2, pool=None):
+        """pool is an optional SubmissionPool to send the bundles from, so
+        that we can keep building the next one while this one is sent"""
+        self.host = host
+        self.bundle_size = bundle_size
+        self.bundle_type = bundle_type
+        self.max_retries = max_retries
+        self.pool = pool
+        self.lock = threading.Lock()
+
+        # resource type => (class_name, key) => entry
+        self.pending = defaultdict(dict)
+        self.requests = 0
+
+        # (class_name, key) => future for the bundle it was sent in, while
+        # that bundle is still on its way
+        self.inflight = {}
+
+    def add(self, entity_class, key, body, on_success, on_failure=None):
+        # drop empty fields
+        body = {k: v for k, v in body.items() if v not in (None, [], {})}
+
+        content_hash = None
+        manifest = get_content_manifest()
+        if manifest is not None:
+            content_hash = digest(body)
+            if manifest.unchanged(entity_class.resource_type, body, content_hash):
+                on_success(body['id'])
+                return
+
+        pending = self.pending[entity_class.resource_type]
+
+        # Should the same entity turn up twice, the server only needs to see
+        # the last version of it
+        pending[(entity_class.class_name, key)] = {
+            'entity_class': entity_class,
+            'body': body,
+            'method': "PUT" if "id" in body else "POST",
+            'hash': content_hash,
+            'on_success': on_success,
+            'on_failure': on_failure
+        }
+
+        if len(pending) >= self.bundle_size:
+            self.flush(entity_class.resource_type)
+
+    def flush(self, resource_type=None):
+        resource_types = [resource_type] if resource_type else list(self.pending.keys())
+        for resource_type in resource_types:
+            pending = self.pending.pop(resource_type, {})
+            entries = list(pending.values())
+            if len(entries) > 0:
+                if self.pool is not None:
+                    future = self.pool.submit(self.host, entries[0]['entity_class'].class_name, self.send, entries, self.bundle_type)
+                    keys = list(pending.keys())
+                    with self.lock:
+                        for key in keys:
+                            self.inflight[key] = future
+                    future.add_done_callback(lambda future, keys=keys: self.sent(keys, future))
+                else:
+                    self.send(entries, self.bundle_type)
+
+    def sent(self, keys, future):
+        with self.lock:
+            for key in keys:
+                # A later bundle may have the same entity by now
+                if self.inflight.get(key) is future:
+                    del self.inflight[key]
+
+    def wait_for(self, class_name, key):
+        """If the entity is in a bundle that is still on its way, wait for the
+        bundle to finish, so that its ID is known before it's built again"""
+        with self.lock:
+            future = self.inflight.get((class_name, key))
+        if future is not None:
+            # If the bundle fell over, the pool has already said so
+            wait([future])
+
+    def bundle_entry(self, item):
+        resource_type = item['entity_class'].resource_type
+        url = resource_type
+        if item['method'] == "PUT":
+            url = f"{resource_type}/{item['body']['id']}"
+        return {
+            "resource": item['body'],
+            "request": {
+                "method": item['method'],
+                "url": url
+            }
+        }
+
+    def send(self, entries, bundle_type, attempt=0):
+        fhir_server = get_fhir_server()
+        bundle = {
+            "resourceType": "Bundle",
+            "type": bundle_type,
+            "entry": [self.bundle_entry(item) for item in entries]
+        }
+
+        with self.lock:
+            self.requests += 1
+
+        # Bundles only ever hold a single resource type, so the first
+        # entry's class is as good as any
+        class_name = entries[0]['entity_class'].class_name
+        profile = get_load_profile()
+        if profile is not None:
+            profile.sent(class_name, bundle)
+        with profiled(class_name, 'request'):
+            success, result = fhir_server.send_request("POST", self.host, body=bundle, headers={})
+
+        if not success:
+            if bundle_type == "transaction":
+                self.retrying(entries)
+                return self.send(entries, "batch", attempt)
+
+            if attempt < self.max_retries:
+                self.retrying(entries)
+                return self.send(entries, bundle_type, attempt + 1)
+
+            for item in entries:
+                self.fail(item, result)
+            return
+
+        retries = []
+        responses = result.get("response", {}).get("entry", [])
+        for item, response in zip(entries, responses):
+            outcome = response.get("response", {})
+            status = str(outcome.get("status", ""))
+            diagnostics = outcome.get("outcome", {}).get("issue", [{}])[0].get("diagnostics", "")
+
+            if status[0:1] == "2":
+                target_id = self.response_id(item, response)
+                manifest = get_content_manifest()
+                if manifest is not None and item['hash'] is not None:
+                    manifest.record(item['entity_class'].resource_type, target_id, item['hash'])
+                item['on_success'](target_id)
+            elif item['method'] == "PUT" and not get_stable_ids() and (status[0:3] == "404" or "no resource with this ID exists" in diagnostics):
+                item['method'] = "POST"
+                retries.append(item)
+            elif status[0:3] in BundleSubmitter.retry_statuses and attempt < self.max_retries:
+                retries.append(item)
+            else:
+                self.fail(item, response)
+
+        # Anything the server didn't give us an answer for gets another go
+        for item in entries[len(responses):]:
+            retries.append(item)
+
+        if len(retries) > 0:
+            if attempt < self.max_retries:
+                self.retrying(retries)
+                self.send(retries, "batch", attempt + 1)
+            else:
+                for item in retries:
+                    self.fail(item, result)
+
+    def retrying(self, entries):
+        profile = get_load_profile()
+        if profile is not None:
+            for item in entries:
+                profile.retried(item['entity_class'].class_name)
+
+    def response_id(self, item, response):
+        if 'resource' in response and 'id' in response['resource']:
+            return response['resource']['id']
+
+        # Location is something like Patient/123/_history/1 and may include the host
+        location = response.get("response", {}).get("location")
+        if location:
+            return location.split("/_history")[0].rstrip("/").split("/")[-1]
+        return item['body'].get('id')
+
+    def fail(self, item, result):
+        message = (f"Sent {item['method']} {item['entity_class'].resource_type} in a bundle:\n{pformat(item['body'])}"
+                    f"\nGot:\n{pformat(result)}")
+        if item['on_failure']:
+            item['on_failure'](message)
+        else:
+            raise RequestException(message)
+
 def submit_(host, entity_class, body):
     global fhir_server
 
@@ -178,6 +411,33 @@ class TargetBase:
                 id_list.add(id)
         return list(id_list)
 
+    @classmethod
+    def prefetch_target_ids(cls, host, page_size=1000):
+        """Pull the id and identifiers for every resource of our type in
+        page_size pages and return identifier => [ids] for our identifier
+        system. This replaces one query_target_ids search per record with a
+        handful of requests up front"""
+        endpoint = cls.resource_type.strip("/")
+        fhir_server = get_fhir_server()
+
+        url = f"{endpoint}?_elements=id,identifier&_count={page_size}"
+        payload = fhir_server.get(url)
+
+        id_lists = defaultdict(set)
+        for entity in payload.entries:
+            resource = entity.get('resource', {})
+            for identifier in resource.get('identifier', []):
+                if identifier.get('system') == cls.identifier_system:
+                    id_lists[identifier.get('value')].add(resource['id'])
+        return {value: list(ids) for value, ids in id_lists.items()}
+
+    @classmethod
+    def stable_target_id(cls, key_components):
+        """The ID the resource gets when we assign IDs ourselves rather than
+        leaving it to the server. It only depends on the identifier, so
+        anything referencing the resource can work it out without asking"""
+        return stable_id(cls.resource_type, key_components['identifier'])
+
     @classmethod
     def submit(cls, host, body):
         return submit(host, cls, body)
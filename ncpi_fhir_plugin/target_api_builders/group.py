@@ -1,11 +1,10 @@
 """
 Builds the FHIR representation for groups 
 """
-from ncpi_fhir_plugin.target_api_builders import TargetBase
+from ncpi_fhir_plugin.target_api_builders import TargetBase, get_target_ids_from_records
 from ncpi_fhir_plugin.shared import join, make_identifier
 from ncpi_fhir_plugin.common import constants, CONCEPT
 from ncpi_fhir_plugin.target_api_builders.ncpi_patient import Patient
-from copy import deepcopy
 
 import pdb
 
@@ -41,24 +40,25 @@ class Group(TargetBase):
         :rtype: list of dicts
         '''
 
+        # Each group's record is the first of its rows with the participants
+        # swapped out. The values are all strings, so there's no need to copy
+        # anything deeper than that. The participants are kept in the order
+        # we first see them so that the members don't shuffle between loads
         altered_records = {}
-        new_record = deepcopy(records_list[0])
-        paricipant_ids = set()
         for row in records_list:
             key = join(
                 row[CONCEPT.STUDY.NAME],
                 row[CONCEPT.STUDY.GROUP.NAME]
             )
             if key not in altered_records:
-                altered_records[key] = deepcopy(row)
-                altered_records[key][CONCEPT.PARTICIPANT.ID] = set()
+                altered_records[key] = {**row, CONCEPT.PARTICIPANT.ID: {}}
 
-            altered_records[key][CONCEPT.PARTICIPANT.ID].add(row[CONCEPT.PARTICIPANT.ID])
+            altered_records[key][CONCEPT.PARTICIPANT.ID][row[CONCEPT.PARTICIPANT.ID]] = None
 
         new_record_list = []
-        for k in altered_records.keys():
-            new_record_list.append(altered_records[k])
-            new_record_list[-1][CONCEPT.PARTICIPANT.ID] = list(new_record_list[-1][CONCEPT.PARTICIPANT.ID])
+        for record in altered_records.values():
+            record[CONCEPT.PARTICIPANT.ID] = list(record[CONCEPT.PARTICIPANT.ID])
+            new_record_list.append(record)
         
         return new_record_list
 
@@ -71,17 +71,17 @@ class Group(TargetBase):
         #pdb.set_trace()
 
         patients = []
-        fake_row = {
-            CONCEPT.PARTICIPANT.ID: "",
+        fake_rows = [{
+            CONCEPT.PARTICIPANT.ID: id,
             CONCEPT.STUDY.NAME: record[CONCEPT.STUDY.NAME]
-        }
+        } for id in record[CONCEPT.PARTICIPANT.ID]]
 
         unmatched_ids = []
         #pdb.set_trace()
-        # We'll need patient references for each of our participants
-        for id in record[CONCEPT.PARTICIPANT.ID]:
-            fake_row[CONCEPT.PARTICIPANT.ID] = id
-            patient_id = get_target_id_from_record(Patient, fake_row)
+        # We'll need patient references for each of our participants, which
+        # we look up all at once
+        patient_ids = get_target_ids_from_records(Patient, fake_rows, get_target_id_from_record)
+        for id, patient_id in zip(record[CONCEPT.PARTICIPANT.ID], patient_ids):
             if patient_id is not None:
                 patients.append(f"Patient/{patient_id}")
             else:
@@ -11,7 +11,6 @@ from ncpi_fhir_plugin.target_api_builders.ncpi_patient import Patient
 from ncpi_fhir_plugin.target_api_builders.disease import Disease
 from ncpi_fhir_plugin.target_api_builders import TargetBase
 
-from copy import deepcopy
 import pdb
 
 # https://www.hl7.org/fhir/valueset-observation-interpretation.html
@@ -111,64 +110,71 @@ class HumanPhenotype(TargetBase):
 
     @classmethod 
     def transform_records_list(cls, records_list):
+        """Rows for the same participant, phenotype and observation are merged
+        into a single record with each of their codings in CODE. Every row
+        still gets an entry in the list we return (the merged record for
+        those with a phenotype), so it lines up with records_list.
+
+        This is done in a single pass. Each merged record is appended as soon
+        as its group is seen and picks up the rest of its codings as we go.
+        Rather than copying it, the group's first row becomes the merged
+        record (it just gains CODE), and identical codings share a single
+        dict. Nothing downstream changes them, so there is no reason to build
+        thousands of copies of the same HPO coding"""
         altered_records = []
 
         # We'll capture the rows associated with a single
         # disease_id and aggregate the codings as we encounter
         # them
         with_codings = {}
+        codings = {}
+
+        # These get looked up for every row
+        study_col = CONCEPT.STUDY.NAME
+        participant_col = CONCEPT.PARTICIPANT.ID
+        hpo_col = CONCEPT.PHENOTYPE.ID
+        observed_col = CONCEPT.PHENOTYPE.OBSERVED
+        name_col = CONCEPT.DIAGNOSIS.NAME
+        description_col = CONCEPT.DIAGNOSIS.DESCRIPTION
+        system_col = CONCEPT.DIAGNOSIS.SYSTEM
+        code_col = CONCEPT.DIAGNOSIS.DISEASE_CODE
 
         for record in records_list:
-            if CONCEPT.PHENOTYPE.ID in record and record[CONCEPT.PHENOTYPE.ID].strip() != "":
-                id = join(
-                    record[CONCEPT.STUDY.NAME],
-                    record[CONCEPT.PARTICIPANT.ID],
-                    record[CONCEPT.PHENOTYPE.ID],
-                    record[CONCEPT.PHENOTYPE.OBSERVED]
-                )
-
-                display = record.get(CONCEPT.DIAGNOSIS.NAME)
-                if display is None or display.strip() == "":
-                    display = record.get(CONCEPT.DIAGNOSIS.DESCRIPTION)
-                if id in with_codings:
-                    #pdb.set_trace()
-                    with_codings[id]['CODE'].append({
-                        'display': display
-                    })
-                    system =  record.get(CONCEPT.DIAGNOSIS.SYSTEM)
-                    code = record.get(CONCEPT.DIAGNOSIS.DISEASE_CODE)
-                    if system is not None and system.strip() != "":
-                        with_codings[id]['CODE'][-1]['system'] = system
-                    if code is not None and code.strip() != "":
-                        with_codings[id]['CODE'][-1]['code'] = code
-
-                else:
-                    #pdb.set_trace()
-                    with_codings[id] = deepcopy(record)
-                    with_codings[id]['CODE'] = [{
-                        'display': display
-                    }]
-                    system =  record.get(CONCEPT.DIAGNOSIS.SYSTEM)
-                    code = record.get(CONCEPT.DIAGNOSIS.DISEASE_CODE)
-
-                    if system is not None and system.strip() != "":
-                        with_codings[id]['CODE'][-1]['system'] = system
-
-                    if code is not None and code.strip() != "":
-                        with_codings[id]['CODE'][-1]['code'] = code
-
+            hpo_id = record.get(hpo_col)
+            if hpo_id is None or hpo_id.strip() == "":
+                altered_records.append(record)
+                continue
 
-        for record in records_list:
-            if CONCEPT.PHENOTYPE.ID in record and record[CONCEPT.PHENOTYPE.ID].strip() != "":
-                id = join(
-                record[CONCEPT.STUDY.NAME],
-                record[CONCEPT.PARTICIPANT.ID],
-                record[CONCEPT.PHENOTYPE.ID],
-                record[CONCEPT.PHENOTYPE.OBSERVED]
+            id = join(
+                record[study_col],
+                record[participant_col],
+                hpo_id,
+                record[observed_col]
             )
-                altered_records.append(with_codings[id])
-            else:
-                altered_records.append(record)
+
+            display = record.get(name_col)
+            if display is None or display.strip() == "":
+                display = record.get(description_col)
+            system = record.get(system_col)
+            code = record.get(code_col)
+
+            coding_key = (display, system, code)
+            coding = codings.get(coding_key)
+            if coding is None:
+                coding = {'display': display}
+                if system is not None and system.strip() != "":
+                    coding['system'] = system
+                if code is not None and code.strip() != "":
+                    coding['code'] = code
+                codings[coding_key] = coding
+
+            merged = with_codings.get(id)
+            if merged is None:
+                merged = record
+                merged['CODE'] = []
+                with_codings[id] = merged
+            merged['CODE'].append(coding)
+            altered_records.append(merged)
         return altered_records
 
     @classmethod
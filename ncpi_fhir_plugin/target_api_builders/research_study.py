@@ -15,9 +15,8 @@ from ncpi_model_forge.ingest_plugin.target_api_builders.practitioner import (
 )"""
 from ncpi_fhir_plugin.shared import join, make_identifier
 from ncpi_fhir_plugin.common import constants, CONCEPT
-from ncpi_fhir_plugin.target_api_builders import TargetBase
+from ncpi_fhir_plugin.target_api_builders import TargetBase, get_target_ids_from_records
 from ncpi_fhir_plugin.target_api_builders.group import Group
-from copy import deepcopy
 import pdb
 
 class ResearchStudy(TargetBase):
@@ -49,21 +48,22 @@ class ResearchStudy(TargetBase):
         :rtype: list of dicts
         '''
 
+        # Like Group, a shallow copy of the first row is all we need, and the
+        # groups stay in the order we first see them
         altered_records = {}
         for row in records_list:
             key = join(
                 row[CONCEPT.STUDY.NAME]
             )
             if key not in altered_records:
-                altered_records[key] = deepcopy(row)
-                altered_records[key][CONCEPT.STUDY.GROUP.NAME] = set()
+                altered_records[key] = {**row, CONCEPT.STUDY.GROUP.NAME: {}}
 
-            altered_records[key][CONCEPT.STUDY.GROUP.NAME].add(row[CONCEPT.STUDY.GROUP.NAME])
+            altered_records[key][CONCEPT.STUDY.GROUP.NAME][row[CONCEPT.STUDY.GROUP.NAME]] = None
 
         new_record_list = []
-        for k in altered_records.keys():
-            new_record_list.append(altered_records[k])
-            new_record_list[-1][CONCEPT.STUDY.GROUP.NAME] = list(new_record_list[-1][CONCEPT.STUDY.GROUP.NAME])
+        for record in altered_records.values():
+            record[CONCEPT.STUDY.GROUP.NAME] = list(record[CONCEPT.STUDY.GROUP.NAME])
+            new_record_list.append(record)
         
         return new_record_list
 
@@ -83,16 +83,17 @@ class ResearchStudy(TargetBase):
 
         unmatched_ids = []
         group_refs = []
-        for group in record.get(CONCEPT.STUDY.GROUP.NAME):
-            fake_row = {
-                CONCEPT.STUDY.NAME: study_name,
-                CONCEPT.STUDY.GROUP.NAME: group
-            }
-            group_id = get_target_id_from_record(Group, fake_row)
+        groups = record.get(CONCEPT.STUDY.GROUP.NAME)
+        fake_rows = [{
+            CONCEPT.STUDY.NAME: study_name,
+            CONCEPT.STUDY.GROUP.NAME: group
+        } for group in groups]
+        group_ids = get_target_ids_from_records(Group, fake_rows, get_target_id_from_record)
+        for group, group_id in zip(groups, group_ids):
             if group_id is not None:
                 group_refs.append(f"Group/{group_id}")
             else:
-                unmatched_ids.append(id)
+                unmatched_ids.append(group)
         if len(unmatched_ids) > 0:
             print(sorted(unmatched_ids))
             print("Unmatched IDs for Research Study enrollment")
@@ -1,18 +1,26 @@
 #!/usr/bin/env python
 
 import csv
+import sys
 from os import getenv
 
 from yaml import safe_load
 from argparse import ArgumentParser, FileType
 from pathlib import Path
 from collections import defaultdict
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import shutil
 import cmg_transform.tools
 from cmg_transform.tools.term_lookup import pull_details, write_cache, remote_calls
+import cmg_transform.tools.term_lookup as term_lookup
 
 from ncpi_fhir_plugin.common import CONCEPT, constants
 
 from cmg_transform.tools.variant_details import Variant
+from cmg_transform.tools.variant_annotator import VariantAnnotator, annotate_variants
+from cmg_transform.tools.genenames import Gene
 
 from cmg_transform import Transform, InvalidID
 from cmg_transform.discovery_variant import DiscoveryVariant
@@ -23,6 +31,7 @@ from cmg_transform.consent import ConsentGroup
 from cmg_transform.specimen import Specimen
 
 from cmg_transform.change_logger import ChangeLog
+from cmg_transform.delta import RowDelta, ReplayedDisease, ReplayedVariant, record_disease, record_variant
 
 import pdb
 
@@ -32,11 +41,263 @@ import pdb
 # is part of the filename, at least for broad's contributions to terra. We may need
 # to tolerate that...)
 
-def Run(output, study_name, dataset, delim=None):
+# Each of the transformed files in the order they are written. These are also 
+# the files that get merged back together from shards when running in parallel
+output_files = [
+    "consent_groups.tsv",
+    "subject.tsv",
+    "disease.tsv",
+    "hpo.tsv",
+    "specimen.tsv",
+    "sequencing.tsv",
+    "discovery_variant.tsv",
+    "discovery_report.tsv"
+]
+
+# The columns identifying rows the loader aggregates into a single resource,
+# which must all end up in the delta together. ResearchStudy gathers every
+# group, so any change to consent_groups.tsv means all of it.
+delta_keys = {
+    "consent_groups.tsv": [CONCEPT.STUDY.NAME],
+    "subject.tsv": [CONCEPT.PARTICIPANT.ID],
+    "disease.tsv": [CONCEPT.PARTICIPANT.ID],
+    "hpo.tsv": [CONCEPT.PARTICIPANT.ID],
+    "specimen.tsv": None,
+    "sequencing.tsv": None,
+    "discovery_variant.tsv": None,
+    "discovery_report.tsv": [CONCEPT.PARTICIPANT.ID]
+}
+
+def OpenWriters(stack, output):
+    """Opens each of the output files and writes their headers. Files are registered
+    with the stack so that they are closed when it is"""
+    writers = {}
+    for filename in output_files:
+        f = stack.enter_context(open(output / filename, 'wt'))
+        writers[filename] = csv.writer(f, delimiter='\t', quotechar='"')
+
+    ConsentGroup.write_default_header(writers['consent_groups.tsv'])
+    Patient.write_default_header(writers['subject.tsv'])
+    Disease.write_header(writers['disease.tsv'])
+    Disease.hpo_write_header(writers['hpo.tsv'])
+    Specimen.write_default_header(writers['specimen.tsv'])
+    Sequencing.write_header(writers['sequencing.tsv'])
+    DiscoveryVariant.writeheader(writers['discovery_variant.tsv'])
+    writers['discovery_report.tsv'].writerow([
+            CONCEPT.STUDY.NAME,
+            CONCEPT.PARTICIPANT.ID,
+            CONCEPT.DISCOVERY.VARIANT.ID
+    ])
+    return writers
+
+def LoadConsentMaps(consent, verbose=True):
+    """The maps are cumulative, so each consent group sees those of the groups before it, too"""
+    if 'field_map' in consent:
+        Transform.LoadFieldMap(consent['field_map'])
+        if verbose:
+            print(Transform._field_map)
+
+    if 'data_map' in consent:
+        Transform.LoadDataMap(consent['data_map'])
+        if verbose:
+            print(Transform._data_map)
+            print(Transform._data_transform)
+
+    if 'invalid-ids' in consent:
+        Transform.LoadInvalidIDs(consent['invalid-ids'])
+        if verbose:
+            print(Transform._invalid_ids)
+
+def GetDelimiter(dataset):
     if "delim" not in dataset:
-        delim = "\t"
+        return "\t"
+    return dataset['delim']
+
+def TransformConsentGroup(study_name, dataset, consent_name, writers, study_group, delim, engine='row'):
+    consent = dataset['consent-groups'][consent_name]
+    study_title = dataset['study_title']
+    study_id = dataset['study_id']
+
+    wconsent = writers['consent_groups.tsv']
+    wsubject = writers['subject.tsv']
+    wdisease = writers['disease.tsv']
+    whpo = writers['hpo.tsv']
+    wspecemin = writers['specimen.tsv']
+    wsequencing = writers['sequencing.tsv']
+    wdisc_var = writers['discovery_variant.tsv']
+    wdisc_rep = writers['discovery_report.tsv']
+
+    # We need a way to point back to the family when we parse our specimen file
+    family_lkup = {}
+
+    # There is currently no reference to the proband from parent rows, so we 
+    # need to define that. 
+    proband_relationships = defaultdict(dict)           # parent_id => "relationship" => proband_id 
+
+    LoadConsentMaps(consent)
+
+    # When running incrementally, unchanged rows are replayed from last time
+    delta = RowDelta._instance
+    if delta is not None:
+        delta.begin(study_name, consent_name)
+
+    consent_group = ConsentGroup(study_name, study_title=study_title, study_id=study_id, group_name=consent_name, consent_name=consent_name)
+
+    drs_ids = {}
+    if 'drs' in consent:
+        with open(consent['drs'], 'rt') as file:
+            reader = csv.DictReader(file, delimiter='\t', quotechar='"')
+
+            for row in reader:
+                locals = dict(zip(row['filenames'].split(","), row['object_id'].split(",")))
+                for fn in locals.keys():
+                    drs_ids[fn] = locals[fn]
+
+    if engine == 'columnar':
+        # Lazy import, since the row engine shouldn't require pandas
+        from cmg_transform.columnar import SubjectTable
+
+        subjects = SubjectTable(consent['subject'], delim, family_lkup, proband_relationships)
+        subjects.write_subjects(study_name, wsubject, proband_relationships)
+        subjects.write_diseases(study_name, wdisease)
+        subjects.hpo_writerows(study_name, whpo)
     else:
-        delim = dataset['delim']
+        # Parents can appear before their proband, so the first pass only 
+        # collects the family and proband relationships. The second does
+        # the actual work, writing each row as it goes, so that we never 
+        # need to hold onto the whole study's patients and diseases
+        with open(consent['subject'], 'rt', encoding='utf-8-sig') as file:
+            Transform._cur_filename = 'subject'
+            reader = Transform.GetReader(file, delimiter=delim, verbose=False)
+            for line in reader:
+                Patient.index(line, family_lkup, proband_relationships)
+
+        with open(consent['subject'], 'rt', encoding='utf-8-sig') as file:
+            Transform._cur_filename = 'subject'
+            try:
+                reader = Transform.GetReader(file, delimiter=delim)
+            except:
+                pdb.set_trace()
+                print(f"There was an issue with loading data from the file, {consent['subject']}")
+                reader = Transform.GetReader(file, delimiter=delim)
+
+            Transform._linenumber = 1
+            for line in reader:
+                Transform._linenumber += 1
+                p = Patient(line, family_lkup)
+                p.write_default(study_name, wsubject, proband_relationships)
+
+                if delta is not None:
+                    subject_id = Transform.CleanSubjectId(line['subject_id'])
+                    replay_key = delta.observe('subject', subject_id, line, family_lkup.get(subject_id))
+                    outputs = delta.replay(replay_key)
+                    if outputs is None:
+                        outputs = record_disease(Disease(line, family_lkup), study_name)
+                        delta.store(replay_key, outputs)
+                    d = ReplayedDisease(outputs)
+                else:
+                    d = Disease(line, family_lkup)
+
+                # Each of these is its own file, so the rows still end up in
+                # the same order they always have
+                d.writerow(study_name, wdisease)
+                d.hpo_writerow(study_name, whpo)
+
+    seq_centers = {}        # Capture the sequencing centers to add to 
+                            # our sequencing output
+    subj_id = {}            # There are some datasets where there is no
+                            # subject ID in the sequencing file
+    with open(consent['sample'], 'rt', encoding='utf-8-sig') as file:
+        Transform._cur_filename = 'sample'
+        reader = Transform.GetReader(file, file_type='sample', delimiter=delim)
+
+        Transform._linenumber = 1
+        for line in reader:
+            try:
+                Transform.CheckForBadIDs(line)
+                Transform._linenumber += 1
+                if delta is not None:
+                    delta.observe('sample', line.get('sample_id'), line)
+                # We skip over samples that exist twice--a side effect
+                # of concatting wgs onto the the wes data
+                if not Specimen.is_duplicate(line):
+                    s = Specimen(line, consent_name, family_lkup, subj_id)
+                    if s.sample_provider:
+                        seq_centers[s.sample_id] = s.sample_provider
+                    consent_group.add_patient(s.id, s.sample_provider)
+                    study_group.add_patient(s.id, s.sample_provider, fail_on_seq_center=False)
+                    s.write_row(study_name, wspecemin)
+            except InvalidID as error:
+                print(repr(error))
+        consent_group.write_data(wconsent)
+        
+    with open(consent['sequencing'], 'rt', encoding='utf-8-sig') as file:
+        reader = Transform.GetReader(file, file_type='sequencing', delimiter=delim)
+        
+        Transform._linenumber = 1
+        for row in reader:
+            try:
+                Transform.CheckForBadIDs(row)
+                Transform._linenumber += 1
+                if delta is not None:
+                    delta.observe('sequencing', row.get('sample_id') or row.get('cram_or_bam_path'), row)
+                seq = Sequencing(row, seq_centers, subj_id)
+                seq.write_row(study_name, wsequencing, drs_ids)
+            except InvalidID as error:
+                print(repr(error))
+    if "discovery" in consent:
+        with open(consent['discovery'], 'rt', encoding='utf-8-sig') as file:
+            Transform._cur_filename = 'discovery'
+            reader = Transform.GetReader(file, delimiter=delim)
+
+            # subject_id => [variant_id, ...]
+            variants = defaultdict(list)
+            Transform._linenumber = 1
+            discovery_variants = []
+            replay_keys = {}
+            for row in reader:
+                Transform._linenumber += 1
+                if delta is not None:
+                    replay_key = delta.observe('discovery', None, row, Sequencing.genome_builds.get(row['sample_id']))
+                    outputs = delta.replay(replay_key)
+                    if outputs is not None:
+                        discovery_variants.append(ReplayedVariant(outputs))
+                        continue
+                    replay_keys[len(discovery_variants)] = replay_key
+                discovery_variants.append(DiscoveryVariant(row, annotate=False))
+
+            # Resolve the genes and pull down the details for all of the 
+            # variants at once
+            fresh_variants = [var for var in discovery_variants if isinstance(var, DiscoveryVariant)]
+            Gene.resolve([var.gene for var in fresh_variants])
+            for var in fresh_variants:
+                var.resolve_gene()
+            annotate_variants(fresh_variants, **VariantAnnotator.settings)
+
+            for index, replay_key in replay_keys.items():
+                outputs = record_variant(discovery_variants[index], study_name)
+                delta.store(replay_key, outputs)
+                discovery_variants[index] = ReplayedVariant(outputs)
+
+            for var in discovery_variants:
+                if var.writerow(wdisc_var, study_name):
+                    var.add_variant_ids(variants)
+
+            for id in variants.keys():
+                wdisc_rep.writerow([study_name, id, "::".join(variants[id])])
+
+    if delta is not None:
+        delta.end()
+
+def Run(output, study_name, dataset, delim=None, engine='row', workers=1):
+    delim = GetDelimiter(dataset)
+
+    # The ontologies can be opened while we work through the CSV files
+    warming = term_lookup.warm_up()
+    if workers > 1 and len(dataset['consent-groups']) > 1:
+        # Any stale indexes get rebuilt here, once, rather than by every worker
+        warming.join()
+        return RunParallel(output, study_name, dataset, delim, engine, workers)
 
     study_title = dataset['study_title']
     study_id = dataset['study_id']
@@ -44,163 +305,180 @@ def Run(output, study_name, dataset, delim=None):
     study_group = ConsentGroup(study_name, study_title=study_title, study_id=study_id, group_name=f"{study_name}-complete", consent_name=None)
 
     # We'll dump consents for each group as they are parsed then the entire study
-    fconsent = open(output /"consent_groups.tsv", 'wt')
-    wconsent = csv.writer(fconsent, delimiter='\t', quotechar='"')
-    ConsentGroup.write_default_header(wconsent)
-
-    with open(output / "subject.tsv", 'wt') as subf, \
-            open(output / "disease.tsv", 'wt') as disf, \
-            open(output / "hpo.tsv", 'wt') as hpof, \
-            open(output / "specimen.tsv", 'wt') as specf, \
-            open(output / "sequencing.tsv", 'wt') as seqf, \
-            open(output / "discovery_variant.tsv", 'wt') as discf, \
-            open(output / "discovery_report.tsv", 'wt') as disrf:
-
-        wsubject = csv.writer(subf, delimiter='\t', quotechar='"')
-        Patient.write_default_header(wsubject)
-
-        wdisease = csv.writer(disf, delimiter='\t', quotechar='"')
-        Disease.write_header(wdisease)
-
-        whpo = csv.writer(hpof, delimiter='\t', quotechar='"')
-        Disease.hpo_write_header(whpo)
-
-        wspecemin = csv.writer(specf, delimiter='\t', quotechar='"')        
-        Specimen.write_default_header(wspecemin)
-
-        wsequencing = csv.writer(seqf, delimiter='\t', quotechar='"')
-        Sequencing.write_header(wsequencing)
-
-        wdisc_var = csv.writer(discf, delimiter='\t', quotechar='"')
-        DiscoveryVariant.writeheader(wdisc_var)
-
-        wdisc_rep = csv.writer(disrf, delimiter='\t', quotechar='"')
-        wdisc_rep.writerow([
-                CONCEPT.STUDY.NAME,
-                CONCEPT.PARTICIPANT.ID,
-                CONCEPT.DISCOVERY.VARIANT.ID
-        ])
+    with ExitStack() as stack:
+        writers = OpenWriters(stack, output)
+
         for consent_name in dataset['consent-groups'].keys():
-            consent = dataset['consent-groups'][consent_name]
-            # We need a way to point back to the family when we parse our specimen file
-            family_lkup = {}
-
-            # There is currently no reference to the proband from parent rows, so we 
-            # need to define that. 
-            proband_relationships = defaultdict(dict)           # parent_id => "relationship" => proband_id 
-
-            if 'field_map' in consent:
-                Transform.LoadFieldMap(consent['field_map'])
-                print(Transform._field_map)
-
-            if 'data_map' in consent:
-                Transform.LoadDataMap(consent['data_map'])
-                print(Transform._data_map)
-                print(Transform._data_transform)
-
-            if 'invalid-ids' in consent:
-                Transform.LoadInvalidIDs(consent['invalid-ids'])
-                print(Transform._invalid_ids)
-
-            consent_group = ConsentGroup(study_name, study_title=study_title, study_id=study_id, group_name=consent_name, consent_name=consent_name)
-
-            drs_ids = {}
-            if 'drs' in consent:
-                with open(consent['drs'], 'rt') as file:
-                    reader = csv.DictReader(file, delimiter='\t', quotechar='"')
-
-                    for row in reader:
-                        locals = dict(zip(row['filenames'].split(","), row['object_id'].split(",")))
-                        for fn in locals.keys():
-                            drs_ids[fn] = locals[fn]
-
-            diseases = []
-            with open(consent['subject'], 'rt', encoding='utf-8-sig') as file:
-                Transform._cur_filename = 'subject'
+            TransformConsentGroup(study_name, dataset, consent_name, writers, study_group, delim, engine)
+        study_group.write_data(writers['consent_groups.tsv'])
+
+class StudyMembership:
+    """Stands in for the study's ConsentGroup inside of a worker. The calls are 
+    replayed against the real study group during the merge so that they end 
+    up in the same order they would have been made serially"""
+    def __init__(self):
+        self.patients = []
+
+    def add_patient(self, participant_id, seq_center, fail_on_seq_center=True):
+        self.patients.append((participant_id, seq_center, fail_on_seq_center))
+
+def ScanConsentGroups(dataset, delim):
+    """Serially, each consent group can see the samples and genome builds 
+    from those groups that came before it. This collects just enough of 
+    that state so that each group can be transformed in isolation.
+
+    Returns a list of (observed sample IDs, genome builds) for each group"""
+    priors = []
+    observed = set()
+    genome_builds = {}
+
+    for consent_name in dataset['consent-groups'].keys():
+        consent = dataset['consent-groups'][consent_name]
+        priors.append((set(observed), dict(genome_builds)))
+        LoadConsentMaps(consent, verbose=False)
+
+        with open(consent['sample'], 'rt', encoding='utf-8-sig') as file:
+            reader = Transform.GetReader(file, file_type='sample', delimiter=delim)
+            for line in reader:
                 try:
-                    reader = Transform.GetReader(file, delimiter=delim)
-                except:
-                    pdb.set_trace()
-                    print(f"There was an issue with loading data from the file, {consent['subject']}")
-                    reader = Transform.GetReader(file, delimiter=delim)
-
-                peeps = []
-                Transform._linenumber = 1
-                for line in reader:
-                    Transform._linenumber += 1
-                    p = Patient(line, family_lkup, proband_relationships)
-                    peeps.append(p)
-
-                    d = Disease(line, family_lkup)
-                    diseases.append(d)
-                # Just in case the pedigree data isn't in order
-                for p in peeps:
-                    p.write_default(study_name, wsubject, proband_relationships)
-
-            # Diseases
-            for d in diseases:
-                d.writerow(study_name, wdisease)
-            
-            # Human Phenotypes
-            for d in diseases:
-                d.hpo_writerow(study_name, whpo)
+                    Transform.CheckForBadIDs(line)
+                    if not Specimen.is_duplicate(line, observed):
+                        observed.add(Specimen.key_for(line))
+                except InvalidID as error:
+                    pass
+
+        with open(consent['sequencing'], 'rt', encoding='utf-8-sig') as file:
+            reader = Transform.GetReader(file, file_type='sequencing', delimiter=delim)
+            for row in reader:
+                try:
+                    Transform.CheckForBadIDs(row)
+                except InvalidID as error:
+                    continue
+                sample_id = Sequencing.key_for(row)
+                build = Transform.GetValue(row, 'reference_genome_build')
+                if sample_id is not None and build is not None:
+                    genome_builds[sample_id] = build
+    return priors
+
+def TransformShard(shard_dir, study_name, dataset, group_index, observed, genome_builds, delim, engine, log_changes, log_dir, log_batch_size, annotator_settings, delta_dir=None, log_backend="sqlite"):
+    """Runs in a worker process, transforming a single consent group into shard files"""
+    consent_names = list(dataset['consent-groups'].keys())
+
+    # Bring the class level state up to where it would be had we run the
+    # prior groups serially
+    for consent_name in consent_names[0:group_index]:
+        LoadConsentMaps(dataset['consent-groups'][consent_name], verbose=False)
+    Specimen.observed = observed
+    Sequencing.genome_builds = genome_builds
+    VariantAnnotator.settings = annotator_settings
+    term_lookup.warm_up()
+
+    ChangeLog._active_log = log_changes
+    ChangeLog._backend = log_backend
+    ChangeLog.InitDB(log_dir, study_name, purge_priors=False, batch_size=log_batch_size)
+    if delta_dir is not None:
+        RowDelta.InitDB(delta_dir)
+
+    term_cache = {term_type: set(term_lookup.cache[term_type].keys()) for term_type in term_lookup.cache}
+
+    membership = StudyMembership()
+    with ExitStack() as stack:
+        writers = OpenWriters(stack, shard_dir)
+        TransformConsentGroup(study_name, dataset, consent_names[group_index], writers, membership, delim, engine)
+    ChangeLog.Close()
+    replayed = RowDelta._instance.replayed if RowDelta._instance else 0
+    RowDelta.Close()
+
+    # Only hand back what this worker learned so that the parent can fold it
+    # into the caches it saves at the end. The variant cache is shared, so
+    # it's already been written.
+    return {
+        'patients': membership.patients,
+        'terms': {term_type: {k: v for k, v in term_lookup.cache[term_type].items() if k not in term_cache[term_type]} for term_type in term_lookup.cache},
+        'broken_terms': term_lookup.broken_terms,
+        'unmatched': {constobj: dict(normalizer.misses) for constobj, normalizer in Transform._normalizers.items()},
+        'memo': dict(Transform.MemoStats()),
+        'replayed': replayed
+    }
+
+def RunParallel(output, study_name, dataset, delim, engine, workers):
+    """Transform each consent group in it's own process and merge the shards back 
+    together in the order the groups appear in the dataset config"""
+    study_title = dataset['study_title']
+    study_id = dataset['study_id']
+    study_group = ConsentGroup(study_name, study_title=study_title, study_id=study_id, group_name=f"{study_name}-complete", consent_name=None)
 
-            seq_centers = {}        # Capture the sequencing centers to add to 
-                                    # our sequencing output
-            subj_id = {}            # There are some datasets where there is no
-                                    # subject ID in the sequencing file
-            with open(consent['sample'], 'rt', encoding='utf-8-sig') as file:
-                Transform._cur_filename = 'sample'
-                reader = Transform.GetReader(file, file_type='sample', delimiter=delim)
-
-                Transform._linenumber = 1
-                for line in reader:
-                    try:
-                        Transform.CheckForBadIDs(line)
-                        Transform._linenumber += 1
-                        # We skip over samples that exist twice--a side effect
-                        # of concatting wgs onto the the wes data
-                        if line['sample_id'] not in Specimen.observed:
-                            s = Specimen(line, consent_name, family_lkup, subj_id)
-                            if s.sample_provider:
-                                seq_centers[s.sample_id] = s.sample_provider
-                            consent_group.add_patient(s.id, s.sample_provider)
-                            study_group.add_patient(s.id, s.sample_provider, fail_on_seq_center=False)
-                            s.write_row(study_name, wspecemin)
-                    except InvalidID as error:
-                        print(repr(error))
-                consent_group.write_data(wconsent)
-                
-            with open(consent['sequencing'], 'rt', encoding='utf-8-sig') as file:
-                reader = Transform.GetReader(file, file_type='sequencing', delimiter=delim)
-                
-                Transform._linenumber = 1
-                for row in reader:
-                    try:
-                        Transform.CheckForBadIDs(row)
-                        Transform._linenumber += 1
-                        seq = Sequencing(row, seq_centers, subj_id)
-                        seq.write_row(study_name, wsequencing, drs_ids)
-                    except InvalidID as error:
-                        print(repr(error))
-            if "discovery" in consent:
-                with open(consent['discovery'], 'rt', encoding='utf-8-sig') as file:
-                    Transform._cur_filename = 'discovery'
-                    reader = Transform.GetReader(file, delimiter=delim)
-
-                    # subject_id => [variant_id, ...]
-                    variants = defaultdict(list)
-                    Transform._linenumber = 1
-                    for row in reader:
-                        Transform._linenumber += 1
-                        var = DiscoveryVariant(row)
-                        if var.writerow(wdisc_var, study_name):
-                            var.add_variant_ids(variants)
-
-                    for id in variants.keys():
-                        wdisc_rep.writerow([study_name, id, "::".join(variants[id])])
-    study_group.write_data(wconsent)
-    fconsent.close()
+    priors = ScanConsentGroups(dataset, delim)
+
+    # The workers will be writing to the change log, too, so we can't be 
+    # sitting on an open transaction (such as the purge)
+    if ChangeLog._instance:
+        ChangeLog._instance.commit()
+
+    # Each worker gets an even share of the API's rate limit
+    annotator_settings = dict(VariantAnnotator.settings)
+    annotator_settings['rate'] = VariantAnnotator.settings['rate'] / workers
+
+    shard_root = output / "shards"
+    shard_dirs = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        jobs = []
+        for group_index, consent_name in enumerate(dataset['consent-groups'].keys()):
+            shard_dir = shard_root / f"{group_index:04}"
+            shard_dir.mkdir(parents=True, exist_ok=True)
+            shard_dirs.append(shard_dir)
+
+            observed, genome_builds = priors[group_index]
+            jobs.append(pool.submit(TransformShard, 
+                                        shard_dir, 
+                                        study_name, 
+                                        dataset, 
+                                        group_index, 
+                                        observed, 
+                                        genome_builds, 
+                                        delim, 
+                                        engine, 
+                                        ChangeLog._active_log,
+                                        ChangeLog._instance.log_dir if ChangeLog._instance else None,
+                                        ChangeLog._instance.batch_size if ChangeLog._instance else None,
+                                        annotator_settings,
+                                        RowDelta._instance.filename.parent if RowDelta._instance else None,
+                                        ChangeLog._backend))
+
+        # Results are consumed in group order, regardless of which finishes first
+        results = [job.result() for job in jobs]
+
+    for result in results:
+        for (participant_id, seq_center, fail_on_seq_center) in result['patients']:
+            study_group.add_patient(participant_id, seq_center, fail_on_seq_center=fail_on_seq_center)
+        for term_type in result['terms']:
+            term_lookup.cache[term_type].update(result['terms'][term_type])
+        term_lookup.broken_terms.update(result['broken_terms'])
+        for constobj in result['unmatched']:
+            for rawval, count in result['unmatched'][constobj].items():
+                Transform.Normalizer(constobj).misses[rawval] += count
+        for fieldname, (hits, misses) in result['memo'].items():
+            Transform._memo_stats[fieldname][0] += hits
+            Transform._memo_stats[fieldname][1] += misses
+        if RowDelta._instance:
+            RowDelta._instance.replayed += result['replayed']
+
+    MergeShards(output, shard_dirs, study_group)
+    shutil.rmtree(shard_root)
+
+def MergeShards(output, shard_dirs, study_group):
+    for filename in output_files:
+        with open(output / filename, 'wt', newline='') as outf:
+            for index, shard_dir in enumerate(shard_dirs):
+                with open(shard_dir / filename, 'rt', newline='') as shard:
+                    header = shard.readline()
+                    # Every shard has the same header, so we only need the first
+                    if index == 0:
+                        outf.write(header)
+                    shutil.copyfileobj(shard, outf)
+
+            if filename == "consent_groups.tsv":
+                study_group.write_data(csv.writer(outf, delimiter='\t', quotechar='"'))
 
 if __name__ == "__main__":
     # Some files may end up going in a directory corresponding to the environment
@@ -214,22 +492,87 @@ if __name__ == "__main__":
                 help=f"Dataset config to be used",
                 action='append')
     parser.add_argument("-o", "--out", default='output')
+    parser.add_argument("-l",
+                "--log-changes",
+                action='store_true',
+                help="Record each value before and after transformation in the change-log database")
+    parser.add_argument("--log-backend",
+                choices=['sqlite', 'parquet'],
+                default='sqlite',
+                help="Where --log-changes writes: the change-log.db sqlite database or dictionary encoded Parquet files under change-log/ (requires pyarrow: pip install cmg-ingest[parquet])")
+    parser.add_argument("--log-batch-size",
+                type=int,
+                default=ChangeLog._batch_size,
+                help="Number of change-log rows to queue before writing them to the database")
+    parser.add_argument("-w",
+                "--workers",
+                type=int,
+                default=1,
+                help="Number of processes used to transform consent groups in parallel")
+    parser.add_argument("--engine",
+                choices=['row', 'columnar'],
+                default='row',
+                help="Transform the subject file one row at a time or as whole columns (requires pandas)")
+    parser.add_argument("--variant-rate",
+                type=float,
+                default=VariantAnnotator.settings['rate'],
+                help="Maximum number of variant API requests per second")
+    parser.add_argument("--variant-concurrency",
+                type=int,
+                default=VariantAnnotator.settings['concurrency'],
+                help="Maximum number of variant API requests in flight at once")
+    parser.add_argument("--delta",
+                action='store_true',
+                help="Only transform rows that changed since the last run and write .delta.tsv/.deleted.tsv files (relative to the last 02_cmg_load.py --delta) alongside the full outputs. Replayed rows aren't counted in the broken terms or unmatched constants reports")
     args = parser.parse_args()
 
+    if args.delta and args.log_changes:
+        parser.error("--delta can't be used with --log-changes, since rows that are replayed wouldn't be logged")
+    if args.delta and args.engine == 'columnar':
+        parser.error("--delta can't be used with --engine columnar, since the columnar engine doesn't record the subject rows it transforms")
+
+    VariantAnnotator.settings['rate'] = args.variant_rate
+    VariantAnnotator.settings['concurrency'] = args.variant_concurrency
+
+    ChangeLog._active_log = args.log_changes
+    ChangeLog._backend = args.log_backend
+
     for dsfile in sorted(args.dataset):
         study = safe_load(dsfile)
         study_name = study['study_name'].replace(' ', '_')
         dirname = Path(f"{args.out}/{study_name}/transformed")
         dirname.mkdir(parents=True, exist_ok=True)
-        ChangeLog.InitDB(args.out, study_name, purge_priors=True)
+        ChangeLog.InitDB(args.out, study_name, purge_priors=True, batch_size=args.log_batch_size)
+
+        if args.delta:
+            RowDelta.InitDB(dirname)
+
+        Run(dirname, study_name, study, engine=args.engine, workers=args.workers)
 
-        Run(dirname, study_name, study)
+        print(f"Value memo hits for {study_name} (field, hits, misses, hit rate):")
+        Transform.MemoReport(csv.writer(sys.stdout, delimiter='\t'))
+        Transform.ResetMemoStats()
+
+        # The reports read from the summary rather than the full log
+        if ChangeLog._instance:
+            ChangeLog._instance.summarize()
+
+        if args.delta:
+            delta = RowDelta._instance
+            delta.prune(study['consent-groups'].keys())
+            delta.write_deltas(dirname, delta_keys)
+            print(f"{delta.replayed} unchanged rows replayed")
+            RowDelta.Close()
 
     # Write the term cache to file since the API can sometimes be unresponsive
     write_cache()
 
     print(f"Total calls to remote api {remote_calls}")
 
-    # Make sure the cache is saved
+    # Let the user know about values that were quietly dropped because they
+    # didn't match any of the constants
+    Transform.UnmatchedReport(csv.writer(sys.stdout, delimiter='\t'))
+
+    # Variants are saved as they are found, but just in case
     Variant.cache.commit()
     ChangeLog.Close()
\ No newline at end of file
@@ -12,6 +12,12 @@ from kf_lib_data_ingest.etl.load.load import LoadStage
 from ncpi_fhir_client.fhir_client import FhirClient
 
 import ncpi_fhir_plugin as fhir # import SetAuthorization, remote_authorization
+from ncpi_fhir_plugin.stream_load import StreamingLoader
+from ncpi_fhir_plugin.target_api_builders import BundleSubmitter
+from ncpi_fhir_plugin.submission_pool import SubmissionPool
+from ncpi_fhir_plugin.content_manifest import ContentManifest
+from ncpi_fhir_plugin.ndjson_export import NdjsonExporter
+from ncpi_fhir_plugin.load_profile import LoadProfile
 
 import pdb
 
@@ -71,20 +77,86 @@ if __name__ == "__main__":
                 "--purge-ids",
                 action='store_true',
                 help="Purge the ID cache. Use only the database has been rebuilt and it's contents look different from when this was last run.")
+    parser.add_argument("-f",
+                "--force",
+                action='store_true',
+                help="Submit every resource, even those that haven't changed since they were last loaded")
+    parser.add_argument("-x",
+                "--export",
+                metavar="DIR",
+                help="Don't load anything. Write each resource type to DIR/<study>/<type>.ndjson.gz (Bulk Data layout) instead")
+    parser.add_argument("--delta",
+                action='store_true',
+                help="Load only the .delta.tsv files written by an incremental transform. Once everything has loaded, the next transform's deltas will be relative to these")
+    parser.add_argument("-s",
+                "--stream",
+                action='store_true',
+                help="Read the transformed files in chunks, submitting resources as they are built, rather than loading everything up front")
+    parser.add_argument("--chunk-size",
+                type=int,
+                default=1000,
+                help="Number of rows to read at a time when streaming")
+    parser.add_argument("--bundle-size",
+                type=int,
+                default=0,
+                help="When streaming, send resources in Bundles of this many entries rather than one at a time")
+    parser.add_argument("--bundle-type",
+                choices=['batch', 'transaction'],
+                default='batch',
+                help="Type of Bundle used when --bundle-size is set")
+    parser.add_argument("--prefetch-size",
+                type=int,
+                default=1000,
+                help="When streaming, page size used to pull down existing identifiers for each resource type (0 searches for each record instead)")
+    parser.add_argument("--workers",
+                type=int,
+                default=1,
+                help="When streaming, number of requests (or bundles) to keep in flight at once")
+    parser.add_argument("--stable-ids",
+                action='store_true',
+                help="When streaming, derive each resource's ID from its identifier and always PUT, rather than letting the server assign them. The server must accept client assigned IDs")
+    parser.add_argument("--profile",
+                action='store_true',
+                help="Time each class's builders, lookups and requests and write the results next to the log as JSON and CSV")
+    parser.add_argument("--progress",
+                action='store_true',
+                help="Show a running progress line for the class being loaded (implies --profile)")
+    parser.add_argument("--class-limit",
+                action='append',
+                default=[],
+                help="Cap the requests in flight for a single class, as class_name=N (can be used more than once)")
     args = parser.parse_args()
 
+    if args.bundle_size > 0 and not args.stream:
+        parser.error("--bundle-size requires --stream")
+    if args.workers > 1 and not args.stream:
+        parser.error("--workers requires --stream")
+    if args.stable_ids and not args.stream:
+        parser.error("--stable-ids requires --stream")
+
+    class_limits = {}
+    for limit in args.class_limit:
+        class_name, _, count = limit.partition("=")
+        if not count.isdigit() or int(count) < 1:
+            parser.error(f"--class-limit should look like class_name=N, not {limit}")
+        class_limits[class_name] = int(count)
+
     list_of_class_names_to_load = args.modules_to_load
     if len(list_of_class_names_to_load) == 0:
         list_of_class_names_to_load = all_loadable_classes
 
     #pdb.set_trace()
-    fhir_host = FhirClient(config[args.env])
-    fhir.set_fhir_server(fhir_host)
+    # Exports never talk to the server
+    fhir_host = None
+    if not args.export:
+        fhir_host = FhirClient(config[args.env])
+        fhir.set_fhir_server(fhir_host)
+        fhir.set_stable_ids(args.stable_ids)
     
     datasets = args.dataset 
 
     path_to_my_target_service_plugin = "ncpi_fhir_plugin/fhir_plugin.py"
-    target_service_base_url = fhir_host.target_service_url
+    target_service_base_url = fhir_host.target_service_url if fhir_host else None
  
     for dsfile in datasets:
         study = safe_load(dsfile)
@@ -107,7 +179,8 @@ if __name__ == "__main__":
                                 level=logging.DEBUG)
 
         logging.info(f"Does this work? We tried to write to a file named {log_filename}")
-        fhir_host.init_log()
+        if fhir_host:
+            fhir_host.init_log()
         input_file_dir = f"{args.out}/{study_name}/transformed"
         path_to_cache_storage_directory = Path(f"{input_file_dir}/{args.env}")
         path_to_cache_storage_directory.mkdir(parents=True, exist_ok=True)
@@ -117,52 +190,137 @@ if __name__ == "__main__":
             print(f"Purging local cache: {cache_file}")
             remove(cache_file)
 
-        if args.write_bundle:
-            fhir_host.init_bundle(f"{args.out}/{study_id}-{args.env}.json", study_id)
+            for cache_file in [StreamingLoader.cache_filename(path_to_cache_storage_directory, study_id),
+                               ContentManifest.manifest_filename(path_to_cache_storage_directory, study_id)]:
+                if cache_file.is_file():
+                    print(f"Purging local cache: {cache_file}")
+                    remove(cache_file)
 
-        specimens = read_df(f'{input_file_dir}/specimen.tsv')
-        consents = read_df(f'{input_file_dir}/consent_groups.tsv')
-        subjects = read_df(f'{input_file_dir}/subject.tsv')
-        disease = read_df(f'{input_file_dir}/disease.tsv')
-        hpo = read_df(f'{input_file_dir}/hpo.tsv')
-        sequencing_data = read_df(f'{input_file_dir}/sequencing.tsv')
-        
-        basic_reports = {
-            "default": subjects,
-            'research_study': consents,
-            'consent': consents,
-            'group': consents,
-            'research_subject': specimens,
-            'tissue_affected_status': specimens,
-            'sequencing_center': specimens,
-            "family_relationship": subjects,
-            "disease": disease,
-            "specimen": specimens,
-            'human_phenotype': hpo,
-            'sequencing_file': sequencing_data,
-            'sequencing_file_no_drs': sequencing_data,
-            'sequencing_data': sequencing_data,
-            "sequencing_file_info": sequencing_data,           
-        }
-        offs = {    
+        # class_name => transformed file. Anything not listed here is
+        # loaded from the default
+        report_files = {
+            "default": 'subject.tsv',
+            'research_study': 'consent_groups.tsv',
+            'consent': 'consent_groups.tsv',
+            'group': 'consent_groups.tsv',
+            'research_subject': 'specimen.tsv',
+            'tissue_affected_status': 'specimen.tsv',
+            'sequencing_center': 'specimen.tsv',
+            "family_relationship": 'subject.tsv',
+            "disease": 'disease.tsv',
+            "specimen": 'specimen.tsv',
+            'human_phenotype': 'hpo.tsv',
+            'sequencing_file': 'sequencing.tsv',
+            'sequencing_file_no_drs': 'sequencing.tsv',
+            'sequencing_data': 'sequencing.tsv',
+            "sequencing_file_info": 'sequencing.tsv',
+            'discovery_variant': 'discovery_variant.tsv',
+            'discovery_implication': 'discovery_variant.tsv',
+            'discovery_report': 'discovery_report.tsv'
         }
-        if Path(f"{input_file_dir}/discovery_variant.tsv").is_file():
-            discovery_variant = read_df(f"{input_file_dir}/discovery_variant.tsv") 
+        if args.delta:
+            # Written by 01-cmg-transform.py --delta with just the rows that
+            # changed since the previous transform
+            report_files = {class_name: filename.replace(".tsv", ".delta.tsv") for class_name, filename in report_files.items()}
+        report_files = {class_name: f"{input_file_dir}/{filename}" for class_name, filename in report_files.items()}
+
+        # The discovery files are optional
+        for class_name in ['discovery_variant', 'discovery_implication', 'discovery_report']:
+            if not Path(report_files[class_name]).is_file():
+                report_files[class_name] = None
+
+        if args.export:
+            export_dir = Path(args.export) / study_name
+            print(f"Exporting to {export_dir}")
+            exporter = NdjsonExporter(export_dir, study_id, chunk_size=args.chunk_size)
+            stats = exporter.run(list_of_class_names_to_load, report_files)
+            for class_name in stats:
+                seconds = exporter.timings[class_name]
+                rate = sum(stats[class_name].values()) / seconds if seconds > 0 else 0
+                print(f"{class_name}: {dict(stats[class_name])} ({rate:.0f} records/s)")
+            continue
 
-            basic_reports['discovery_variant'] = discovery_variant
-            basic_reports["discovery_implication"] = discovery_variant
+        # Resources that haven't changed since the last load are skipped
+        manifest = ContentManifest(ContentManifest.manifest_filename(path_to_cache_storage_directory, study_id), 
+                                   force=args.force)
+        fhir.set_content_manifest(manifest)
+
+        profile = None
+        if args.profile or args.progress:
+            profile = LoadProfile(progress=args.progress)
+            fhir.set_load_profile(profile)
+
+        if args.write_bundle:
+            fhir_host.init_bundle(f"{args.out}/{study_id}-{args.env}.json", study_id)
 
-        if Path(f"{input_file_dir}/discovery_report.tsv").is_file():
-            discovery_report = read_df(f"{input_file_dir}/discovery_report.tsv")
+        failures = 0
+        if args.stream:
+            pool = None
+            if args.workers > 1:
+                pool = SubmissionPool(max_workers=args.workers, class_limits=class_limits)
+            submitter = None
+            if args.bundle_size > 0:
+                submitter = BundleSubmitter(target_service_base_url, 
+                                            bundle_size=args.bundle_size, 
+                                            bundle_type=args.bundle_type,
+                                            pool=pool)
+            try:
+                stats = StreamingLoader(
+                    target_service_base_url,
+                    study_id,
+                    path_to_cache_storage_directory,
+                    chunk_size=args.chunk_size,
+                    submitter=submitter,
+                    pool=pool,
+                    prefetch_size=args.prefetch_size,
+                    stable_ids=args.stable_ids
+                ).run(list_of_class_names_to_load, report_files)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+            for class_name in stats:
+                print(f"{class_name}: {dict(stats[class_name])}")
+                failures += stats[class_name]['failed']
+            if submitter is not None:
+                print(f"{submitter.requests} bundles sent")
+        else:
+            # Each file only needs to be read once, even if it's used by
+            # several classes
+            dataframes = {}
+            basic_reports = {}
+            for class_name, filename in report_files.items():
+                if filename is not None:
+                    if filename not in dataframes:
+                        dataframes[filename] = read_df(filename)
+                    basic_reports[class_name] = dataframes[filename]
 
-            basic_reports["discovery_report"] = discovery_report
+            outcome = LoadStage(
+                path_to_my_target_service_plugin,
+                target_service_base_url,
+                list_of_class_names_to_load,
+                study_id,
+                str(path_to_cache_storage_directory)
+            ).run(basic_reports)
 
-        outcome = LoadStage(
-            path_to_my_target_service_plugin,
-            target_service_base_url,
-            list_of_class_names_to_load,
-            study_id,
-            str(path_to_cache_storage_directory)
-        ).run(basic_reports)
+        print(f"{manifest.skipped} unchanged resources skipped")
 
+        delta_db = Path(input_file_dir) / "delta.db"
+        if args.delta and delta_db.is_file():
+            if failures > 0:
+                print(f"{failures} resources failed to load, the next delta will include these changes again")
+            else:
+                # Lazy import, since nothing else here needs the transforms
+                from cmg_transform.delta import RowDelta
+                delta = RowDelta(input_file_dir)
+                delta.loaded()
+                delta.db.close()
+        fhir.set_content_manifest(None)
+        if profile is not None:
+            profile.print_summary()
+            profile_filename = f"{args.out}/{study_name}-{args.env}-load-profile"
+            profile.write_json(f"{profile_filename}.json")
+            profile.write_csv(f"{profile_filename}.csv")
+            print(f"Load profile: {profile_filename}.json (and .csv)")
+            fhir.set_load_profile(None)
+        manifest.close()
         fhir_host.close_bundle()
\ No newline at end of file
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark comparing the compiled constant normalizer used by
+Transform.CleanVar against the original getattr/AttributeError implementation.
+
+Values are drawn with roughly the same mix we see in CMG subject files: mostly
+valid entries with a handful of alt transforms and some that don't match
+anything at all (which are defaulted to empty).
+"""
+
+import csv
+import sys
+import random
+from argparse import ArgumentParser
+from timeit import default_timer as timer
+
+from ncpi_fhir_plugin.common import constants
+from cmg_transform import Transform
+
+def legacy_clean_var(constobj, rawval, default_to_empty=False):
+    """This is the implementation of CleanVar prior to the lookup tables"""
+    val = rawval
+
+    if val is None or val.strip() == "":
+        return None
+
+    if constobj == constants.DISCOVERY.VARIANT.CHROMOSOME:
+        if val in Transform._raw_chroms:
+            val = f"Chr{val}"
+
+    if val is not None:
+        propname = val.strip().upper().replace(" ", "_")
+        try:
+            propname = getattr(constobj, propname)
+            return propname
+        except AttributeError as e:
+            if constobj in Transform._alt_transforms:
+                if val in Transform._alt_transforms[constobj]:
+                    return Transform._alt_transforms[constobj][val]
+
+            if default_to_empty:
+                return ""
+            # Building the message is part of the original cost
+            message = f"Unmatched entry, {propname}. Viable choices include: {', '.join([x for x in dir(constobj) if x[0] != '_']) }\n"
+            raise e
+    return None
+
+samples = {
+    constants.RACE: ["White", "Black or African American", "Asian", "Unknown", "white", "Not Reported", "Other", "", "Martian"],
+    constants.GENDER: ["Male", "Female", "male", " Female ", "Unknown", "Intersex", "", "X"],
+    constants.AFFECTED_STATUS: ["Affected", "Unaffected", "Unknown", "", "Possibly affected", "Other", "Kinda"],
+    constants.RELATIONSHIP: ["Proband", "Mother", "Father", "Sibling", "mother's cousin #2", "Brother", "", "Neighbor"],
+    constants.DISCOVERY.VARIANT.CHROMOSOME: [str(x) for x in range(1, 23)] + ['X', 'Y', 'chr1', 'M'],
+    constants.DISCOVERY.VARIANT.SIGNIFICANCE: ["Pathogenic", "Likely pathogenic", "Benign", "Uncertain significance", "VUS"],
+}
+
+def run(func, values):
+    start = timer()
+    results = []
+    for constobj, val in values:
+        results.append(func(constobj, val, True))
+    return timer() - start, results
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-n",
+                "--cells",
+                type=int,
+                default=1000000,
+                help="Number of values to normalize")
+    parser.add_argument("-s", "--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    constobjs = list(samples.keys())
+    values = []
+    for i in range(args.cells):
+        constobj = random.choice(constobjs)
+        values.append((constobj, random.choice(samples[constobj])))
+
+    legacy_time, legacy_results = run(legacy_clean_var, values)
+    compiled_time, compiled_results = run(Transform.CleanVar, values)
+
+    assert legacy_results == compiled_results, "The compiled normalizer disagrees with the original"
+    print(f"{args.cells} cells")
+    print(f"Original CleanVar : {legacy_time:.3f}s")
+    print(f"Compiled CleanVar : {compiled_time:.3f}s ({legacy_time / compiled_time:.1f}x)")
+    print("Unmatched values:")
+    Transform.UnmatchedReport(csv.writer(sys.stdout, delimiter='\t'))
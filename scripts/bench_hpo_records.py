@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+Benchmark comparing HumanPhenotype.transform_records_list against the original
+two pass, deepcopy based implementation on a synthetic hpo.tsv.
+
+The file mirrors what 01-cmg-transform.py writes: a handful of phenotypes per
+participant, present or absent, with the occasional phenotype coded more than
+once (which is what gets merged into a single Condition). Each implementation
+is run on its own copy of the records and timed, then run again under
+tracemalloc to find the peak memory used on top of the records themselves
+(tracing slows everything down too much to time them at the same time).
+"""
+
+import csv
+import random
+import tracemalloc
+from argparse import ArgumentParser
+from copy import deepcopy
+from pathlib import Path
+from timeit import default_timer as timer
+
+import pandas as pd
+
+from ncpi_fhir_plugin.common import CONCEPT, constants
+from ncpi_fhir_plugin.shared import join
+from ncpi_fhir_plugin.target_api_builders.hpo_observation import HumanPhenotype
+
+def legacy_transform_records_list(records_list):
+    """This is the implementation of transform_records_list prior to the single pass"""
+    altered_records = []
+    with_codings = {}
+
+    for record in records_list:
+        if CONCEPT.PHENOTYPE.ID in record and record[CONCEPT.PHENOTYPE.ID].strip() != "":
+            id = join(
+                record[CONCEPT.STUDY.NAME],
+                record[CONCEPT.PARTICIPANT.ID],
+                record[CONCEPT.PHENOTYPE.ID],
+                record[CONCEPT.PHENOTYPE.OBSERVED]
+            )
+
+            display = record.get(CONCEPT.DIAGNOSIS.NAME)
+            if display is None or display.strip() == "":
+                display = record.get(CONCEPT.DIAGNOSIS.DESCRIPTION)
+            if id in with_codings:
+                with_codings[id]['CODE'].append({
+                    'display': display
+                })
+                system =  record.get(CONCEPT.DIAGNOSIS.SYSTEM)
+                code = record.get(CONCEPT.DIAGNOSIS.DISEASE_CODE)
+                if system is not None and system.strip() != "":
+                    with_codings[id]['CODE'][-1]['system'] = system
+                if code is not None and code.strip() != "":
+                    with_codings[id]['CODE'][-1]['code'] = code
+            else:
+                with_codings[id] = deepcopy(record)
+                with_codings[id]['CODE'] = [{
+                    'display': display
+                }]
+                system =  record.get(CONCEPT.DIAGNOSIS.SYSTEM)
+                code = record.get(CONCEPT.DIAGNOSIS.DISEASE_CODE)
+
+                if system is not None and system.strip() != "":
+                    with_codings[id]['CODE'][-1]['system'] = system
+
+                if code is not None and code.strip() != "":
+                    with_codings[id]['CODE'][-1]['code'] = code
+
+    for record in records_list:
+        if CONCEPT.PHENOTYPE.ID in record and record[CONCEPT.PHENOTYPE.ID].strip() != "":
+            id = join(
+            record[CONCEPT.STUDY.NAME],
+            record[CONCEPT.PARTICIPANT.ID],
+            record[CONCEPT.PHENOTYPE.ID],
+            record[CONCEPT.PHENOTYPE.OBSERVED]
+        )
+            altered_records.append(with_codings[id])
+        else:
+            altered_records.append(record)
+    return altered_records
+
+def write_hpo(filename, rows, seed):
+    """Writes a synthetic hpo.tsv with (roughly) rows rows"""
+    random.seed(seed)
+    terms = [f"HP:{x:07}" for x in range(1, 5000)]
+    with open(filename, 'wt', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', quotechar='"')
+        writer.writerow([
+            CONCEPT.FAMILY.ID,
+            CONCEPT.PARTICIPANT.ID,
+            CONCEPT.STUDY.NAME,
+            CONCEPT.PHENOTYPE.ID,
+            CONCEPT.DIAGNOSIS.NAME,
+            CONCEPT.PHENOTYPE.OBSERVED,
+            CONCEPT.DIAGNOSIS.SYSTEM,
+            CONCEPT.DIAGNOSIS.DISEASE_CODE])
+
+        written = 0
+        participant = 0
+        while written < rows:
+            participant += 1
+            for i in range(random.randint(1, 12)):
+                hpo = random.choice(terms)
+                observed = random.choice([constants.PHENOTYPE.OBSERVED.PRESENT, constants.PHENOTYPE.OBSERVED.ABSENT])
+                # Every so often, the same phenotype is coded twice
+                for j in range(1 if random.random() < 0.9 else 2):
+                    writer.writerow([
+                        f"fam{participant // 3}",
+                        f"p{participant}",
+                        "SYNTHETIC",
+                        hpo,
+                        f"name of {hpo}",
+                        observed,
+                        "http://purl.obolibrary.org/obo/hp.owl",
+                        hpo
+                    ])
+                    written += 1
+
+def run(func, df):
+    records = df.to_dict('records')
+    start = timer()
+    results = func(records)
+    elapsed = timer() - start
+
+    records = df.to_dict('records')
+    tracemalloc.start()
+    func(records)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, results
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-n",
+                "--rows",
+                type=int,
+                default=1000000,
+                help="Number of rows in the synthetic hpo.tsv")
+    parser.add_argument("-f",
+                "--filename",
+                default="synthetic_hpo.tsv",
+                help="Where to write the synthetic file (it's reused if it's already there)")
+    parser.add_argument("-s", "--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not Path(args.filename).is_file():
+        write_hpo(args.filename, args.rows, args.seed)
+
+    # The same way the streaming loader reads them
+    df = pd.read_csv(args.filename, sep='\t', dtype=str, na_filter=False)
+
+    legacy_time, legacy_peak, legacy_results = run(legacy_transform_records_list, df)
+    current_time, current_peak, current_results = run(HumanPhenotype.transform_records_list, df)
+
+    assert legacy_results == current_results, "The single pass transform disagrees with the original"
+    print(f"{len(df)} rows, {len(set([id(x) for x in current_results]))} phenotypes")
+    print(f"Original transform_records_list : {legacy_time:.3f}s, peak {legacy_peak / 1048576:.1f} MiB")
+    print(f"Single pass                     : {current_time:.3f}s ({legacy_time / current_time:.1f}x), peak {current_peak / 1048576:.1f} MiB")
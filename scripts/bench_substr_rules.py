@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Benchmark comparing the compiled SUBSTR data map rules (SubstrRules) against
+the original loop, which tested each of a field's rules against each cell in
+turn.
+
+The rules are synthetic misspellings (a couple of characters dropped from a
+random word) and the cells are a few random words each, some of which contain
+one or more of the misspellings. Rules are often substrings of one another
+and a cell can contain more than one, so the results are compared to make
+sure the first rule found still wins. Both are run without the MapValue memo,
+since the cells are (nearly) all different anyway.
+"""
+
+import random
+import string
+from argparse import ArgumentParser
+from timeit import default_timer as timer
+
+from cmg_transform import SubstrRules
+
+def legacy_apply(rules, val):
+    """This is how ApplyMaps used to handle the SUBSTR rules"""
+    for err in rules.keys():
+        if err in val:
+            return val.replace(err, rules[err]).strip()
+    return None
+
+def random_word(min_len=4, max_len=12):
+    return "".join(random.choice(string.ascii_lowercase) for i in range(random.randint(min_len, max_len)))
+
+def build_rules(count):
+    rules = {}
+    while len(rules) < count:
+        word = random_word(6, 14)
+        start = random.randint(0, 2)
+        err = word[start:start + random.randint(3, len(word) - start)]
+        rules[err] = word.upper()
+    return rules
+
+def build_cells(count, rules, hit_rate):
+    errs = list(rules.keys())
+    cells = []
+    for i in range(count):
+        words = [random_word() for j in range(random.randint(1, 5))]
+        if random.random() < hit_rate:
+            for j in range(random.randint(1, 2)):
+                words.insert(random.randint(0, len(words)), random.choice(errs))
+        cells.append(" ".join(words))
+    return cells
+
+def run(func, cells):
+    start = timer()
+    results = [func(val) for val in cells]
+    return timer() - start, results
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-r",
+                "--rules",
+                type=int,
+                default=500,
+                help="Number of SUBSTR rules for the field")
+    parser.add_argument("-n",
+                "--cells",
+                type=int,
+                default=1000000,
+                help="Number of cells to rewrite")
+    parser.add_argument("--hit-rate",
+                type=float,
+                default=0.2,
+                help="Fraction of the cells which contain at least one of the rules")
+    parser.add_argument("-s", "--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    rules = build_rules(args.rules)
+    cells = build_cells(args.cells, rules, args.hit_rate)
+
+    start = timer()
+    compiled = SubstrRules(rules)
+    compile_time = timer() - start
+
+    legacy_time, legacy_results = run(lambda val: legacy_apply(rules, val), cells)
+    current_time, current_results = run(compiled.apply, cells)
+
+    assert legacy_results == current_results, "The compiled rules disagree with the original loop"
+    print(f"{len(rules)} rules, {len(cells)} cells, {sum(x is not None for x in current_results)} rewritten")
+    print(f"Original loop    : {legacy_time:.3f}s")
+    print(f"Compiled rules   : {current_time:.3f}s ({legacy_time / current_time:.1f}x), plus {compile_time * 1000:.1f}ms to compile {len(compiled.goto)} states")
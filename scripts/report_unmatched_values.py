@@ -28,6 +28,10 @@ if __name__ == "__main__":
                 action='append')
     parser.add_argument("-m", "--min-missing", type=int, default=10, help='Filter out values with % missingness greater than this value')
     parser.add_argument("-o", "--out", default='output', help="Directory where the database is to be found")
+    parser.add_argument("--backend", 
+                choices=['sqlite', 'parquet'], 
+                default='sqlite', 
+                help="Which change log to report on (see 01-cmg-transform.py --log-backend)")
     args = parser.parse_args()
 
     datasets = args.dataset 
@@ -35,11 +39,18 @@ if __name__ == "__main__":
     if 'ALL' in datasets:
         datasets = ds_options
 
+    # Otherwise, the change log won't open the database
+    ChangeLog._active_log = True
+
+    if args.backend == 'parquet':
+        from cmg_transform.parquet_change_log import ParquetReport
+        report = ParquetReport(args.out)
+
     report_header = True
     for study in sorted(datasets):
-        cur = ChangeLog.InitDB(args.out, study, purge_priors=False)
-
-        report = Report(cur)
+        if args.backend == 'sqlite':
+            cur = ChangeLog.InitDB(args.out, study, purge_priors=False)
+            report = Report(cur)
 
         report.summarize(study, args.min_missing, report_header)
         report_header =False
@@ -17,5 +17,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
+    # Table.group_by with count_distinct arrived in pyarrow 7
+    extras_require={"parquet": ["pyarrow >= 7.0.0"]},
     scripts=["scripts/01-cmg-transform.py", "scripts/02_cmg_load.py"],
 )
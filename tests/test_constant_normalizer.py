@@ -0,0 +1,108 @@
+import pytest
+
+from ncpi_fhir_plugin.common import constants
+from cmg_transform import Transform, ConstantNormalizer
+
+def legacy_clean_var(constobj, rawval, default_to_empty=False):
+    """This is Transform.CleanVar prior to the ConstantNormalizer"""
+    val = rawval
+
+    if val is None or val.strip() == "":
+        return None
+
+    if constobj == constants.DISCOVERY.VARIANT.CHROMOSOME:
+        if val in Transform._raw_chroms:
+            val = f"Chr{val}"
+
+    propname = val.strip().upper().replace(" ", "_")
+    try:
+        return getattr(constobj, propname)
+    except AttributeError as e:
+        if constobj in Transform._alt_transforms:
+            if val in Transform._alt_transforms[constobj]:
+                return Transform._alt_transforms[constobj][val]
+
+        if default_to_empty:
+            return ""
+        raise e
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+constant_classes = [
+    constants.GENDER,
+    constants.RACE,
+    constants.ETHNICITY,
+    constants.RELATIONSHIP,
+    constants.AFFECTED_STATUS,
+    constants.PHENOTYPE.OBSERVED,
+    constants.COMMON,
+    constants.DISCOVERY.VARIANT.CHROMOSOME
+]
+
+def raw_values(constobj):
+    """The constants' own values along with the sort of case and whitespace
+    variations we see in the CMG files"""
+    values = [None, "", "   ", "not a real value", "Not A Real Value"]
+    for propname in dir(constobj):
+        if propname[0] != '_':
+            value = getattr(constobj, propname)
+            if isinstance(value, str):
+                values += [value, value.lower(), value.upper(), f"  {value} "]
+            values += [propname, propname.lower(), propname.lower().replace("_", " ")]
+    values += list(Transform._alt_transforms.get(constobj, {}).keys())
+    values += Transform._raw_chroms
+    return values
+
+def normalizer(constobj):
+    return ConstantNormalizer(constobj, Transform._alt_transforms.get(constobj, {}))
+
+@pytest.mark.parametrize("constobj", constant_classes, ids=lambda x: x.__name__)
+def test_normalizer_matches_legacy(constobj):
+    norm = normalizer(constobj)
+
+    # Twice, so that the second time around comes from the lookup
+    for attempt in range(2):
+        for rawval in raw_values(constobj):
+            try:
+                expected = legacy_clean_var(constobj, rawval)
+            except AttributeError:
+                with pytest.raises(AttributeError):
+                    norm.normalize(rawval)
+                assert norm.normalize(rawval, True) == "", f"Unmatched {rawval!r} should default to empty"
+                continue
+
+            assert norm.normalize(rawval) == expected, f"Does {rawval!r} still resolve to {expected!r}?"
+            assert norm.normalize(rawval, True) == expected
+
+def test_unmatched_report_order():
+    norm = normalizer(constants.GENDER)
+    unmatched = ["zebra", "  Apple", "mango", "apple", "mango", "zebra", "mango"]
+    for rawval in unmatched:
+        assert norm.normalize(rawval, True) == ""
+
+    # The matches aren't reported at all
+    norm.normalize("Female")
+
+    writer = ListWriter()
+    norm.report(writer)
+    assert writer.rows == [
+        [constants.GENDER.__name__, "  Apple", 1],
+        [constants.GENDER.__name__, "apple", 1],
+        [constants.GENDER.__name__, "mango", 3],
+        [constants.GENDER.__name__, "zebra", 2]
+    ], "Unmatched values are reported in sorted order with how often they were seen"
+
+def test_unmatched_counted_when_raised():
+    norm = normalizer(constants.RACE)
+    for attempt in range(3):
+        with pytest.raises(AttributeError):
+            norm.normalize("Martian")
+
+    writer = ListWriter()
+    norm.report(writer)
+    assert writer.rows == [[constants.RACE.__name__, "Martian", 3]]
@@ -0,0 +1,123 @@
+import csv
+import sqlite3
+
+import pytest
+
+from cmg_transform.delta import RowDelta
+
+outputs = {'disease': [["fam1", "s1", "OMIM:123"]], 'hpo': []}
+
+def run(output, consent, rows, kind='subject', key='subject_id'):
+    """Observe the rows the way a transform would, storing the outputs for
+    anything that can't be replayed. Returns (replayed, stored)"""
+    delta = RowDelta(output)
+    delta.begin("FAKE-CMG", consent)
+    replayed = 0
+    stored = 0
+    for row in rows:
+        replay_key = delta.observe(kind, row.get(key), row)
+        if delta.replay(replay_key) is None:
+            delta.store(replay_key, outputs)
+            stored += 1
+        else:
+            replayed += 1
+    delta.end()
+    delta.db.close()
+    return replayed, stored
+
+def test_unchanged_rows_are_replayed(tmp_path):
+    rows = [{'subject_id': 's1', 'sex': 'Male'}, {'subject_id': 's2', 'sex': 'Female'}]
+    assert run(tmp_path, "GRP1", rows) == (0, 2), "Nothing to replay the first time"
+    assert run(tmp_path, "GRP1", rows) == (2, 0), "Everything is replayed the second time"
+
+    rows[1]['sex'] = 'Male'
+    assert run(tmp_path, "GRP1", rows) == (1, 1), "Only the changed row is transformed again"
+
+def test_replay_returns_stored_outputs(tmp_path):
+    row = {'subject_id': 's1'}
+    run(tmp_path, "GRP1", [row])
+
+    delta = RowDelta(tmp_path)
+    delta.begin("FAKE-CMG", "GRP1")
+    assert delta.replay(delta.observe('subject', 's1', row)) == outputs
+    assert delta.replayed == 1
+
+def test_stored_outputs_wait_for_end(tmp_path):
+    delta = RowDelta(tmp_path)
+    delta.begin("FAKE-CMG", "GRP1")
+    replay_key = delta.observe('subject', 's1', {'subject_id': 's1'})
+    delta.store(replay_key, outputs)
+
+    # Nothing has been written yet, so another worker can still get in
+    other = sqlite3.connect(tmp_path / "delta.db", timeout=0)
+    other.execute("INSERT INTO replays VALUES ('other', '{}')")
+    other.commit()
+    other.close()
+
+    # But the outputs are available to the rest of the consent group
+    assert delta.replay(replay_key) == outputs
+
+    delta.end()
+    stored = delta.db.execute("SELECT count(*) FROM replays WHERE replay_key=?", (replay_key,)).fetchone()[0]
+    assert stored == 1, "The outputs are written at the end"
+
+def test_duplicate_keys(tmp_path, capsys):
+    rows = [{'subject_id': 's1', 'sex': 'Male'}, {'subject_id': 's1', 'sex': 'Female'}]
+    run(tmp_path, "GRP1", rows)
+
+    db = sqlite3.connect(tmp_path / "delta.db")
+    keys = sorted(key for (key,) in db.execute("SELECT key FROM inputs WHERE consent='GRP1'"))
+    assert keys == ["s1", "s1#2"], "Each occurrence of a key is kept"
+
+    capsys.readouterr()
+    run(tmp_path, "GRP1", rows[0:1])
+    assert "GRP1 subject: 0 new, 0 changed, 1 deleted, 1 unchanged" in capsys.readouterr().out
+
+def test_end_reports_changes(tmp_path, capsys):
+    run(tmp_path, "GRP1", [{'subject_id': 's1', 'sex': 'Male'}, {'subject_id': 's2', 'sex': 'Male'}])
+    capsys.readouterr()
+    run(tmp_path, "GRP1", [{'subject_id': 's1', 'sex': 'Female'}, {'subject_id': 's3', 'sex': 'Male'}])
+    assert "GRP1 subject: 1 new, 1 changed, 1 deleted, 0 unchanged" in capsys.readouterr().out
+
+def test_prune(tmp_path):
+    run(tmp_path, "GRP1", [{'subject_id': 's1'}])
+    run(tmp_path, "GRP2", [{'subject_id': 's2'}])
+
+    delta = RowDelta(tmp_path)
+    delta.prune(["GRP1"])
+    consents = [consent for (consent,) in delta.db.execute("SELECT DISTINCT consent FROM inputs")]
+    assert consents == ["GRP1"]
+    replays = delta.db.execute("SELECT count(*) FROM replays").fetchone()[0]
+    assert replays == 1, "GRP2's replays are gone along with its inputs"
+
+def write_subjects(output, subject_ids):
+    with open(output / "subject.tsv", 'wt', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', quotechar='"')
+        writer.writerow(["PARTICIPANT|ID", "PARTICIPANT|GENDER"])
+        for subject_id, sex in subject_ids:
+            writer.writerow([subject_id, sex])
+
+def delta_rows(output):
+    with open(output / "subject.delta.tsv", 'rt', newline='') as f:
+        return list(csv.reader(f, delimiter='\t'))[1:]
+
+def test_deltas_are_relative_to_the_last_load(tmp_path):
+    delta = RowDelta(tmp_path)
+    delta_keys = {"subject.tsv": ["PARTICIPANT|ID"]}
+
+    write_subjects(tmp_path, [("s1", "male"), ("s2", "female")])
+    delta.write_deltas(tmp_path, delta_keys)
+    assert len(delta_rows(tmp_path)) == 2, "Nothing has been loaded yet"
+
+    # Transformed again without being loaded in between
+    write_subjects(tmp_path, [("s1", "male"), ("s2", "male")])
+    delta.write_deltas(tmp_path, delta_keys)
+    assert len(delta_rows(tmp_path)) == 2, "The first transform's changes haven't been loaded yet"
+
+    assert delta.loaded() == ["subject.tsv"]
+    delta.write_deltas(tmp_path, delta_keys)
+    assert delta_rows(tmp_path) == [], "Everything has been loaded"
+
+    write_subjects(tmp_path, [("s1", "female"), ("s2", "male")])
+    delta.write_deltas(tmp_path, delta_keys)
+    assert delta_rows(tmp_path) == [["s1", "female"]]
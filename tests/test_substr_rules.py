@@ -0,0 +1,97 @@
+import csv
+import random
+
+import pytest
+
+from cmg_transform import Transform, SubstrRules
+
+def legacy_apply(rules, val):
+    """This is how ApplyMaps handled the SUBSTR rules before they were compiled"""
+    for err in rules.keys():
+        if err in val:
+            return val.replace(err, rules[err]).strip()
+    return None
+
+def check(rules, values):
+    compiled = SubstrRules(rules)
+    for val in values:
+        assert compiled.apply(val) == legacy_apply(rules, val), f"Does {val!r} get the same rewrite?"
+
+def test_overlapping_rules():
+    rules = {
+        "abc": "1",
+        "bcd": "2",
+        "b": "3",
+        "cd": "4",
+        "abcd": "5"
+    }
+    check(rules, ["abcd", "xbcdx", "bcd", "cd", "xxb", "abcabc", "dcba", "ab cd"])
+
+def test_first_rule_in_load_order_wins():
+    # "dup" appears first in the value, but "plic" was loaded first
+    rules = {"plic": "PLIC", "dup": "DUP"}
+    assert SubstrRules(rules).apply("duplicate") == "duPLICate"
+
+    # And the other way round
+    rules = {"dup": "DUP", "plic": "PLIC"}
+    assert SubstrRules(rules).apply("duplicate") == "DUPlicate"
+
+    # A rule which is a suffix of another still wins if it came first
+    rules = {"ase": "ASE", "disease": "DISEASE"}
+    assert SubstrRules(rules).apply("a disease") == "a diseASE"
+
+def test_every_occurrence_replaced_and_stripped():
+    rules = {"  ": " ", "x": ""}
+    check(rules, ["a  b  c", "x a x", "  x  "])
+    assert SubstrRules({"x": ""}).apply("x a x") == "a"
+
+def test_no_match():
+    rules = {"foo": "bar", "baz": "qux"}
+    compiled = SubstrRules(rules)
+    for val in ["", "fo", "ba z", "FOO", "something else"]:
+        assert compiled.apply(val) is None, f"{val!r} shouldn't match anything"
+        assert legacy_apply(rules, val) is None
+
+def test_empty_rule_matches_everything():
+    rules = {"q": "Q", "": "-"}
+    check(rules, ["", "abc", "q"])
+
+def test_random_rules_match_legacy():
+    random.seed(1)
+    for attempt in range(500):
+        rules = {}
+        for i in range(random.randint(1, 10)):
+            rules["".join(random.choice("ab ") for j in range(random.randint(1, 4)))] = random.choice(["X", "", "ab"])
+        values = ["".join(random.choice("ab c") for j in range(random.randint(0, 12))) for k in range(20)]
+        check(rules, values)
+
+@pytest.fixture
+def data_map(tmp_path):
+    """A data map with SUBSTR rules for a field nobody else uses"""
+    fieldname = "test_substr_field"
+    filename = tmp_path / "data_map.csv"
+    with open(filename, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["FIELD_NAME", "ALTERNATIVE", "EXPECTED", "SUBSTR"])
+        writer.writerow([fieldname, "Unkown", "Unknown", "YES"])
+        writer.writerow([fieldname, "own", "OWN", "YES"])
+        writer.writerow([fieldname, "N/A", "", "NO"])
+    Transform.LoadDataMap(filename)
+    yield fieldname
+    Transform._data_transform.pop(fieldname, None)
+    Transform._data_map.pop(fieldname, None)
+    Transform._substr_rules.pop(fieldname, None)
+    Transform.ClearMemos()
+
+def test_map_value_uses_compiled_rules(data_map):
+    rules = Transform._data_transform[data_map]
+    assert data_map in Transform._substr_rules, "The rules are compiled when the map is loaded"
+
+    for val in ["Unkown status", "Known", "nothing", "N/A"]:
+        expected = legacy_apply(rules, val)
+        if val == "N/A":
+            expected = ""
+        elif expected is None:
+            expected = Transform.Value(val)
+        assert Transform.MapValue(data_map, val) == expected
+        assert Transform.ApplyMaps(data_map, val) == expected
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+
+import pytest
+from aiohttp import web
+
+from cmg_transform.tools.variant_details import Variant, VarCache, header
+from cmg_transform.tools.variant_annotator import VariantAnnotator
+
+transcript = "NM_000001.2"
+
+class StubServer:
+    """Stands in for the clinical tables API. Each hgvsc can be given a list of
+    (status, headers) to answer with before it finally gets its 200"""
+    def __init__(self):
+        self.scripts = {}
+
+        # hgvsc => [time each request arrived]
+        self.requests = defaultdict(list)
+        self.arrivals = []
+        self.runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/search", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/search?terms="
+
+    async def handle(self, request):
+        trscpt, hgvsc = request.query['terms'].split(" ")
+        now = time.monotonic()
+        attempt = len(self.requests[hgvsc])
+        self.requests[hgvsc].append(now)
+        self.arrivals.append(now)
+
+        script = self.scripts.get(hgvsc, [])
+        if attempt < len(script):
+            status, headers = script[attempt]
+            return web.Response(status=status, headers=headers)
+
+        values = dict((col, "") for col in header)
+        values.update({
+            'VariantID': f"v-{hgvsc}",
+            'Name': hgvsc,
+            'GeneSymbol': "GENE1",
+            'RefSeqID': f"{trscpt}.1"
+        })
+        return web.json_response([1, [values['VariantID']], None, [[values[col] for col in header]]])
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    yield server
+    asyncio.run_coroutine_threadsafe(server.runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    """Keep the real variant cache out of it"""
+    monkeypatch.setattr(VarCache, "fn", tmp_path / "variant_cache.csv")
+    monkeypatch.setattr(VarCache, "miss", tmp_path / "variant_missing.csv")
+    cache = VarCache(tmp_path / "variant_cache.db")
+    monkeypatch.setattr(Variant, "cache", cache)
+    yield cache
+    cache.close()
+
+def annotator(stub, **kwargs):
+    settings = {'rate': 1000.0, 'concurrency': 8, 'retries': 3, 'backoff': 0.05, 'timeout': 5}
+    settings.update(kwargs)
+    return VariantAnnotator(base_url=stub.base_url, **settings)
+
+def test_rate_is_respected(stub, cache):
+    rate = 20.0
+    hgvscs = [f"c.{i}A>G" for i in range(10)]
+    client = annotator(stub, rate=rate)
+    results = client.annotate([(hgvsc, transcript) for hgvsc in hgvscs])
+
+    assert sorted(results.keys()) == sorted(hgvscs)
+    for hgvsc in hgvscs:
+        assert results[hgvsc].variant_id == f"v-{hgvsc}"
+        assert cache.get_variant(hgvsc).variant_id == f"v-{hgvsc}", "Resolved variants end up in the cache"
+
+    assert client.remote_calls == len(hgvscs)
+    arrivals = sorted(stub.arrivals)
+    gaps = [b - a for a, b in zip(arrivals, arrivals[1:])]
+
+    # Allow a little for the clock, but nothing close to two at once
+    assert min(gaps) > 0.8 / rate, "Requests are spaced out by the token bucket"
+    assert arrivals[-1] - arrivals[0] >= 0.95 * (len(hgvscs) - 1) / rate
+
+def test_cached_variants_are_not_queried(stub):
+    client = annotator(stub)
+    client.annotate([("c.1A>G", transcript)])
+    client = annotator(stub)
+    results = client.annotate([("c.1A>G", transcript), ("c.1A>G", transcript)])
+
+    assert results["c.1A>G"].variant_id == "v-c.1A>G"
+    assert client.remote_calls == 0
+    assert len(stub.requests["c.1A>G"]) == 1
+
+def test_retry_after(stub):
+    stub.scripts["c.1A>G"] = [(429, {"Retry-After": "1"})]
+    client = annotator(stub)
+    results = client.annotate([("c.1A>G", transcript)])
+
+    assert results["c.1A>G"].variant_id == "v-c.1A>G"
+    first, second = stub.requests["c.1A>G"]
+
+    # The backoff alone would have tried again after 0.05s
+    assert second - first >= 0.95, "The retry waits for as long as the server asked"
+    assert client.remote_calls == 2
+    assert client.failures == 0
+
+def test_server_errors_back_off(stub, cache):
+    stub.scripts["c.1A>G"] = [(503, {})] * 10
+    stub.scripts["c.2A>G"] = [(500, {}), (502, {})]
+    client = annotator(stub, retries=3, backoff=0.1)
+    results = client.annotate([("c.1A>G", transcript), ("c.2A>G", transcript)])
+
+    attempts = stub.requests["c.1A>G"]
+    assert len(attempts) == 4, "One try and 3 retries"
+    gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+    for gap, delay in zip(gaps, [0.1, 0.2, 0.4]):
+        assert gap >= delay * 0.95, "Each retry waits twice as long as the last"
+
+    assert results["c.1A>G"] is None
+    assert cache.get_variant("c.1A>G") is None, "Giving up isn't recorded, so it'll be tried again next run"
+
+    assert len(stub.requests["c.2A>G"]) == 3
+    assert results["c.2A>G"].variant_id == "v-c.2A>G", "A retry that succeeds is as good as the first try"
+
+    assert client.remote_calls == 7
+    assert client.failures == 1
+
+def test_not_found_is_a_miss_without_retrying(stub):
+    stub.scripts["c.1A>G"] = [(404, {})]
+    client = annotator(stub)
+    results = client.annotate([("c.1A>G", transcript)])
+
+    assert results["c.1A>G"] is None
+    assert len(stub.requests["c.1A>G"]) == 1
+    assert client.remote_calls == 1
+    assert client.failures == 1